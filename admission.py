@@ -0,0 +1,49 @@
+""" Token buckets limiting how many seconds of audio each client (by IP address, and by submitter; see
+scheduler.submitter_key) can have decoded, refilling at a steady rate up to a burst. They come on top
+of the limits on queued audio, per submitter and overall, which the server checks against the job
+store (see server.check_admission).
+Each bucket is kept as a single number, as in GCRA (the generic cell rate algorithm): the time at which
+it will be full again. A request is admitted while its bucket isn't empty, and is charged the duration
+of its audio once that's known, which may leave the bucket in debt. Buckets are slots of a fixed table
+in shared memory, allocated when a TokenBuckets is created (so the decoder workers forked afterwards,
+which refund audio found to be shorter than charged, update the same table) and indexed by a hash of
+the key, so colliding keys share a bucket. No lock is taken: a slot is read and written whole, so two
+processes updating the same bucket at once can at worst lose one charge, and the server's greenlets
+never yield partway through an update. """
+import multiprocessing
+import time
+import zlib
+
+BUCKET_SLOTS = 4096
+
+class TokenBuckets:
+    def __init__(self, rate, burst, slots=BUCKET_SLOTS):
+        """ rate is the audio seconds per second each bucket refills at, burst the most it holds """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.full_at = multiprocessing.RawArray("d", slots)
+
+    def _slot(self, key):
+        return (zlib.crc32(key.encode("utf-8")) & 0xffffffff) % len(self.full_at)
+
+    def wait_s(self, key, now=None):
+        """ Returns how long until the given key's bucket isn't empty, or 0 if it isn't now
+        (or key is None, for clients that can't be told apart) """
+        if key is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return max(0.0, self.full_at[self._slot(key)] - self.burst / self.rate - now)
+
+    def charge(self, key, audio_s, now=None):
+        if key is None:
+            return
+        now = time.time() if now is None else now
+        slot = self._slot(key)
+        self.full_at[slot] = max(self.full_at[slot], now) + audio_s / self.rate
+
+    def refund(self, key, audio_s):
+        """ Gives back audio seconds charged for (e.g. when the audio was shorter than estimated) """
+        if key is None:
+            return
+        slot = self._slot(key)
+        self.full_at[slot] = max(0.0, self.full_at[slot] - audio_s / self.rate)
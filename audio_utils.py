@@ -0,0 +1,209 @@
+""" Audio file helpers shared by the real and fake decoders. Files are processed in fixed-size
+blocks so memory use doesn't grow with the length of the recording. Errors from libsndfile
+propagate as RuntimeError.
+Once converted to a 16-bit PCM wav file, a recording isn't copied again: later stages work on
+PcmViews, spans of frames of the file which are memory-mapped (or read straight from the file by
+the demodulator) rather than written out to new files. """
+from collections import namedtuple
+import hashlib
+import numpy
+import os
+import resampler
+import soundfile as sf
+import struct
+
+AUDIO_BLOCK_FRAMES = 65536
+PCM_FORMAT_TAGS = (0x0001, 0xFFFE) # WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE (with a PCM subformat)
+WAV_FMT_MAX_BYTES = 1024
+
+AudioInfo = namedtuple("AudioInfo", ["sample_rate", "nframes", "channels", "subtype", "duration"])
+# the frames [start_i, start_i + nframes) of a 16-bit PCM wav file, whose frame 0 is at byte data_offset
+PcmView = namedtuple("PcmView", ["filename", "data_offset", "start_i", "nframes", "channels", "sample_rate"])
+
+def probe_audiofile(filename):
+    """ Returns an AudioInfo for the given audio file, read from its header without decoding any audio """
+    info = sf.info(filename)
+    duration = float(info.frames) / info.samplerate if info.samplerate > 0 else 0
+    return AudioInfo(info.samplerate, info.frames, info.channels, info.subtype, duration)
+
+def get_audio_info(filename):
+    """ Returns the sample rate, duration (s) and number of frames of the given audio file """
+    info = probe_audiofile(filename)
+    return info.sample_rate, info.duration, info.nframes
+
+def wav_filename(filename):
+    """ Returns the name of the .wav file the given file is converted to """
+    doti = filename.rfind(".")
+    if doti == -1:
+        return filename + ".wav"
+    else:
+        return filename[:doti] + ".wav"
+
+def _write_blocks(outfilename, sample_rate, channels, subtype, blocks):
+    """ Writes the given blocks of frames to a new .wav file, through a temporary file so outfilename
+    may be the input file. Returns the number of frames written """
+    tmpfilename = outfilename + ".part"
+    nframes = 0
+    try:
+        with sf.SoundFile(tmpfilename, "w", samplerate=sample_rate, channels=channels,
+                          subtype=subtype, format="WAV") as outfile:
+            for block in blocks:
+                outfile.write(block)
+                nframes += len(block)
+    except:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+        raise
+
+    os.rename(tmpfilename, outfilename)
+    return nframes
+
+def copy_blocks(infile, outfilename, subtype, frames=-1):
+    """ Copies the given number of frames (all remaining ones if -1) from the current position of the
+    open SoundFile infile to a new .wav file block by block. The output is written to a temporary file
+    first, so outfilename may be the input file. Returns the number of frames written """
+    return _write_blocks(outfilename, infile.samplerate, infile.channels, subtype,
+                         infile.blocks(blocksize=AUDIO_BLOCK_FRAMES, frames=frames))
+
+def mono_blocks(infile, sample_rate):
+    """ Yields the open SoundFile infile block by block, mixed down to mono and resampled to
+    sample_rate (see resampler.py) if it isn't at that rate already """
+    resample = resampler.Resampler(infile.samplerate, sample_rate) if infile.samplerate != sample_rate else None
+    for block in infile.blocks(blocksize=AUDIO_BLOCK_FRAMES, dtype="float32", always_2d=True):
+        block = block.mean(axis=1)
+        yield block if resample is None else resample.process(block)
+    if resample is not None:
+        yield resample.flush()
+
+def convert_audiofile(filename, subtype, max_sample_rate=None):
+    """ Converts the given file to a .wav file with the given subtype. If max_sample_rate is given, it's
+    also mixed down to mono and resampled to max_sample_rate if its rate is higher (lower rates are kept,
+    as upsampling would only add work). Returns the wav filename, sample rate, duration (s) and number of
+    frames. A file which already is a 16-bit PCM wav file (mono at most max_sample_rate, if that's given)
+    is used as it is (and its own name returned) """
+    if subtype == "PCM_16":
+        try:
+            view = pcm_view(filename)
+            if max_sample_rate is None or (view.channels == 1 and view.sample_rate <= max_sample_rate):
+                return filename, view.sample_rate, float(view.nframes) / view.sample_rate, view.nframes
+        except ValueError: # not a 16-bit PCM wav file
+            pass
+
+    wavfilename = wav_filename(filename)
+    with sf.SoundFile(filename) as infile:
+        if max_sample_rate is None:
+            sample_rate = infile.samplerate
+            nframes = copy_blocks(infile, wavfilename, subtype)
+        else:
+            sample_rate = min(infile.samplerate, max_sample_rate)
+            # the filter's overshoot could take full scale input past full scale
+            blocks = (numpy.clip(block, -1, 1 - 1.0 / 32768) for block in mono_blocks(infile, sample_rate))
+            nframes = _write_blocks(wavfilename, sample_rate, 1, subtype, blocks)
+
+    return wavfilename, sample_rate, float(nframes) / sample_rate, nframes
+
+def slice_audiofile(filename, start_i, stop_i, outfilename=None):
+    """ Overwrites the given audio file (or writes outfilename) with its frames [start_i, stop_i).
+    Negative indices reference from the end of the file, and stop_i may be None.
+    Returns the number of frames remaining """
+    with sf.SoundFile(filename) as infile:
+        start_i, stop_i = frame_span(infile.frames, start_i, stop_i)
+        infile.seek(start_i)
+        return copy_blocks(infile, outfilename or filename, infile.subtype, stop_i - start_i)
+
+def view_audiofile(filename, start_s, stop_s, sample_rate):
+    """ Resolves start_s and stop_s (which may be negative to reference from the end, or None) to the
+    span of frames [start_i, stop_i) of the given audio file, leaving the file as it is (the span is
+    demodulated in place, see DecoderQueue.demod_wavfile). Returns its duration (s) and the span """
+    frames = frame_span(probe_audiofile(filename).nframes, None if start_s is None else int(start_s * sample_rate),
+                        None if stop_s is None else int(stop_s * sample_rate))
+    return float(frames[1] - frames[0]) / sample_rate, frames
+
+def frame_span(nframes, start_i, stop_i):
+    """ Resolves start_i and stop_i (which may be negative to reference from the end, or None) to the
+    span [start_i, stop_i) of a file of nframes frames, with stop_i >= start_i """
+    start_i, stop_i, _ = slice(start_i, stop_i).indices(nframes)
+    return start_i, max(start_i, stop_i)
+
+def read_pcm_header(filename):
+    """ Reads the header of a 16-bit PCM wav file, returning the offset of its sample data in bytes,
+    its number of frames, channels and sample rate. Raises ValueError for any other file """
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        riff = f.read(12)
+        if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            raise ValueError("%s is not a wav file" % filename)
+
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("%s has no sample data" % filename)
+            chunk_id = chunk[0:4]
+            chunk_size, = struct.unpack("<I", chunk[4:8])
+            if chunk_id == b"fmt " and 16 <= chunk_size <= WAV_FMT_MAX_BYTES:
+                body = f.read(chunk_size + chunk_size % 2)
+                fmt = struct.unpack("<HHIIHH", body[0:16])
+                if fmt[0] == 0xFFFE and chunk_size >= 26:
+                    fmt = struct.unpack("<H", body[24:26]) + fmt[1:] # the subformat's tag
+            elif chunk_id == b"data":
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR) # chunks are word aligned
+        data_offset = f.tell()
+
+    if fmt is None:
+        raise ValueError("%s has no format chunk before its sample data" % filename)
+    tag, channels, sample_rate, _, _, bits = fmt
+    if tag not in PCM_FORMAT_TAGS or bits != 16 or channels < 1 or sample_rate < 1 or data_offset % 2 != 0:
+        raise ValueError("%s is not a 16-bit PCM wav file" % filename)
+    # the size may be wrong (e.g. left at its maximum by a streaming writer), so trust the file's
+    data_bytes = min(chunk_size, file_size - data_offset)
+    return data_offset, data_bytes // (2 * channels), channels, sample_rate
+
+def pcm_view(filename, frames=None):
+    """ Returns a PcmView of the frames [start_i, stop_i) of the given 16-bit PCM wav file, or all of it
+    if frames is None. Raises ValueError if it isn't such a file """
+    data_offset, nframes, channels, sample_rate = read_pcm_header(filename)
+    start_i, stop_i = frame_span(nframes, *(frames or (0, None)))
+    return PcmView(filename, data_offset, start_i, stop_i - start_i, channels, sample_rate)
+
+def sub_view(view, start_i, stop_i):
+    """ Returns the PcmView of the frames [start_i, stop_i) of the file of the given PcmView """
+    return view._replace(start_i=start_i, nframes=max(0, stop_i - start_i))
+
+def map_pcm(view):
+    """ Returns the samples of the given PcmView as a read-only (frames, channels) int16 array
+    memory-mapped from its file, so only the pages actually touched are ever read """
+    if view.nframes == 0:
+        return numpy.zeros((0, view.channels), dtype=numpy.int16)
+    return numpy.memmap(view.filename, dtype="<i2", mode="r", shape=(view.nframes, view.channels),
+                        offset=view.data_offset + 2 * view.start_i * view.channels)
+
+def pcm_blocks(view, blocksize=AUDIO_BLOCK_FRAMES):
+    """ Yields consecutive blocks of up to blocksize frames of the given PcmView, as views of its mapping """
+    samples = map_pcm(view)
+    for start in range(0, len(samples), blocksize):
+        yield samples[start:start + blocksize]
+
+def read_windows(filename, window_frames, frames=None):
+    """ Reads the given 16-bit PCM wav file (only its frames [start_i, stop_i) if frames is given) block
+    by block, yielding its consecutive windows of window_frames frames (mixed down to mono and normalized
+    like libsndfile's float samples) as the rows of float32 arrays; a partial last window is dropped """
+    blocksize = window_frames * max(1, AUDIO_BLOCK_FRAMES // window_frames)
+    for block in pcm_blocks(pcm_view(filename, frames), blocksize):
+        nwindows = len(block) // window_frames
+        if nwindows == 0:
+            break
+        mono = block[:nwindows * window_frames].mean(axis=1, dtype=numpy.float32) / 32768
+        yield mono.reshape(nwindows, window_frames)
+
+def hash_audiofile(filename, frames=None):
+    """ Returns a hex digest of the given 16-bit PCM wav file's sample rate, channel count and
+    samples (only its frames [start_i, stop_i) if frames is given), which doesn't depend on its metadata """
+    view = pcm_view(filename, frames)
+    digest = hashlib.sha1()
+    digest.update(("%d:%d:" % (view.sample_rate, view.channels)).encode("ascii"))
+    for block in pcm_blocks(view):
+        digest.update(block.tobytes())
+    return digest.hexdigest()
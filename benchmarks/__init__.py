@@ -0,0 +1,2 @@
+""" Benchmarks for the decode server. Run from the repository root with
+python -m benchmarks.<name> (see each module for its options) """
@@ -0,0 +1,91 @@
+""" Measures the wall time of decoding one long recording (the sample recording repeated) through a
+DecoderQueue, demodulated whole versus split into chunks demodulated in parallel (see chunking.py)
+by increasing numbers of workers, and checks the split runs decode the same packets. (As the clip
+repeats the recording, its packets repeat too, and merging keeps only one of each; so packets
+are compared as sets.)
+
+usage: python -m benchmarks.chunked_decode [--duration 480] [--workers 1 2 4] [--json out.json]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import decoder
+import jobstore
+from decoder import DecoderQueue
+from benchmarks.clips import make_clip
+
+RUN_TIMEOUT_S = 1800
+
+def copy_clip_stage(job):
+    """ Gives each job its own copy of the clip, like an upload """
+    shutil.copyfile(job["args"]["clip"], job["wavfilename"])
+
+def on_finish(wavfilename, packets, args, err):
+    if os.path.exists(wavfilename):
+        os.remove(wavfilename)
+
+def run(clip, folder, split, workers):
+    decoder.SPLIT_LONG_RECORDINGS = split
+    store = jobstore.JobStore(os.path.join(folder, "jobs_%s_%d.db" % (split, workers)))
+    dec = DecoderQueue(in_logger=logging.getLogger("chunked_decode"), store=store)
+    dec.start(workers, workers)
+    try:
+        time.sleep(2) # let the workers start
+        start = time.time()
+        job_id = dec.submit(os.path.join(folder, "recording.wav"), on_finish, {"clip": clip}, [copy_clip_stage])
+        while time.time() - start < RUN_TIMEOUT_S:
+            job = store.get(job_id)
+            if job["state"] in jobstore.FINISHED_STATES:
+                break
+            time.sleep(0.1)
+        elapsed = time.time() - start
+    finally:
+        dec.stop()
+
+    packets = job["packets"] or {"corrected_packets": []}
+    return {
+        "split": split,
+        "workers": workers,
+        "state": job["state"],
+        "chunks": job["chunks"]["total"] if job["chunks"] else 1,
+        "elapsed_s": elapsed,
+        "corrected": set(p["corrected"] for p in packets["corrected_packets"]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Wall time of decoding a long recording whole and split into chunks")
+    parser.add_argument("--duration", type=float, default=480)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts for the split runs")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    clip = make_clip(options.duration, folder=folder)
+    results = []
+    print("%6s %8s %7s %10s %8s %8s %12s" % ("split", "workers", "chunks", "elapsed_s", "speedup", "packets", "same_packets"))
+    try:
+        whole = None
+        for split, workers in [(False, 1)] + [(True, w) for w in options.workers]:
+            result = run(clip, folder, split, workers)
+            if whole is None:
+                whole = dict(result)
+            result["speedup"] = whole["elapsed_s"] / result["elapsed_s"]
+            result["packets"] = len(result["corrected"])
+            result["same_packets"] = result["corrected"] == whole["corrected"]
+            print("%(split)6s %(workers)8d %(chunks)7d %(elapsed_s)10.2f %(speedup)8.2f %(packets)8d %(same_packets)12s" % result)
+            del result["corrected"]
+            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
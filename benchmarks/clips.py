@@ -0,0 +1,48 @@
+import numpy
+import os
+import soundfile as sf
+import tempfile
+
+WRITE_BLOCK_FRAMES = 65536 # libsndfile's Vorbis encoder crashes on very large writes
+SAMPLE_RECORDING = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "static", "good_equisat_fm_recording.wav")
+
+def make_clip(duration_s, recording=SAMPLE_RECORDING, subtype="PCM_16", folder=None, suffix=".wav"):
+    """ Writes a temporary audio file of the given duration made by repeating (or truncating)
+    the given recording, and returns its filename. The format is chosen by suffix (use
+    subtype=None for the format's default). The caller is responsible for removing it """
+    data, sample_rate = sf.read(recording, always_2d=True)
+    nframes = int(duration_s * sample_rate)
+
+    fd, filename = tempfile.mkstemp(suffix=suffix, dir=folder)
+    os.close(fd)
+    with sf.SoundFile(filename, "w", samplerate=sample_rate, channels=data.shape[1], subtype=subtype) as f:
+        while nframes > 0:
+            for start in range(0, min(nframes, len(data)), WRITE_BLOCK_FRAMES):
+                f.write(data[start:min(nframes, start + WRITE_BLOCK_FRAMES)])
+            nframes -= len(data)
+    return filename
+
+def make_pass_clip(duration_s, burst_every_s=30, recording=SAMPLE_RECORDING, noise_from_s=3.5, folder=None):
+    """ Writes a temporary .wav file of the given duration resembling a satellite pass: receiver noise
+    (repeated from the part of the recording after noise_from_s, which has no bursts) with the whole
+    recording in the middle of every burst_every_s. Returns its filename; the caller is responsible for removing it """
+    data, sample_rate = sf.read(recording, always_2d=True)
+    noise = data[int(noise_from_s * sample_rate):]
+    every = max(len(data), int(burst_every_s * sample_rate))
+    lead = (every - len(data)) // 2
+    tile = lambda n: numpy.tile(noise, (n // len(noise) + 1, 1))[:n]
+    period = numpy.concatenate([tile(lead), data, tile(every - lead - len(data))])
+
+    fd, filename = tempfile.mkstemp(suffix=".wav", dir=folder)
+    os.close(fd)
+    nframes = int(duration_s * sample_rate)
+    with sf.SoundFile(filename, "w", samplerate=sample_rate, channels=data.shape[1], subtype="PCM_16") as f:
+        while nframes > 0:
+            f.write(period[:nframes])
+            nframes -= len(period)
+    return filename
+
+def packet_bytes(packets):
+    """ The raw and corrected packets of a packets dict, sorted, for comparing the results of two demods """
+    return sorted(packets["raw_packets"]), sorted(p["corrected"] for p in packets["corrected_packets"])
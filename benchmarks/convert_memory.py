@@ -0,0 +1,85 @@
+""" Measures the peak RSS of the upload convert + slice path (convert_audiofile followed by
+slice_audiofile) for increasingly long Ogg Vorbis inputs, using the decoder's and the fake
+decoder's DecoderQueue as well as the previous whole-file sf.read/sf.write implementation.
+Each measurement runs in a fresh process; the idle RSS of such a process is reported too.
+
+usage: python -m benchmarks.convert_memory [--lengths 30,120,480] [--queues fake,decoder,legacy] [--json out.json]
+"""
+import argparse
+import audio_utils
+import json
+import multiprocessing
+import os
+import resource
+import soundfile as sf
+
+from benchmarks.clips import make_clip
+
+def legacy_convert_slice(filename):
+    """ The whole-file conversion and slicing used before audio_utils """
+    data, sample_rate = sf.read(filename)
+    wavfilename = filename[:filename.rfind(".")] + ".wav"
+    sf.write(wavfilename, data, sample_rate, subtype="PCM_16")
+    data, _ = sf.read(wavfilename, start=0, stop=len(data) // 2)
+    sf.write(wavfilename, data, sample_rate)
+    return wavfilename
+
+def load_queue(queue_name):
+    if queue_name == "fake":
+        from fake_decoder import DecoderQueue
+    elif queue_name == "decoder":
+        from decoder import DecoderQueue
+    else:
+        DecoderQueue = None
+    return DecoderQueue
+
+def convert_slice(queue_name, filename):
+    DecoderQueue = load_queue(queue_name)
+    if DecoderQueue is None:
+        return legacy_convert_slice(filename)
+
+    wavfilename, sample_rate, duration, _ = DecoderQueue.convert_audiofile(filename)
+    audio_utils.slice_audiofile(wavfilename, 0, int(duration / 2 * sample_rate))
+    return wavfilename
+
+def measure(queue_name, filename, results):
+    load_queue(queue_name)
+    if filename is not None:
+        os.remove(convert_slice(queue_name, filename))
+    results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def peak_rss_kb(queue_name, filename):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=measure, args=(queue_name, filename, results))
+    proc.start()
+    peak = results.get()
+    proc.join()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak RSS of audio conversion and slicing")
+    parser.add_argument("--lengths", default="30,120,480", help="comma-separated input lengths in seconds")
+    parser.add_argument("--queues", default="fake,decoder,legacy", help="implementations to measure")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    results = []
+    print("%8s %10s %14s %14s" % ("input_s", "queue", "peak_rss_kb", "idle_rss_kb"))
+    for length in [float(l) for l in options.lengths.split(",")]:
+        filename = make_clip(length, subtype=None, suffix=".ogg")
+        try:
+            for queue_name in options.queues.split(","):
+                idle = peak_rss_kb(queue_name, None)
+                peak = peak_rss_kb(queue_name, filename)
+                print("%8.0f %10s %14d %14d" % (length, queue_name, peak, idle))
+                results.append({"input_s": length, "queue": queue_name,
+                                "peak_rss_kb": peak, "idle_rss_kb": idle})
+        finally:
+            os.remove(filename)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+""" Checks that the decoder pool keeps its capacity when workers die: runs a batch of jobs through a
+DecoderQueue, with a fraction of them killing their worker (SIGKILL, as the OOM killer would) on
+their first attempt, and compares completion time and worker count against a run without crashes.
+Every job should still finish, the crashed ones on their second attempt.
+
+usage: python -m benchmarks.crash_recovery [--jobs 20] [--crash-rate 0.25] [--workers 2] [--json out.json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import tempfile
+import time
+
+import jobstore
+from decoder import DecoderQueue
+from benchmarks.clips import make_clip
+
+CLIP_S = 2
+RUN_TIMEOUT_S = 600
+
+def copy_clip_stage(job):
+    """ Gives each job its own copy of the clip, like an upload """
+    shutil.copyfile(job["args"]["clip"], job["wavfilename"])
+
+def crash_stage(job):
+    """ Kills the worker on the job's first attempt """
+    if job["attempts"] == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+
+def on_finish(wavfilename, packets, args, err):
+    if os.path.exists(wavfilename):
+        os.remove(wavfilename)
+
+def run(clip, folder, jobs, crash_rate, workers):
+    store = jobstore.JobStore(os.path.join(folder, "jobs_%s.db" % crash_rate))
+    dec = DecoderQueue(in_logger=logging.getLogger("crash_recovery"), store=store)
+    dec.start(workers, workers)
+    try:
+        start = time.time()
+        job_ids = []
+        for i in range(jobs):
+            stages = [copy_clip_stage]
+            if random.random() < crash_rate:
+                stages.append(crash_stage)
+            job_ids.append(dec.submit(os.path.join(folder, "job%d.wav" % i), on_finish, {"clip": clip}, stages))
+
+        worker_counts = []
+        while time.time() - start < RUN_TIMEOUT_S:
+            worker_counts.append(len(dec.supervisor.active_workers()))
+            states = [store.get(job_id)["state"] for job_id in job_ids]
+            if all(state in jobstore.FINISHED_STATES for state in states):
+                break
+            time.sleep(0.5)
+        elapsed = time.time() - start
+    finally:
+        dec.stop()
+
+    return {
+        "crash_rate": crash_rate,
+        "jobs": jobs,
+        "done": states.count(jobstore.DONE),
+        "failed": states.count(jobstore.FAILED),
+        "elapsed_s": elapsed,
+        "crashes": dec.supervisor.crashes,
+        "min_workers_seen": min(worker_counts),
+        "mean_workers_seen": float(sum(worker_counts)) / len(worker_counts),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Decoder pool capacity under injected worker crashes")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--crash-rate", type=float, default=0.25, help="fraction of jobs which kill their worker once")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    clip = make_clip(CLIP_S, folder=folder)
+    results = []
+    print("%10s %6s %6s %8s %10s %8s %12s" % ("crash_rate", "done", "failed", "crashes", "elapsed_s", "min_wkr", "mean_workers"))
+    try:
+        for crash_rate in [0.0, options.crash_rate]:
+            result = run(clip, folder, options.jobs, crash_rate, options.workers)
+            print("%(crash_rate)10.2f %(done)6d %(failed)6d %(crashes)8d %(elapsed_s)10.2f %(min_workers_seen)8d %(mean_workers_seen)12.2f" % result)
+            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+""" Measures decoding synthetic recordings (see synth.py) end to end through a DecoderQueue: for each
+combination of sample rate, SNR, carrier frequency offset, amplitude and duration, submits --jobs
+recordings to a fresh queue with --workers workers and reports
+- throughput, in seconds of audio per CPU second (of the workers and this process) and per wall second,
+- the mean and worst time taken by each stage and spent queued (from the job store),
+- the workers' peak RSS,
+- the packet recovery rate: the fraction of the packets expected from each job's bursts which it
+  decoded, in order (so a packet repeated by a later burst counts again), where a burst's expected
+  packets are those decoded from a clean synthesis of it alone at the same sample rate (in a separate
+  process, so the workers don't inherit its flowgraphs).
+Write the results to JSON with --json to compare them between revisions.
+
+usage: python -m benchmarks.end_to_end [--sample-rates 8000 44100 48000 96000] [--snr-db 30 10]
+    [--freq-offset-hz 0 500] [--amplitude 0.5] [--durations 60] [--jobs 2] [--workers 2] [--json out.json]
+"""
+import argparse
+import difflib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import jobstore
+from decoder import DecoderQueue
+from benchmarks import synth
+
+MAX_DURATION_S = 480 # server.MAX_AUDIOFILE_DURATION_S
+REFERENCE = {"snr_db": 60, "freq_offset_hz": 0, "amplitude": 0.5}
+RUN_TIMEOUT_S = 1800
+PROC_STAT = "/proc/%d/stat"
+PROC_STATUS = "/proc/%d/status"
+
+def process_cpu_s(pid):
+    """ Returns the user and system CPU time used by the given process so far, or 0 if it's gone """
+    try:
+        with open(PROC_STAT % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except IOError:
+        return 0
+    # utime and stime are the 14th and 15th fields, counting the pid and command name
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def process_peak_rss_kb(pid):
+    try:
+        with open(PROC_STATUS % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def own_cpu_s():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def on_finish(wavfilename, packets, args, err):
+    if os.path.exists(wavfilename):
+        os.remove(wavfilename)
+
+def corrected(packets):
+    return [p["corrected"] for p in (packets or {"corrected_packets": []})["corrected_packets"]]
+
+def reference_worker(sample_rate, symbols, folder, results):
+    packets = []
+    for levels in symbols:
+        filename, _ = synth.make_recording(synth_period_s(symbols), sample_rate, symbols=[levels],
+                                           burst_every_s=synth_period_s(symbols), folder=folder, **REFERENCE)
+        try:
+            packets.append(corrected(DecoderQueue.demod_wavfile(filename)))
+        finally:
+            os.remove(filename)
+    results.put(packets)
+
+def reference_packets(sample_rate, symbols, folder):
+    """ The packets decoded from each burst alone at the given sample rate, with next to no noise. They're
+    decoded in a child process, as demodulating here would leave warm flowgraphs (see demod_pool.py)
+    for the DecoderQueue's workers to inherit """
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=reference_worker, args=(sample_rate, symbols, folder, results))
+    proc.start()
+    packets = results.get()
+    proc.join()
+    return packets
+
+def expected_packets(reference, nbursts):
+    """ The packets expected from a recording of nbursts bursts cycling through those of the reference """
+    return [packet for i in range(nbursts) for packet in reference[i % len(reference)]]
+
+def recovered_packets(expected, packets):
+    """ The number of the expected packets which were decoded, matching them in order """
+    matcher = difflib.SequenceMatcher(None, expected, packets, autojunk=False)
+    return sum(block.size for block in matcher.get_matching_blocks())
+
+def synth_period_s(symbols):
+    """ Burst spacing leaving a second of noise around the longest burst """
+    return max(len(levels) for levels in symbols) / float(synth.SYMBOL_RATE) + 2
+
+def summarize(durations):
+    durations = [d for d in durations if d is not None]
+    if len(durations) == 0:
+        return None
+    return {"mean_s": sum(durations) / len(durations), "max_s": max(durations), "count": len(durations)}
+
+def run(config, symbols, reference, options, folder):
+    recordings = []
+    recording_packets = {}
+    for i in range(options.jobs):
+        filename, nbursts = synth.make_recording(config["duration_s"], config["sample_rate"], config["snr_db"],
+                                                 config["freq_offset_hz"], config["amplitude"],
+                                                 synth_period_s(symbols), seed=i, symbols=symbols, folder=folder)
+        recordings.append(filename)
+        recording_packets[filename] = expected_packets(reference, nbursts)
+
+    store = jobstore.JobStore(os.path.join(folder, "jobs.db"))
+    dec = DecoderQueue(in_logger=logging.getLogger("end_to_end"), store=store)
+    dec.start(options.workers, options.workers)
+    try:
+        time.sleep(2) # let the workers start
+        workers_cpu_before = dict((w.proc.pid, process_cpu_s(w.proc.pid)) for w in dec.workers)
+        own_cpu_before = own_cpu_s()
+        start = time.time()
+        job_ids = [dec.submit(filename, on_finish, {}, duration=config["duration_s"]) for filename in recordings]
+        expected = dict((job_id, recording_packets[filename]) for job_id, filename in zip(job_ids, recordings))
+        jobs = {}
+        while len(jobs) < len(job_ids) and time.time() - start < RUN_TIMEOUT_S:
+            for job_id in job_ids:
+                job = store.get(job_id)
+                if job["state"] in jobstore.FINISHED_STATES:
+                    jobs[job_id] = job
+            time.sleep(0.1)
+        wall_s = time.time() - start
+        cpu_s = own_cpu_s() - own_cpu_before + sum(process_cpu_s(w.proc.pid) - workers_cpu_before.get(w.proc.pid, 0)
+                                                   for w in dec.workers)
+        peak_rss_kb = [process_peak_rss_kb(w.proc.pid) for w in dec.workers]
+        waits = [c["wait_s"] for c in store.claims(start) if c["id"] in job_ids]
+    finally:
+        dec.stop()
+        for filename in recordings:
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.remove(os.path.join(folder, "jobs.db"))
+
+    audio_s = config["duration_s"] * len(jobs)
+    stages = {}
+    for job in jobs.values():
+        for stage in job["stages"]:
+            stages.setdefault(stage["stage"], []).append(stage["duration_s"])
+    recovered = [recovered_packets(expected[job_id], corrected(job["packets"])) for job_id, job in jobs.items()]
+    nexpected = sum(len(packets) for packets in expected.values())
+    result = dict(config)
+    result.update({
+        "jobs": len(job_ids),
+        "done": len([j for j in jobs.values() if j["state"] == jobstore.DONE]),
+        "audio_s": audio_s,
+        "wall_s": wall_s,
+        "cpu_s": cpu_s,
+        "audio_s_per_cpu_s": audio_s / cpu_s if cpu_s > 0 else None,
+        "audio_s_per_wall_s": audio_s / wall_s,
+        "queue_wait": summarize(waits),
+        "stages": dict((name, summarize(durations)) for name, durations in stages.items()),
+        "peak_rss_kb": max([0] + [kb for kb in peak_rss_kb if kb is not None]) or None,
+        "expected_packets": nexpected,
+        "recovery_rate": float(sum(recovered)) / nexpected if nexpected > 0 else None,
+    })
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end decoding throughput, latency, memory and packet recovery "
+                                                 "over synthetic recordings")
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=synth.SAMPLE_RATES)
+    parser.add_argument("--snr-db", type=float, nargs="+", default=[30, 10])
+    parser.add_argument("--freq-offset-hz", type=float, nargs="+", default=[0])
+    parser.add_argument("--amplitude", type=float, nargs="+", default=[0.5], help="peak of the bursts relative to full scale")
+    parser.add_argument("--durations", type=float, nargs="+", default=[60], help="recording lengths in seconds")
+    parser.add_argument("--jobs", type=int, default=2, help="recordings decoded per combination")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+    if any(d > MAX_DURATION_S for d in options.durations):
+        parser.error("the server doesn't accept recordings longer than %d s" % MAX_DURATION_S)
+
+    symbols = synth.sample_bursts()
+    folder = tempfile.mkdtemp()
+    results = []
+    print("%7s %6s %8s %5s %8s %5s %8s %8s %7s %9s %9s %8s" % ("rate", "snr_db", "offset", "amp", "duration", "done",
+                                                               "audio/cpu", "audio/wall", "wait_s", "demod_s",
+                                                               "rss_mb", "recovery"))
+    try:
+        for sample_rate in options.sample_rates:
+            reference = reference_packets(sample_rate, symbols, folder)
+            if not any(reference):
+                logging.warning("no packets were decoded from the clean synthesis at %d Hz", sample_rate)
+            for duration_s in options.durations:
+                for snr_db in options.snr_db:
+                    for freq_offset_hz in options.freq_offset_hz:
+                        for amplitude in options.amplitude:
+                            config = {"sample_rate": sample_rate, "snr_db": snr_db, "freq_offset_hz": freq_offset_hz,
+                                      "amplitude": amplitude, "duration_s": duration_s}
+                            result = run(config, symbols, reference, options, folder)
+                            demod = result["stages"].get("demod")
+                            print("%7d %6.1f %8.1f %5.2f %8.1f %5d %8s %8.1f %7s %9s %9s %8s" % (
+                                sample_rate, snr_db, freq_offset_hz, amplitude, duration_s, result["done"],
+                                "%.1f" % result["audio_s_per_cpu_s"] if result["audio_s_per_cpu_s"] else "-",
+                                result["audio_s_per_wall_s"],
+                                "%.2f" % result["queue_wait"]["mean_s"] if result["queue_wait"] else "-",
+                                "%.2f" % demod["mean_s"] if demod else "-",
+                                "%.0f" % (result["peak_rss_kb"] / 1024.0) if result["peak_rss_kb"] else "-",
+                                "%.2f" % result["recovery_rate"] if result["recovery_rate"] is not None else "-"))
+                            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
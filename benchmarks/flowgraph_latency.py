@@ -0,0 +1,62 @@
+""" Measures demod job latency against clip length, comparing the previous fixed-period
+polling of the wav source with the EOF probe used by DecoderQueue.wait_for_flowgraph.
+
+usage: python -m benchmarks.flowgraph_latency [--lengths 1,2,5,10,20] [--runs 3] [--json out.json]
+"""
+import argparse
+import json
+import os
+import time
+
+from decoder import DecoderQueue
+from benchmarks.clips import make_clip
+
+LEGACY_POLL_PERIOD_S = 2
+LEGACY_MAX_RUNTIME_S = 20
+
+def wait_polling(tb, probe, nframes):
+    """ The completion check decode_worker used before the EOF probe: poll the wav
+    source's item count every LEGACY_POLL_PERIOD_S seconds (read here off the probe,
+    which sees every sample the source writes) """
+    start = time.time()
+    while probe.nitems_read(0) < nframes \
+        and (time.time() - start) < LEGACY_MAX_RUNTIME_S:
+        time.sleep(LEGACY_POLL_PERIOD_S)
+    return probe.nitems_read(0) >= nframes
+
+def time_demod(wavfilename, wait, runs):
+    latencies = []
+    packets = None
+    for _ in range(runs):
+        start = time.time()
+        packets = DecoderQueue.demod_wavfile(wavfilename, wait=wait)
+        latencies.append(time.time() - start)
+    return min(latencies), sum(latencies) / len(latencies), len(packets["corrected_packets"])
+
+def main():
+    parser = argparse.ArgumentParser(description="Demod job latency vs. clip length")
+    parser.add_argument("--lengths", default="1,2,5,10,20", help="comma-separated clip lengths in seconds")
+    parser.add_argument("--runs", type=int, default=3, help="runs per clip length and method")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    methods = [("polling", wait_polling), ("eof_probe", DecoderQueue.wait_for_flowgraph)]
+    results = []
+    print("%8s %10s %10s %10s %8s" % ("clip_s", "method", "min_s", "mean_s", "packets"))
+    for length in [float(l) for l in options.lengths.split(",")]:
+        wavfilename = make_clip(length)
+        try:
+            for name, wait in methods:
+                best, mean, npackets = time_demod(wavfilename, wait, options.runs)
+                print("%8.1f %10s %10.3f %10.3f %8d" % (length, name, best, mean, npackets))
+                results.append({"clip_s": length, "method": name, "min_s": best,
+                                "mean_s": mean, "corrected_packets": npackets})
+        finally:
+            os.remove(wavfilename)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+""" Measures the bytes a decode job reads and writes (through read/write system calls, as counted by
+pipeline.io_counters) and the time taken by each step of its audio handling, from the uploaded file
+to the input of the demodulator, for a synthetic pass uploaded as a 16-bit PCM wav file and as Ogg
+Vorbis (like a SatNOGS observation), sliced to all but its first and last SLICE_MARGIN_S.
+"copy" is the previous handling, which rewrote the file when converting (even a wav file) and slicing
+it, wrote each chunk to a file of its own (for long recordings) and read the file through libsndfile
+for every pass over it. "view" is the current handling: the file is converted at most once, and
+slices and chunks are spans of it whose samples are memory-mapped (which the counters don't include,
+as no bytes are copied; those passes only show up in the time taken). The demod step reads the
+demodulated frames of the converted file like the demodulator's file source does, the same way in both.
+
+usage: python -m benchmarks.job_io [--duration 480] [--json out.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy
+import soundfile as sf
+
+import audio_utils
+import bursts
+import chunking
+import pipeline
+from benchmarks.clips import make_clip, make_pass_clip
+
+SLICE_MARGIN_S = 10
+READ_BLOCK_BYTES = 65536
+
+def copy_score(wavfilename, window_s):
+    """ bursts.score_audiofile as it was, reading the file through libsndfile """
+    with sf.SoundFile(wavfilename) as infile:
+        sample_rate = infile.samplerate
+        window_frames = max(1, int(window_s * sample_rate))
+        blocksize = window_frames * max(1, audio_utils.AUDIO_BLOCK_FRAMES // window_frames)
+        ratios = []
+        for block in infile.blocks(blocksize=blocksize, dtype="float32", always_2d=True):
+            nwindows = len(block) // window_frames
+            if nwindows == 0:
+                break
+            windows = block[:nwindows * window_frames].mean(axis=1).reshape(nwindows, window_frames)
+            ratios.append(bursts.band_power_ratio(windows, sample_rate))
+    return numpy.concatenate(ratios), float(window_frames) / sample_rate
+
+def copy_steps(filename):
+    """ The steps of the previous handling, as (name, function) pairs run in order """
+    state = {}
+
+    def convert():
+        state["wav"] = audio_utils.wav_filename(filename)
+        with sf.SoundFile(filename) as infile:
+            state["sample_rate"] = infile.samplerate
+            audio_utils.copy_blocks(infile, state["wav"], "PCM_16")
+
+    def slice_():
+        sample_rate = state["sample_rate"]
+        nframes = audio_utils.slice_audiofile(state["wav"], SLICE_MARGIN_S * sample_rate, -SLICE_MARGIN_S * sample_rate)
+        state["duration"] = float(nframes) / sample_rate
+
+    def hash_():
+        digest = hashlib.sha1()
+        with sf.SoundFile(state["wav"]) as infile:
+            for block in infile.blocks(blocksize=audio_utils.AUDIO_BLOCK_FRAMES, dtype="int16"):
+                digest.update(block.tobytes())
+
+    def split():
+        if not chunking.should_split(state["duration"]):
+            return
+        score, window_s = copy_score(state["wav"], chunking.SCORE_WINDOW_S)
+        sample_rate = state["sample_rate"]
+        for i, (start_s, stop_s) in enumerate(chunking.plan_chunks(score, state["duration"], window_s)):
+            chunk_filename = "%s.chunk%d.wav" % (os.path.splitext(state["wav"])[0], i)
+            audio_utils.slice_audiofile(state["wav"], int(start_s * sample_rate), int(stop_s * sample_rate), chunk_filename)
+            os.remove(chunk_filename)
+
+    state["steps"] = [("convert", convert), ("slice", slice_), ("hash", hash_), ("split", split)]
+    return state
+
+def view_steps(filename):
+    """ The steps of the current handling, as (name, function) pairs run in order """
+    state = {}
+
+    def convert():
+        state["wav"], state["sample_rate"], _, _ = audio_utils.convert_audiofile(filename, "PCM_16")
+
+    def slice_():
+        sample_rate = state["sample_rate"]
+        nframes = audio_utils.probe_audiofile(state["wav"]).nframes
+        state["frames"] = audio_utils.frame_span(nframes, SLICE_MARGIN_S * sample_rate, -SLICE_MARGIN_S * sample_rate)
+        state["duration"] = float(state["frames"][1] - state["frames"][0]) / sample_rate
+
+    def hash_():
+        audio_utils.hash_audiofile(state["wav"], state["frames"])
+
+    def split():
+        if chunking.should_split(state["duration"]):
+            bursts.score_audiofile(state["wav"], chunking.SCORE_WINDOW_S, state["frames"])
+
+    state["steps"] = [("convert", convert), ("slice", slice_), ("hash", hash_), ("split", split)]
+    return state
+
+def read_demod_input(wavfilename, frames=None):
+    view = audio_utils.pcm_view(wavfilename, frames)
+    remaining = 2 * view.nframes * view.channels
+    with open(wavfilename, "rb") as f:
+        f.seek(view.data_offset + 2 * view.start_i * view.channels)
+        while remaining > 0:
+            block = f.read(min(READ_BLOCK_BYTES, remaining))
+            if len(block) == 0:
+                break
+            remaining -= len(block)
+
+def run(handling, input_name, clip, folder):
+    filename = os.path.join(folder, "upload" + os.path.splitext(clip)[1])
+    shutil.copyfile(clip, filename)
+    state = (copy_steps if handling == "copy" else view_steps)(filename)
+    steps = state["steps"] + [("demod", lambda: read_demod_input(state["wav"], state.get("frames")))]
+
+    results = []
+    for step, func in steps:
+        read_before, written_before = pipeline.io_counters()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        read_after, written_after = pipeline.io_counters()
+        results.append({
+            "input": input_name,
+            "handling": handling,
+            "step": step,
+            "read_mb": (read_after - read_before) / 1e6,
+            "written_mb": (written_after - written_before) / 1e6,
+            "time_s": elapsed,
+        })
+
+    for name in os.listdir(folder):
+        if name.startswith("upload"):
+            os.remove(os.path.join(folder, name))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes read and written per decode job, copying vs. viewing the audio")
+    parser.add_argument("--duration", type=float, default=480, help="length of the synthetic pass in seconds")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+    if pipeline.io_counters()[0] is None:
+        parser.error("needs %s to count bytes read and written" % pipeline.PROC_IO)
+
+    folder = tempfile.mkdtemp()
+    results = []
+    print("%6s %9s %8s %9s %11s %8s" % ("input", "handling", "step", "read_mb", "written_mb", "time_s"))
+    try:
+        wav = make_pass_clip(options.duration, folder=folder)
+        ogg = make_clip(options.duration, recording=wav, subtype=None, folder=folder, suffix=".ogg")
+        for input_name, clip in [("wav", wav), ("ogg", ogg)]:
+            for handling in ["copy", "view"]:
+                steps = run(handling, input_name, clip, folder)
+                steps.append({
+                    "input": input_name,
+                    "handling": handling,
+                    "step": "total",
+                    "read_mb": sum(s["read_mb"] for s in steps),
+                    "written_mb": sum(s["written_mb"] for s in steps),
+                    "time_s": sum(s["time_s"] for s in steps),
+                })
+                for result in steps:
+                    print("%(input)6s %(handling)9s %(step)8s %(read_mb)9.1f %(written_mb)11.1f %(time_s)8.2f" % result)
+                results.extend(steps)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+""" Measures result email delivery against a local stand-in SMTP server: sending each email from the
+decoder worker with yagmail.SMTP.send (which connects and logs in for every message) versus queueing
+it for the mail process (mailer.py). Reports how long the worker is blocked per email, how long
+delivery of all of them takes and how many SMTP connections were made. The stand-in can be made slow,
+and can fail every nth message with a 451 to exercise reconnecting and retries.
+
+usage: python -m benchmarks.mail_delivery [--emails 50] [--latency-ms 20] [--fail-every 0] [--json out.json]
+"""
+import argparse
+import asyncore
+import json
+import os
+import shutil
+import smtpd
+import tempfile
+import threading
+import time
+
+import yagmail
+import mailer
+from mailer import Mailer, MailOutbox
+
+SENDER = "decoder@example.com"
+RECIPIENT = "someone@example.com"
+DELIVERY_TIMEOUT_S = 120
+
+class StandinSMTPServer(smtpd.SMTPServer):
+    """ Accepts any mail, counting connections and messages """
+
+    def __init__(self, latency_s=0, fail_every=0):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.latency_s = latency_s
+        self.fail_every = fail_every
+        self.connections = 0
+        self.attempts = 0
+        self.received = 0
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        time.sleep(self.latency_s)
+        self.attempts += 1
+        if self.fail_every > 0 and self.attempts % self.fail_every == 0:
+            return "451 Temporary failure, try again later"
+        self.received += 1
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05})
+        thread.daemon = True
+        thread.start()
+
+def send_direct(server, emails):
+    """ The old way: a yagmail.SMTP created up front, and yag.send called for every email """
+    yag = yagmail.SMTP(SENDER, None, host="127.0.0.1", port=server.port, smtp_ssl=False,
+                       smtp_starttls=False, smtp_skip_login=True)
+    blocked = []
+    for i in range(emails):
+        start = time.time()
+        try:
+            yag.send(to=RECIPIENT, subject="Results #%d" % i, contents="packets")
+        except Exception:
+            pass
+        blocked.append(time.time() - start)
+    return blocked
+
+def send_queued(server, emails):
+    folder = tempfile.mkdtemp()
+    mail = Mailer(SENDER, None, host="127.0.0.1", port=server.port, ssl=False, starttls=False, skip_login=True,
+                  outbox=MailOutbox(os.path.join(folder, "mail.db")))
+    mail.start()
+    blocked = []
+    try:
+        for i in range(emails):
+            start = time.time()
+            mail.send(RECIPIENT, "Results #%d" % i, "packets")
+            blocked.append(time.time() - start)
+
+        deadline = time.time() + DELIVERY_TIMEOUT_S
+        while server.received < emails and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        mail.stop()
+        mail.proc.join()
+        shutil.rmtree(folder)
+    return blocked
+
+def main():
+    parser = argparse.ArgumentParser(description="Result email delivery against a local stand-in SMTP server")
+    parser.add_argument("--emails", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20, help="stand-in server delay per message")
+    parser.add_argument("--fail-every", type=int, default=0, help="fail every nth message with a 451 (0 for never)")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    mailer.RETRY_BASE_S = 0.1 # don't wait minutes for retries
+    mailer.QUEUE_EMPTY_POLL_PERIOD = 0.1
+
+    results = []
+    print("%8s %8s %16s %12s %10s %12s" % ("mode", "emails", "worker_block_ms", "delivery_s", "received", "connections"))
+    for mode in ["direct", "queued"]:
+        server = StandinSMTPServer(options.latency_ms / 1000.0, options.fail_every)
+        server.start()
+        start = time.time()
+        if mode == "direct":
+            blocked = send_direct(server, options.emails)
+        else:
+            blocked = send_queued(server, options.emails)
+        elapsed = time.time() - start
+        server.close()
+
+        result = {
+            "mode": mode,
+            "emails": options.emails,
+            "worker_block_ms": 1000 * sum(blocked) / len(blocked),
+            "delivery_s": elapsed,
+            "received": server.received,
+            "connections": server.connections,
+        }
+        print("%(mode)8s %(emails)8d %(worker_block_ms)16.2f %(delivery_s)12.3f %(received)10d %(connections)12d" % result)
+        results.append(result)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+""" NumPy approximation of the front half of the equisat_fm_demod flowgraph (gain, RRC matched filter
+with decimation and Mueller & Muller clock recovery), used by synth.py to recover the symbols of the
+sample recording's bursts. It isn't a decoder: its clock recovery interpolates with a cubic rather than
+GNU Radio's MMSE filter bank, so its symbols differ slightly from the flowgraph's. """
+import audio_utils
+import math
+import numpy
+
+# these mirror the variables and block parameters of equisat_fm_demod
+SYMBOL_RATE = 4800
+SYMBOL_DEPTH = 40
+DECIMATION = 2
+INPUT_GAIN = 10
+RRC_ALPHA = 0.2
+GAIN_MU = 0.050
+OMEGA_RELATIVE_LIMIT = 0.005
+INITIAL_MU = 0.5
+WAV_NORMALIZE = 32768.0
+
+def root_raised_cosine(gain, sampling_freq, symbol_rate, alpha, ntaps):
+    """ Port of firdes.root_raised_cosine, returning float32 taps """
+    ntaps |= 1 # odd number of taps
+    spb = float(sampling_freq) / symbol_rate
+    xindx = numpy.arange(ntaps, dtype=numpy.float64) - ntaps // 2
+    x1 = numpy.pi * xindx / spb
+    x2 = 4 * alpha * xindx / spb
+    x3 = x2 * x2 - 1
+
+    taps = numpy.empty(ntaps, dtype=numpy.float64)
+    regular = numpy.abs(x3) >= 0.000001
+    center = xindx == 0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        num = numpy.where(center,
+                          numpy.cos((1 + alpha) * x1) + (1 - alpha) * numpy.pi / (4 * alpha),
+                          numpy.cos((1 + alpha) * x1) + numpy.sin((1 - alpha) * x1) / (4 * alpha * xindx / spb))
+        den = x3 * numpy.pi
+        taps[regular] = 4 * alpha * num[regular] / den[regular]
+
+        # the singular points at +-spb/(4*alpha)
+        s = ~regular
+        sx1 = x1[s]
+        sxindx = xindx[s]
+        snum = numpy.sin((1 + alpha) * sx1) * (1 + alpha) * numpy.pi \
+               - numpy.cos((1 - alpha) * sx1) * ((1 - alpha) * numpy.pi * spb) / (4 * alpha * sxindx) \
+               + numpy.sin((1 - alpha) * sx1) * spb * spb / (4 * alpha * sxindx * sxindx)
+        sden = -32 * numpy.pi * alpha * alpha * alpha * sxindx / spb
+        taps[s] = -1 if alpha == 1 else 4 * alpha * snum / sden
+
+    return (taps * gain / taps.sum()).astype(numpy.float32)
+
+def fir_decimate(samples, taps, decimation):
+    """ Equivalent of fir_filter_fff(decimation, taps) over a whole buffer: the filter
+    history starts zeroed and output n is aligned with input n*decimation """
+    filtered = numpy.convolve(samples, taps)[:len(samples)]
+    return filtered[::decimation].astype(numpy.float32)
+
+def clock_recovery_mm(samples, omega, gain_omega, mu, gain_mu, omega_relative_limit):
+    """ Port of clock_recovery_mm_ff. The loop is inherently sequential, so it runs over a
+    plain list; the fractional sample interpolation uses a 4-point cubic between the samples
+    bracketing mu rather than GNU Radio's 8-tap MMSE table """
+    x = samples.tolist()
+    out = []
+    append = out.append
+
+    omega_mid = omega
+    omega_lim = omega_relative_limit * omega
+    last_sample = 0.0
+    ii = 0
+    ni = len(x) - 8 - 16 # same end margin as the block (interpolator taps + 16)
+    floor = math.floor
+    while ii < ni:
+        # cubic Lagrange interpolation between x[ii+3] and x[ii+4], matching the
+        # alignment of the MMSE interpolator's 8-sample window
+        xm1 = x[ii + 2]
+        x0 = x[ii + 3]
+        x1 = x[ii + 4]
+        x2 = x[ii + 5]
+        c1 = x1 - xm1 / 3.0 - x0 / 2.0 - x2 / 6.0
+        c2 = (xm1 + x1) / 2.0 - x0
+        c3 = (x2 - xm1) / 6.0 + (x0 - x1) / 2.0
+        sample = ((c3 * mu + c2) * mu + c1) * mu + x0
+        append(sample)
+
+        mm_val = (1.0 if last_sample >= 0 else -1.0) * sample - (1.0 if sample >= 0 else -1.0) * last_sample
+        last_sample = sample
+
+        omega = omega + gain_omega * mm_val
+        omega = omega_mid + max(-omega_lim, min(omega_lim, omega - omega_mid))
+        mu = mu + omega + gain_mu * mm_val
+
+        step = floor(mu)
+        ii += int(step)
+        mu -= step
+
+    return numpy.array(out, dtype=numpy.float32)
+
+def read_pcm(view):
+    """ Reads the first channel of a span of a 16-bit PCM wav file (an audio_utils.PcmView) as float32
+    normalized the same way as wavfile_source. Returns the samples and the sample rate """
+    return audio_utils.map_pcm(view)[:, 0].astype(numpy.float32) / WAV_NORMALIZE, view.sample_rate
+
+def demod_symbols(samples, sample_rate):
+    """ Runs the gain, RRC filter/decimation and clock recovery stages over a
+    buffer of audio samples and returns the recovered symbol stream """
+    taps = root_raised_cosine(1.0, sample_rate/DECIMATION, SYMBOL_RATE, RRC_ALPHA,
+                              int(SYMBOL_DEPTH*(sample_rate/DECIMATION/SYMBOL_RATE)))
+    filtered = fir_decimate(samples * INPUT_GAIN, taps, DECIMATION)
+    return clock_recovery_mm(filtered, (sample_rate/DECIMATION)/float(SYMBOL_RATE),
+                             0.25*GAIN_MU*GAIN_MU, INITIAL_MU, GAIN_MU, OMEGA_RELATIVE_LIMIT)
@@ -0,0 +1,101 @@
+""" Measures post-processing the packets stored by a finished demod flowgraph: the previous loop
+converting each message's PMTs element by element and hexlifying each payload separately, against
+the batch of packet_batch.py. The messages are built from the packets demodulated from the sample
+recording, repeated to the given numbers of packets per job, and both must give the same results.
+
+usage: python -m benchmarks.packet_postprocess [--packets 100 300 1000] [--runs 5] [--json out.json]
+"""
+import argparse
+import binascii
+import json
+import time
+import pmt
+from packetparse import packetparse
+
+import packet_batch
+from decoder import DecoderQueue
+from benchmarks.clips import SAMPLE_RECORDING
+
+def u8vector(hexstr):
+    data = bytearray(binascii.unhexlify(hexstr))
+    return pmt.init_u8vector(len(data), list(data))
+
+def make_messages(packets, count):
+    """ Returns count raw and count corrected packet messages, repeating the given packets dict's """
+    raw_key = pmt.intern("raw")
+    raw_messages = []
+    corrected_messages = []
+    for i in range(count):
+        packet = packets["corrected_packets"][i % len(packets["corrected_packets"])]
+        raw_messages.append(pmt.cons(pmt.make_dict(), u8vector(packet["raw"])))
+        meta = pmt.dict_add(pmt.make_dict(), raw_key, u8vector(packet["raw"]))
+        corrected_messages.append(pmt.cons(meta, u8vector(packet["corrected"])))
+    return raw_messages, corrected_messages
+
+def per_message(raw_messages, corrected_messages, parse_packet):
+    """ DecoderQueue.extract_packets as it was """
+    raw_packets = []
+    corrected_packets = []
+    for msg in raw_messages:
+        raw_packets.append(binascii.hexlify(bytearray(pmt.u8vector_elements(pmt.cdr(msg)))))
+    for msg in corrected_messages:
+        corrected = pmt.u8vector_elements(pmt.cdr(msg))
+        raw = pmt.u8vector_elements(pmt.dict_ref(pmt.car(msg), pmt.intern("raw"), pmt.get_PMT_NIL()))
+        decoded, decode_errs = parse_packet(binascii.hexlify(bytearray(corrected)))
+        corrected_packets.append({
+            "raw": binascii.hexlify(bytearray(raw)),
+            "corrected": binascii.hexlify(bytearray(corrected)),
+            "parsed": decoded,
+            "decode_errs": decode_errs
+        })
+    return {
+        "raw_packets": raw_packets,
+        "corrected_packets": corrected_packets,
+    }
+
+def time_method(method, raw_messages, corrected_messages, parse_packet, runs):
+    times = []
+    packets = None
+    for _ in range(runs):
+        start = time.time()
+        packets = method(raw_messages, corrected_messages, parse_packet)
+        times.append(time.time() - start)
+    return min(times), packets
+
+def main():
+    parser = argparse.ArgumentParser(description="Packet post-processing time, per message vs. batched")
+    parser.add_argument("--packets", type=int, nargs="+", default=[100, 300, 1000], help="packets per job")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    packets = DecoderQueue.demod_wavfile(SAMPLE_RECORDING)
+    if len(packets["corrected_packets"]) == 0:
+        parser.error("no packets were decoded from the sample recording")
+    no_parse = lambda hexstr: (None, [])
+
+    results = []
+    print("%8s %10s %14s %12s %8s %6s" % ("packets", "parse", "per_message_s", "batch_s", "speedup", "same"))
+    for count in options.packets:
+        raw_messages, corrected_messages = make_messages(packets, count)
+        for parse_name, parse_packet in [("none", no_parse), ("packetparse", packetparse.parse_packet)]:
+            old_s, old_packets = time_method(per_message, raw_messages, corrected_messages, parse_packet, options.runs)
+            new_s, new_packets = time_method(packet_batch.collect_packets, raw_messages, corrected_messages,
+                                             parse_packet, options.runs)
+            result = {
+                "packets": count,
+                "parse": parse_name,
+                "per_message_s": old_s,
+                "batch_s": new_s,
+                "speedup": old_s / new_s,
+                "same": old_packets == new_packets,
+            }
+            print("%(packets)8d %(parse)10s %(per_message_s)14.4f %(batch_s)12.4f %(speedup)8.2f %(same)6s" % result)
+            results.append(result)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+""" Measures packet submission throughput against a local mock of the packet API: the old approach of
+one requests.post (and so one new connection) per packet, versus queueing each job's packets in the
+outbox and sending them from it over a pooled session (publisher.py). The mock can add latency and
+fail a fraction of requests with 503s to exercise the retries.
+
+usage: python -m benchmarks.publish_throughput [--jobs 20] [--packets 5] [--latency-ms 5]
+                                               [--fail-rate 0.1] [--json out.json]
+"""
+import argparse
+import BaseHTTPServer
+import json
+import os
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+import publisher
+from publisher import Outbox, PacketPublisher
+
+class MockPacketAPI(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Accepts packet submissions, answering 200 for new packets and 201 for ones it has seen """
+    daemon_threads = True
+
+    def __init__(self, latency_s=0, fail_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), MockPacketAPIHandler)
+        self.latency_s = latency_s
+        self.fail_rate = fail_rate
+        self.received = set()
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def route(self):
+        return "http://127.0.0.1:%d/equisat/receive/raw" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class MockPacketAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    wbufsize = -1 # send each response in one write, or Nagle's algorithm stalls keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency_s)
+        with self.server.lock:
+            self.server.requests += 1
+            if random.random() < self.server.fail_rate:
+                status = 503
+            elif body["corrected"] in self.server.received:
+                status = 201
+            else:
+                self.server.received.add(body["corrected"])
+                status = 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def make_jobs(jobs, packets):
+    return [[{"raw": uuid.uuid4().hex, "corrected": uuid.uuid4().hex, "station_name": "bench",
+              "post_publicly": False, "source": "decoder.brownspace.org", "rx_time": 0}
+             for _ in range(packets)] for _ in range(jobs)]
+
+def submit_legacy(api, jobs):
+    """ One requests.post per packet, without retries (the old server.submit_packet) """
+    for payloads in jobs:
+        for payload in payloads:
+            jsn = dict(payload, secret="bench")
+            try:
+                requests.post(api.route, json=jsn)
+            except Exception:
+                pass
+
+def submit_outbox(api, jobs, folder):
+    outbox = Outbox(os.path.join(folder, "outbox.db"))
+    pub = PacketPublisher("bench", route=api.route, outbox=outbox)
+    for payloads in jobs:
+        pub.submit(uuid.uuid4().hex, "bench", payloads)
+
+    session = PacketPublisher.new_session()
+    while outbox.counts().get(publisher.PENDING, 0) > 0:
+        if PacketPublisher.drain(session, outbox, api.route, "bench") == 0:
+            time.sleep(publisher.RETRY_BASE_S / 10.0)
+    return outbox.counts()
+
+def main():
+    parser = argparse.ArgumentParser(description="Packet API submission throughput against a local mock")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--packets", type=int, default=5, help="packets per job")
+    parser.add_argument("--latency-ms", type=float, default=5, help="mock API latency per request")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="fraction of requests the mock fails with 503")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    publisher.RETRY_BASE_S = 0.05 # don't wait minutes for retries
+    folder = tempfile.mkdtemp()
+    results = []
+    print("%10s %10s %12s %10s %12s %10s" % ("mode", "packets", "packets/s", "requests", "connections", "accepted"))
+    try:
+        for mode in ["legacy", "outbox"]:
+            api = MockPacketAPI(options.latency_ms / 1000.0, options.fail_rate)
+            api.start()
+            jobs = make_jobs(options.jobs, options.packets)
+            start = time.time()
+            if mode == "legacy":
+                submit_legacy(api, jobs)
+            else:
+                submit_outbox(api, jobs, folder)
+            elapsed = time.time() - start
+            api.shutdown()
+
+            npackets = options.jobs * options.packets
+            result = {
+                "mode": mode,
+                "packets": npackets,
+                "packets_per_s": npackets / elapsed,
+                "requests": api.requests,
+                "connections": api.connections,
+                "accepted": len(api.received),
+            }
+            print("%(mode)10s %(packets)10d %(packets_per_s)12.1f %(requests)10d %(connections)12d %(accepted)10d" % result)
+            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
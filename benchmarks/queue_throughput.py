@@ -0,0 +1,112 @@
+""" Measures enqueue and claim throughput of the durable job queue (jobstore.JobStore, a SQLite
+database in WAL mode) against the in-memory multiprocessing.Queue it replaced, with several worker
+processes claiming concurrently. Each claimed job is also marked finished, as a worker would.
+
+usage: python -m benchmarks.queue_throughput [--jobs 2000] [--workers 4] [--json out.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import Queue
+import shutil
+import tempfile
+import time
+
+import jobstore
+import pipeline
+
+def noop_stage(job):
+    pass
+
+def on_finish(wavfilename, packets, args, err):
+    pass
+
+def make_job(i):
+    return pipeline.new_job("wav_uploads/upload%d.ogg" % i, on_finish, {
+        "email": "someone@example.com",
+        "rx_time": None,
+        "station_name": "station %d" % i,
+        "submit_to_db": True,
+        "post_publicly": False,
+        "satnogs": False,
+    }, [noop_stage, noop_stage])
+
+def claim_store(store, claimed):
+    while True:
+        job = store.claim(os.getpid())
+        if job is None:
+            return
+        store.finish(job["id"], jobstore.DONE, pipeline.empty_packets())
+        with claimed.get_lock():
+            claimed.value += 1
+
+def claim_queue(queue, claimed):
+    while True:
+        try:
+            queue.get(timeout=0.5)
+        except Queue.Empty:
+            return
+        with claimed.get_lock():
+            claimed.value += 1
+
+def run(mode, jobs, workers, folder):
+    if mode == "sqlite":
+        store = jobstore.JobStore(os.path.join(folder, "jobs.db"))
+        enqueue = lambda job: store.create(job, pipeline.stage_plan(job))
+        target, target_arg = claim_store, store
+    else:
+        queue = multiprocessing.Queue()
+        enqueue = queue.put
+        target, target_arg = claim_queue, queue
+
+    job_dicts = [make_job(i) for i in range(jobs)]
+    start = time.time()
+    for job in job_dicts:
+        enqueue(job)
+    enqueue_s = time.time() - start
+
+    claimed = multiprocessing.Value("i", 0)
+    procs = [multiprocessing.Process(target=target, args=(target_arg, claimed)) for _ in range(workers)]
+    start = time.time()
+    for proc in procs:
+        proc.start()
+    while claimed.value < jobs and any(proc.is_alive() for proc in procs):
+        time.sleep(0.001)
+    claim_s = time.time() - start
+    for proc in procs:
+        proc.join()
+
+    return {
+        "mode": mode,
+        "jobs": jobs,
+        "workers": workers,
+        "claimed": claimed.value,
+        "enqueue_per_s": jobs / enqueue_s,
+        "claim_per_s": claimed.value / claim_s,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Durable job queue enqueue/claim throughput")
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4, help="concurrently claiming processes")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    results = []
+    print("%8s %8s %8s %8s %14s %12s" % ("mode", "jobs", "workers", "claimed", "enqueue_per_s", "claim_per_s"))
+    try:
+        for mode in ["mp_queue", "sqlite"]:
+            result = run(mode, options.jobs, options.workers, folder)
+            print("%(mode)8s %(jobs)8d %(workers)8d %(claimed)8d %(enqueue_per_s)14.0f %(claim_per_s)12.0f" % result)
+            results.append(result)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
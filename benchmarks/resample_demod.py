@@ -0,0 +1,77 @@
+""" Measures demodulating uploads at various sample rates as they are versus resampled to
+decoder.WAVFILE_CONV_MAX_SAMPLE_RATE when converted (see resampler.py): the conversion time, the demod
+time per second of audio, and whether both decode the same packets. The uploads are synthetic
+recordings (see synth.py) written at each rate.
+
+usage: python -m benchmarks.resample_demod [--sample-rates 48000 96000 192000] [--duration 60] [--runs 3] [--json out.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import decoder
+from decoder import DecoderQueue
+from benchmarks import synth
+from benchmarks.clips import packet_bytes
+
+def measure(filename, max_sample_rate, runs):
+    upload = filename + ".upload.wav"
+    shutil.copyfile(filename, upload)
+    start = time.time()
+    wavfilename, sample_rate, duration, _ = DecoderQueue.convert_audiofile(upload, max_sample_rate=max_sample_rate)
+    convert_s = time.time() - start
+
+    times = []
+    packets = None
+    for _ in range(runs):
+        start = time.time()
+        packets = DecoderQueue.demod_wavfile(wavfilename)
+        times.append(time.time() - start)
+    os.remove(wavfilename)
+    return {
+        "demod_rate": sample_rate,
+        "convert_s": convert_s,
+        "demod_s_per_audio_s": min(times) / duration,
+        "corrected_packets": len(packets["corrected_packets"]),
+    }, packet_bytes(packets)
+
+def main():
+    parser = argparse.ArgumentParser(description="Demod time per audio second, at the upload's sample rate vs. resampled")
+    parser.add_argument("--sample-rates", type=int, nargs="+", default=[48000, 96000, 192000])
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    symbols = synth.sample_bursts()
+    results = []
+    print("%11s %10s %11s %10s %20s %10s %6s" % ("upload_rate", "handling", "demod_rate", "convert_s",
+                                                "demod_s_per_audio_s", "corrected", "same"))
+    try:
+        for sample_rate in options.sample_rates:
+            filename, _ = synth.make_recording(options.duration, sample_rate, symbols=symbols, folder=folder)
+            native, native_packets = measure(filename, None, options.runs)
+            resampled, resampled_packets = measure(filename, decoder.WAVFILE_CONV_MAX_SAMPLE_RATE, options.runs)
+            for handling, result in [("native", native), ("resampled", resampled)]:
+                result.update({
+                    "upload_rate": sample_rate,
+                    "handling": handling,
+                    "same": resampled_packets == native_packets,
+                })
+                print("%(upload_rate)11d %(handling)10s %(demod_rate)11d %(convert_s)10.2f %(demod_s_per_audio_s)20.4f "
+                      "%(corrected_packets)10d %(same)6s" % result)
+                results.append(result)
+            os.remove(filename)
+    finally:
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+""" Measures fetching SatNOGS observation metadata and audio through satnogs.SatnogsClient against the
+local stand-in site (benchmarks/satnogs_standin.py): a cold fetch of each observation, then repeated
+fetches of the same observations (e.g. for different time windows), which should be served from the
+caches without any requests reaching the site.
+
+usage: python -m benchmarks.satnogs_fetch [--observations 5] [--repeats 5] [--json out.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from satnogs import SatnogsClient
+from benchmarks.satnogs_standin import StandinServer
+
+def fetch(client, obs_id, folder):
+    obs_data = client.get_metadata(obs_id)
+    filename = os.path.join(folder, os.path.basename(obs_data["audio_url"]))
+    client.fetch_audio(obs_id, obs_data["audio_url"], filename)
+    os.remove(filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="SatNOGS fetch time and round trips, cold and cached")
+    parser.add_argument("--observations", type=int, default=5, help="distinct observations to fetch")
+    parser.add_argument("--repeats", type=int, default=5, help="cached fetches per observation")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    server = StandinServer()
+    server.start()
+    folder = tempfile.mkdtemp()
+    try:
+        client = SatnogsClient(server.base_url, cache_folder=os.path.join(folder, "cache"))
+        obs_ids = [str(1000001 + i) for i in range(options.observations)]
+
+        results = []
+        print("%8s %8s %12s %14s %14s" % ("mode", "fetches", "mean_s", "page_requests", "audio_requests"))
+        for mode, repeats in [("cold", 1), ("cached", options.repeats)]:
+            before = dict(server.requests)
+            times = []
+            for _ in range(repeats):
+                for obs_id in obs_ids:
+                    start = time.time()
+                    fetch(client, obs_id, folder)
+                    times.append(time.time() - start)
+            result = {
+                "mode": mode,
+                "fetches": len(times),
+                "mean_s": sum(times) / len(times),
+                "page_requests": server.requests["page"] - before["page"],
+                "audio_requests": server.requests["audio"] - before["audio"],
+            }
+            print("%(mode)8s %(fetches)8d %(mean_s)12.5f %(page_requests)14d %(audio_requests)14d" % result)
+            results.append(result)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
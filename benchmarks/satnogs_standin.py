@@ -0,0 +1,135 @@
+""" Local stand-in for the SatNOGS network website serving canned observation pages (laid out like the
+real ones, as far as satnogs.py is concerned) and a copy of the sample recording as their audio. It
+counts the requests it gets, so it can be used to check how many round trips the client makes.
+Point the server at it with satnogs_base_url = "http://localhost:8001" in config.py.
+
+usage: python -m benchmarks.satnogs_standin [--port 8001] [--audio file.ogg]
+"""
+import argparse
+import BaseHTTPServer
+import re
+import SocketServer
+import threading
+
+from benchmarks.clips import SAMPLE_RECORDING
+
+OBSERVATION_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>SatNOGS Network - Observation %(obs_id)s</title></head>
+<body>
+<div class="container">
+  <div class="row">
+    <div class="col-md-5">
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Satellite</span><span><a href="#">43817 - EQUiSat</a></span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Station</span><span><a href="/stations/291/">
+        291 - %(station_name)s
+      </a></span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Transmitter</span><span>Mode FSK4800</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Status</span><span class="label label-xs label-%(status)s">%(status_title)s</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Frequency</span><span>435.550 MHz</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Encoding</span><span>FM</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Pass</span><span>Rise 10 Max 45 Set 12</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Timeframe</span><span>
+        <span>%(start_date)s</span> <span>%(start_time)s</span>
+      </span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Client version</span><span>0.9</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Client metadata</span><span>-</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Rated</span><span>-</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Uploaded</span><span>-</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Waterfall</span><span>-</span></div>
+      <div class="front-line"><span class="label-title"><i class="icon"></i>Data</span><span>-</span></div>
+      <div class="front-line">%(audio_link)s</div>
+    </div>
+  </div>
+</div>
+</body>
+</html>
+"""
+
+AUDIO_LINK = """<a href="/media/data_obs/%(obs_id)s/satnogs_%(obs_id)s_%(start_date)sT%(start_time_dashed)s.ogg" target="_blank" download="">
+        <button type="button" class="btn btn-default btn-xs"><span class="glyphicon glyphicon-download"></span> Audio</button>
+      </a>"""
+
+def observation_page(obs_id, station_name="COSPAR 8049", status="good", start_date="2019-01-07",
+                     start_time="00:01:01", audio=True):
+    fields = {
+        "obs_id": obs_id,
+        "station_name": station_name,
+        "status": status,
+        "status_title": status.title(),
+        "start_date": start_date,
+        "start_time": start_time,
+        "start_time_dashed": start_time.replace(":", "-"),
+    }
+    fields["audio_link"] = AUDIO_LINK % fields if audio else "<span>-</span>"
+    return OBSERVATION_PAGE % fields
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves /observations/<id> pages and /media/data_obs/<id>/<file>.ogg audio. Observation IDs
+    ending in 0 are reported as missing (404), and ones ending in 9 as pending without audio """
+    daemon_threads = True
+
+    def __init__(self, port=0, audio_path=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), StandinHandler)
+        self.audio_path = audio_path or SAMPLE_RECORDING
+        self.requests = {"page": 0, "audio": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    wbufsize = -1 # send each response in one write, or Nagle's algorithm stalls keep-alive connections
+    protocol_version = "HTTP/1.1" # keep-alive, like the real site
+
+    def do_GET(self):
+        page_match = re.match(r"^/observations/(\d+)/?$", self.path)
+        audio_match = re.match(r"^/media/data_obs/(\d+)/[^/]+\.ogg$", self.path)
+        if page_match:
+            self.server.count("page")
+            obs_id = page_match.group(1)
+            if obs_id.endswith("0"):
+                self.respond(404, "text/html", "<html><body>Not found</body></html>")
+            elif obs_id.endswith("9"):
+                self.respond(200, "text/html", observation_page(obs_id, status="pending", audio=False))
+            else:
+                self.respond(200, "text/html", observation_page(obs_id))
+        elif audio_match:
+            self.server.count("audio")
+            with open(self.server.audio_path, "rb") as f:
+                self.respond(200, "audio/ogg", f.read())
+        else:
+            self.respond(404, "text/html", "<html><body>Not found</body></html>")
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the SatNOGS network website")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--audio", help="file served as every observation's audio (default: the sample recording)")
+    options = parser.parse_args()
+
+    server = StandinServer(options.port, options.audio)
+    print("Serving canned SatNOGS pages at %s" % server.base_url)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+""" Synthetic EQUiSat recordings: FM receiver audio with 4FSK bursts at 4800 baud of a given SNR,
+carrier frequency offset and amplitude, at any sample rate, spaced by receiver noise to any length.
+There's no packet encoder in this repo, so the bursts carry the symbols recovered from the bursts of
+the sample recording (by numpy_demod.py, sliced to the four 4FSK levels), re-modulated cleanly
+with RRC pulses; the packets to expect are the ones decoded from a clean synthesis (see end_to_end.py).
+"""
+import numpy
+import os
+import soundfile as sf
+import tempfile
+
+import audio_utils
+import bursts
+from benchmarks import numpy_demod
+from benchmarks.clips import SAMPLE_RECORDING
+
+SYMBOL_RATE = numpy_demod.SYMBOL_RATE
+LEVELS = numpy.array([-3, -1, 1, 3]) / 3.0 # of the four symbols, relative to the outermost
+SYNTH_OVERSAMPLE = 20 # samples per symbol the bursts are modulated at, before resampling
+RRC_SPAN_SYMBOLS = 8
+OUTER_DEVIATION_HZ = 2400 # assumed deviation of the outermost symbols, scaling a carrier offset to the DC it adds
+SLICER_ITERATIONS = 5
+BURST_PADDING_S = 0.05 # of the sample recording kept around each of its bursts (so they don't merge)
+NOISE_RMS = 0.5 # of the receiver noise between bursts (no carrier), relative to the outermost symbols
+SAMPLE_RATES = [8000, 44100, 48000, 96000]
+
+def slice_symbols(symbols, iterations=SLICER_ITERATIONS):
+    """ Returns the level (index into LEVELS) of each recovered symbol. The thresholds start out
+    assuming the levels are equally likely, then move halfway between the mean of each level's symbols """
+    center = numpy.median(symbols)
+    step = numpy.mean(numpy.abs(symbols - center)) / 2 # mean(|x|) of levels +-1 and +-3 is 2
+    thresholds = center + numpy.array([-2 * step, 0, 2 * step])
+    for _ in range(iterations):
+        levels = numpy.digitize(symbols, thresholds)
+        if numpy.any(numpy.bincount(levels, minlength=len(LEVELS)) == 0):
+            break
+        means = numpy.array([symbols[levels == i].mean() for i in range(len(LEVELS))])
+        thresholds = (means[:-1] + means[1:]) / 2
+    return numpy.digitize(symbols, thresholds)
+
+def sample_bursts(recording=SAMPLE_RECORDING):
+    """ Returns the levels of the symbols of each burst in the given 16-bit PCM wav file """
+    view = audio_utils.pcm_view(recording)
+    samples, sample_rate = numpy_demod.read_pcm(view)
+    ratio, window_s = bursts.score_audiofile(recording)
+    if ratio is None:
+        raise ValueError("%s's sample rate is too low to find its bursts" % recording)
+    spans = bursts.burst_spans(ratio, window_s, float(view.nframes) / sample_rate, padding_s=BURST_PADDING_S)
+    return [slice_symbols(numpy_demod.demod_symbols(samples[int(start_s * sample_rate):int(stop_s * sample_rate)], sample_rate))
+            for start_s, stop_s in spans]
+
+def modulate(levels, sample_rate):
+    """ Returns the baseband of the given symbol levels with RRC pulses at the given sample rate,
+    peaking at about +-1 """
+    fine_rate = SYMBOL_RATE * SYNTH_OVERSAMPLE
+    impulses = numpy.zeros(len(levels) * SYNTH_OVERSAMPLE)
+    impulses[::SYNTH_OVERSAMPLE] = LEVELS[levels]
+    taps = numpy_demod.root_raised_cosine(SYNTH_OVERSAMPLE, fine_rate, SYMBOL_RATE, numpy_demod.RRC_ALPHA,
+                                          RRC_SPAN_SYMBOLS * SYNTH_OVERSAMPLE)
+    fine = numpy.convolve(impulses, taps)
+    fine /= numpy.max(numpy.abs(fine))
+    # the baseband is far below either Nyquist frequency, so linear interpolation is enough
+    times = numpy.arange(int(len(fine) * float(sample_rate) / fine_rate)) / float(sample_rate)
+    return numpy.interp(times, numpy.arange(len(fine)) / float(fine_rate), fine)
+
+def make_recording(duration_s, sample_rate=48000, snr_db=20, freq_offset_hz=0, amplitude=0.5,
+                   burst_every_s=5, seed=0, symbols=None, folder=None):
+    """ Writes a temporary mono 16-bit PCM .wav file of the given duration with a burst every burst_every_s
+    (cycling through the sample recording's, or the given symbol levels of each burst), in the middle of
+    receiver noise. snr_db is the ratio of a burst's power to the noise added to it (over the whole band
+    up to the Nyquist frequency); freq_offset_hz is the carrier's, which offsets the bursts by a DC level;
+    amplitude is the peak of the outermost symbols relative to full scale. Returns its filename and the
+    number of bursts in it; the caller is responsible for removing it """
+    rng = numpy.random.RandomState(seed)
+    if symbols is None:
+        symbols = sample_bursts()
+    waveforms = [modulate(levels, sample_rate) for levels in symbols]
+    every = int(burst_every_s * sample_rate)
+    if any(len(w) > every for w in waveforms):
+        raise ValueError("bursts are longer than burst_every_s=%s" % burst_every_s)
+    offset = float(freq_offset_hz) / OUTER_DEVIATION_HZ
+
+    fd, filename = tempfile.mkstemp(suffix=".wav", dir=folder)
+    os.close(fd)
+    nframes = int(duration_s * sample_rate)
+    nbursts = 0
+    with sf.SoundFile(filename, "w", samplerate=sample_rate, channels=1, subtype="PCM_16") as f:
+        for start in range(0, nframes, every):
+            period = rng.normal(0, NOISE_RMS, min(every, nframes - start))
+            waveform = waveforms[nbursts % len(waveforms)]
+            lead = (every - len(waveform)) // 2
+            if lead + len(waveform) <= len(period):
+                noise_rms = numpy.sqrt(numpy.mean(numpy.square(waveform)) / 10 ** (snr_db / 10.0))
+                period[lead:lead + len(waveform)] = waveform + offset + rng.normal(0, noise_rms, len(waveform))
+                nbursts += 1
+            f.write(numpy.clip(period * amplitude, -1, 1 - 1.0 / 32768))
+    return filename, nbursts
@@ -0,0 +1,69 @@
+""" Measures steady-state per-job overhead of rebuilding the demod flowgraph for every job versus
+reusing this process' warm flowgraph (decoder.REUSE_FLOWGRAPHS / demod_pool.py). A very short
+clip isolates the fixed cost of a job; a full-length one shows it next to the DSP time. It also checks
+that a warm flowgraph, last run over a recording cut off partway through a burst, decodes each clip
+the same as a flowgraph built for it (reading it with its wavfile_source, as without REUSE_FLOWGRAPHS).
+
+usage: python -m benchmarks.warm_pool [--lengths 0.1,5.7] [--jobs 20] [--json out.json]
+"""
+import argparse
+import json
+import os
+import time
+
+from decoder import DecoderQueue
+from benchmarks.clips import make_clip, packet_bytes
+
+CUTOFF_S = 2.1 # partway through a burst of the sample recording
+
+def time_jobs(wavfilename, reuse, jobs):
+    """ Returns the per-job times for jobs runs, excluding a first warm-up run """
+    DecoderQueue.demod_wavfile(wavfilename, reuse=reuse)
+    times = []
+    for _ in range(jobs):
+        start = time.time()
+        DecoderQueue.demod_wavfile(wavfilename, reuse=reuse)
+        times.append(time.time() - start)
+    return sorted(times)
+
+def same_after_other_file(wavfilename, cutoff_s):
+    """ Returns whether a warm run over the given clip, straight after one over the first cutoff_s
+    seconds of the sample recording, decodes the same packets as a cold run over it """
+    cold = packet_bytes(DecoderQueue.demod_wavfile(wavfilename, reuse=False))
+    other = make_clip(cutoff_s)
+    try:
+        DecoderQueue.demod_wavfile(other, reuse=True)
+    finally:
+        os.remove(other)
+    return packet_bytes(DecoderQueue.demod_wavfile(wavfilename, reuse=True)) == cold
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-job overhead with and without warm flowgraphs")
+    parser.add_argument("--lengths", default="0.1,5.7", help="comma-separated clip lengths in seconds")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs per clip length and mode")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    options = parser.parse_args()
+
+    results = []
+    print("%8s %8s %10s %10s %10s %6s" % ("clip_s", "mode", "median_s", "p90_s", "mean_s", "same"))
+    for length in [float(l) for l in options.lengths.split(",")]:
+        wavfilename = make_clip(length)
+        try:
+            same = same_after_other_file(wavfilename, CUTOFF_S)
+            for mode, reuse in [("rebuild", False), ("warm", True)]:
+                times = time_jobs(wavfilename, reuse, options.jobs)
+                median = times[len(times) // 2]
+                p90 = times[int(len(times) * 0.9)]
+                mean = sum(times) / len(times)
+                print("%8.1f %8s %10.4f %10.4f %10.4f %6s" % (length, mode, median, p90, mean, same))
+                results.append({"clip_s": length, "mode": mode, "median_s": median,
+                                "p90_s": p90, "mean_s": mean, "same_after_other_file": same})
+        finally:
+            os.remove(wavfilename)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
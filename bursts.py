@@ -0,0 +1,58 @@
+""" Fast pre-detection of EQUiSat transmissions in FM receiver audio, so long recordings can be
+split into chunks away from any burst (see chunking.py). Without a carrier the receiver's audio is
+loud broadband noise; while EQUiSat is transmitting, the noise is quieted and the power is
+concentrated in the 4FSK baseband. So each short window of the recording is scored by the ratio of its power in the 4FSK band to that in a band above it, which
+takes one FFT per window over the whole recording (computed a block of windows at a time). """
+import audio_utils
+import numpy
+
+WINDOW_S = 0.05
+SIGNAL_BAND_HZ = (100, 3000)
+NOISE_BAND_HZ = (6000, 12000) # cut short by the Nyquist frequency at lower sample rates
+MIN_NOISE_BAND_HZ = 1000 # narrower noise bands (sample rates below 14 kHz) aren't reliable
+BURST_RATIO = 6 # noise alone scores around 1-2, bursts in the tens to hundreds
+MIN_POWER = 1e-6 # mean square; quieter windows (e.g. squelched audio) are never bursts
+
+def has_noise_band(sample_rate):
+    return min(NOISE_BAND_HZ[1], sample_rate / 2.0) - NOISE_BAND_HZ[0] >= MIN_NOISE_BAND_HZ
+
+def band_power_ratio(windows, sample_rate):
+    """ Returns the ratio of signal band to noise band power for each row of windows, a 2D array of
+    samples, with windows below MIN_POWER scoring 0 """
+    nframes = windows.shape[1]
+    spectrum = numpy.abs(numpy.fft.rfft(windows * numpy.hanning(nframes).astype(numpy.float32), axis=1)) ** 2
+    freqs = numpy.fft.rfftfreq(nframes, 1.0 / sample_rate)
+    signal = spectrum[:, (freqs >= SIGNAL_BAND_HZ[0]) & (freqs < SIGNAL_BAND_HZ[1])].sum(axis=1)
+    noise = spectrum[:, (freqs >= NOISE_BAND_HZ[0]) & (freqs < NOISE_BAND_HZ[1])].sum(axis=1)
+
+    ratio = signal / numpy.maximum(noise, numpy.finfo(numpy.float32).tiny)
+    ratio[numpy.mean(numpy.square(windows), axis=1) < MIN_POWER] = 0
+    return ratio
+
+def score_audiofile(filename, window_s=WINDOW_S, frames=None):
+    """ Returns the band power ratio of each consecutive window of about window_s of the given 16-bit PCM
+    wav file (only its frames [start_i, stop_i) if frames is given) and the actual window length,
+    or (None, None) if its sample rate is too low to score it """
+    sample_rate = audio_utils.pcm_view(filename, frames).sample_rate
+    if not has_noise_band(sample_rate):
+        return None, None
+
+    window_frames = max(1, int(window_s * sample_rate))
+    ratios = [band_power_ratio(windows, sample_rate) for windows in audio_utils.read_windows(filename, window_frames, frames)]
+    ratio = numpy.concatenate(ratios) if len(ratios) > 0 else numpy.zeros(0)
+    return ratio, float(window_frames) / sample_rate
+
+def burst_spans(ratio, window_s, duration, threshold=BURST_RATIO, padding_s=0):
+    """ Returns the (start_s, stop_s) of the parts of a recording with bursts in them, given its
+    window scores (see score_audiofile), padded by padding_s and merged where they overlap """
+    active = numpy.concatenate([[False], ratio >= threshold, [False]])
+    edges = numpy.flatnonzero(numpy.diff(active.astype(numpy.int8)))
+    spans = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        start_s = max(0.0, start * window_s - padding_s)
+        stop_s = min(duration, stop * window_s + padding_s)
+        if len(spans) > 0 and start_s <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], stop_s)
+        else:
+            spans.append((start_s, stop_s))
+    return spans
@@ -0,0 +1,71 @@
+""" Splitting of long recordings into overlapping chunks which are demodulated in parallel as
+separate jobs (see pipeline.split_job), and merging of their results. Chunks are cut at the point
+near each chunk boundary least likely to be in an EQUiSat burst (by the burst score of bursts.py).
+Each chunk also runs CHUNK_OVERLAP_S into the next one, longer than a transmission, so a packet
+cut by a boundary is still decoded whole from the chunk it starts in. The packets a chunk decodes
+from its overlap with the previous one are counted by also demodulating the overlap on its own (see
+pipeline.demod_job), so those decoded from both sides of an overlap can be dropped when merging
+while packets repeated elsewhere in the recording are kept, as they are when it isn't split. """
+import numpy
+
+CHUNK_S = 60
+CHUNK_OVERLAP_S = 6
+SPLIT_SEARCH_S = 10 # how far from the nominal boundary to look for a point outside any burst
+MIN_SPLIT_DURATION_S = 2*CHUNK_S # shorter recordings are demodulated whole
+SCORE_WINDOW_S = 0.25
+
+def should_split(duration):
+    return duration is not None and duration >= MIN_SPLIT_DURATION_S
+
+def plan_chunks(score, duration, window_s=SCORE_WINDOW_S, chunk_s=CHUNK_S, overlap_s=CHUNK_OVERLAP_S,
+                search_s=SPLIT_SEARCH_S):
+    """ Returns the (start_s, stop_s) of the chunks to split a recording of the given duration into,
+    given its burst score in consecutive windows of window_s (see bursts.score_audiofile), which may
+    be empty to split at the nominal boundaries """
+    boundaries = [0.0]
+    # no chunk shorter than half the nominal length, which would mostly be overhead
+    while duration - boundaries[-1] >= chunk_s * 1.5:
+        target = boundaries[-1] + chunk_s
+        first = int(max(boundaries[-1] + chunk_s / 2.0, target - search_s) / window_s)
+        last = int(min(duration - chunk_s / 2.0, target + search_s) / window_s)
+        if last > first and last <= len(score):
+            least = first + int(numpy.argmin(score[first:last]))
+            boundaries.append((least + 0.5) * window_s)
+        else:
+            boundaries.append(target)
+
+    stops = boundaries[1:] + [duration]
+    return [(start, min(duration, stop + overlap_s)) for start, stop in zip(boundaries, stops)]
+
+def merge_packets(chunk_packets):
+    """ Merges the packets dicts of a recording's chunks (in order, with None for those which failed).
+    A chunk's first packets, as many as it decoded from its overlap with the previous chunk alone (its
+    "head" counts), are dropped if the previous chunk also decoded them among as many of its last """
+    merged = {
+        "raw_packets": [],
+        "corrected_packets": [],
+    }
+    previous = None
+    for packets in chunk_packets:
+        if packets is not None:
+            head_raw, head_corrected = packets.get("head", (0, 0)) if previous is not None else (0, 0)
+            merged["raw_packets"] += drop_overlap(packets["raw_packets"], head_raw,
+                                                  previous["raw_packets"] if previous is not None else [])
+            merged["corrected_packets"] += drop_overlap(packets["corrected_packets"], head_corrected,
+                                                        previous["corrected_packets"] if previous is not None else [],
+                                                        lambda packet: packet["corrected"])
+        previous = packets
+    if any(packets is None or packets.get("incomplete") for packets in chunk_packets):
+        merged["incomplete"] = True
+    return merged
+
+def drop_overlap(packets, nhead, previous, key=lambda packet: packet):
+    """ Returns packets without those of its first nhead which are also among the last nhead of previous """
+    tail = [key(packet) for packet in previous[max(0, len(previous) - nhead):]] if nhead > 0 else []
+    kept = []
+    for i, packet in enumerate(packets):
+        if i < nhead and key(packet) in tail:
+            tail.remove(key(packet))
+        else:
+            kept.append(packet)
+    return kept
@@ -0,0 +1,27 @@
+from gnuradio import gr
+import numpy
+import threading
+
+class eof_probe(gr.sync_block):
+    """ Sink block which signals an event once it has consumed a given number of items.
+    Tapped onto the output of a flowgraph's source block, it lets callers block until the
+    source has been drained instead of polling its item counters. """
+
+    def __init__(self, nitems):
+        gr.sync_block.__init__(self, name="eof_probe", in_sig=[numpy.float32], out_sig=None)
+        self.nitems = nitems
+        self.done = threading.Event()
+        if nitems <= 0:
+            self.done.set()
+
+    def work(self, input_items, output_items):
+        ninput = len(input_items[0])
+        if self.nitems_read(0) + ninput >= self.nitems:
+            self.done.set()
+        return ninput
+
+    def wait(self, timeout=None):
+        """ Blocks until the target number of items has been consumed or timeout seconds pass.
+        Returns whether the target was reached """
+        self.done.wait(timeout)
+        return self.done.is_set()
@@ -1,4 +1,19 @@
 decoder_enabled = False
 gmail_user = "john.brown@gmail.com"
 gmail_pass = "mypasscode"
-api_key = "myapikey"
\ No newline at end of file
+api_key = "myapikey"
+# submitter_secret = "a long random string" # keys the hashes of submitters' emails in the job store (api_key by default)
+# satnogs_base_url = "https://network.satnogs.org"
+# smtp_host = "smtp.gmail.com"
+# smtp_port = 465
+# smtp_ssl = True
+# smtp_starttls = None
+# smtp_skip_login = False
+# min_decoder_workers = 1
+# max_decoder_workers = 4
+# max_queued_audio_s = 1920
+# max_backlog_audio_s = 24000
+# client_audio_s_per_hour = 1920
+# client_burst_audio_s = 1920
+# batch_token = "a long random string"
+# batch_parallelism = 4
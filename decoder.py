@@ -1,74 +1,137 @@
 import multiprocessing
 import Queue # for Queue.Empty
+from completion_probe import eof_probe
 from equisat_fm_demod import equisat_fm_demod
+import demod_pool
 from packetparse import packetparse
-import binascii
-import pmt
-import soundfile as sf
+import packet_batch
+import audio_utils
+import pipeline
+import jobstore
+import metrics
+from supervisor import DecoderSupervisor, WorkerState
+import os
 import sys
 import time
 import logging
 
 QUEUE_EMPTY_POLL_PERIOD = 2
-FLOWGRAPH_POLL_PERIOD_S = 2
-MAX_FLOWGRAPH_RUNTIME   = 20
+FLOWGRAPH_SETTLE_POLL_S = 0.02
+FLOWGRAPH_SETTLE_POLLS  = 3
+FLOWGRAPH_SETTLE_TIMEOUT_S = 10 # for the blocks downstream of a drained source to stop moving
+JOB_TIMEOUT_S = 180 # wall-clock limit for a whole job, enforced by killing its worker (see supervisor.py)
+MAX_JOB_ATTEMPTS = 2 # runs of a job whose worker died or timed out before it's failed
 WAVFILE_CONV_SUBTYPE = "PCM_16"
+WAVFILE_CONV_MAX_SAMPLE_RATE = 48000 # uploads above it are resampled to it, and all mixed to mono (see resampler.py)
+DEMOD_VERSION = 1 # bump when a demod change should invalidate cached results
+# keep a warm flowgraph per sample rate in each worker, reading spans of the wav file straight out of it
+# (see demod_pool.py). Off until its packets have been checked against the wavfile_source path under
+# GNU Radio (see benchmarks/warm_pool.py); without it, each job builds a flowgraph reading a whole file
+REUSE_FLOWGRAPHS = False
+SPLIT_LONG_RECORDINGS = True # demodulate chunks of long recordings in parallel (see chunking.py)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 class DecoderQueue:
-    def __init__(self, in_logger=None):
+    def __init__(self, in_logger=None, store=None, cache=None):
+        # jobs are queued in the job store (so they survive restarts); this queue only
+        # carries job IDs to wake up idle workers when a job is submitted
         self.queue = multiprocessing.Queue()
-        self.procs = []
+        self.workers = [] # WorkerStates, managed by the supervisor
+        self.supervisor = None
         self.stopping = multiprocessing.Value("b", False)
+        self.store = store if store is not None else jobstore.JobStore()
+        self.cache = cache # optional result_cache.ResultCache to skip demodulating known audio
         if in_logger:
             global logger
             logger = in_logger
 
-    def start(self, num):
-        """ Spawns a new set of num processes which reads requests off the decode queue and performs them """
-        for i in range(num):
-            proc = multiprocessing.Process(target=self.decode_worker, args=(self.queue, self.stopping))
-            proc.start()
-            self.procs.append(proc)
+    def start(self, min_workers, max_workers=None):
+        """ Starts min_workers processes which read requests off the decode queue and perform them,
+        and a supervisor which adds more (up to max_workers, or as many as the cores allow if None)
+        as jobs queue up (see supervisor.py). Jobs interrupted by the last shutdown are requeued first """
+        self.recover()
+        self.supervisor = DecoderSupervisor(self, min_workers, max_workers, JOB_TIMEOUT_S, logger)
+        self.supervisor.start()
+
+    def spawn_worker(self):
+        """ Starts a new worker process and returns its WorkerState """
+        worker = WorkerState()
+        worker.proc = multiprocessing.Process(target=self.decode_worker,
+                                              args=(self.queue, self.stopping, worker, self.store, self.cache))
+        worker.proc.start()
+        self.workers.append(worker)
+        return worker
+
+    def queue_stats(self):
+        """ Returns the number of jobs waiting for a worker and how long the oldest has waited (s) """
+        return self.store.queue_stats()
 
     def stop(self):
         self.stopping.value = True
 
-    def submit(self, wavfilename, onfinish, args):
-        """ Submits an FM decode job (wavfilename) to the decoder queue.
+    def submit(self, wavfilename, onfinish, args, stages=None, duration=None):
+        """ Submits an FM decode job (wavfilename) to the decoder queue and returns its job ID.
+        stages is a list of ingest stages run by the worker before demodulation (see pipeline.py);
+        they may produce or replace wavfilename. duration is the (estimated) length of the audio
+        in seconds, if known, which the scheduler uses to run shorter clips first (see scheduler.py).
         The onfinish callback receives wavfilename, a dict containing raw_packets and corrected_packets lists,
         the passed in args, and any error message (or None otherwise) """
-        self.queue.put_nowait({
-            "wavfilename": str(wavfilename),
-            "onfinish": onfinish,
-            "args": args
-        })
+        job = pipeline.new_job(wavfilename, onfinish, args, stages, duration)
+        self.store.create(job, pipeline.stage_plan(job))
+        self.queue.put_nowait(job["id"])
+        return job["id"]
+
+    def recover(self):
+        """ Requeues (or fails) the jobs which were running when the decoder was last stopped """
+        for job_id in self.store.running_jobs():
+            self.lost_job(job_id, "was restarted")
+        self.store.requeue_finished_splits()
+
+    def lost_worker(self, worker_pid, reason):
+        """ Called by the supervisor when a worker process has exited, to recover any job it had claimed """
+        for job_id in self.store.running_jobs(worker_pid):
+            self.lost_job(job_id, reason)
+
+    def lost_job(self, job_id, reason):
+        """ Called when the worker running the given job died or was killed. Requeues the job
+        (it resumes after its last finished stage), or fails it through its onfinish after MAX_JOB_ATTEMPTS """
+        job, state, attempts = self.store.load(job_id)
+        if job is None or state in jobstore.FINISHED_STATES:
+            return # finished just before its worker died
+
+        attempts += 1
+        if attempts < MAX_JOB_ATTEMPTS:
+            logger.warning("[%s] Worker %s; requeueing job (attempt %d)" % (job_id, reason, attempts + 1))
+            self.store.requeue(job_id, attempts)
+            self.queue.put_nowait(job_id)
+        else:
+            pipeline.fail_job(job, "Decoder failure",
+                              "The decoder %s while processing your submission (%d attempts). " \
+                              "This is likely a bug with our software, or a problem with the audio file." % (reason, attempts),
+                              self.store, logger, self.queue)
 
     @staticmethod
     def get_audio_info(filename):
-        data, sample_rate = sf.read(filename)
-        nframes = len(data)
-        duration = nframes  / sample_rate
-        return sample_rate, duration, nframes
+        return audio_utils.get_audio_info(filename)
 
     @staticmethod
-    def convert_audiofile(filename, subtype=WAVFILE_CONV_SUBTYPE):
-        """ Converts the given file to a .wav file with the given subtype"""
+    def probe_audiofile(filename):
+        """ Reads the sample rate, number of frames, channels, subtype and duration of the given
+        audio file from its header only (see audio_utils.AudioInfo), or returns None if it can't be read """
         try:
-            data, sample_rate = sf.read(filename)
-            doti = filename.rfind(".")
-            if doti == -1:
-                wavfilename = filename + ".wav"
-            else:
-                wavfilename = filename[:doti] + ".wav"
+            return audio_utils.probe_audiofile(filename)
 
-            sf.write(wavfilename, data, sample_rate, subtype=subtype)
+        except RuntimeError as ex: # soundfile error
+            logger.warning("Error probing audio file '%s': %s", filename, ex)
+            return None
 
-            nframes = len(data)
-            duration = nframes / sample_rate
-            return wavfilename, sample_rate, duration, nframes
+    @staticmethod
+    def convert_audiofile(filename, subtype=WAVFILE_CONV_SUBTYPE, max_sample_rate=WAVFILE_CONV_MAX_SAMPLE_RATE):
+        """ Converts the given file to a mono .wav file with the given subtype, at no more than max_sample_rate """
+        try:
+            return audio_utils.convert_audiofile(filename, subtype, max_sample_rate)
 
         except RuntimeError as ex: # soundfile error
             logger.error("Error converting audio file '%s' to wav", filename)
@@ -76,107 +139,155 @@ class DecoderQueue:
             return None, 0, 0, 0
 
     @staticmethod
-    def slice_audiofile(filename, start_s, stop_s, sample_rate):
-        """ Slices the given audio file from start_s seconds to end_s seconds
-        and overwrites the file. If start_s or end_s are negative,
-        they reference from the end of the file.
-        Returns whether the process was successful and the new duration """
-        if start_s is None:
-            start_i = 0
-        else:
-            start_i = start_s * sample_rate
+    def wait_for_flowgraph(tb, probe, nframes):
+        """ Blocks until the flowgraph's wav source has been drained (signalled by the EOF probe)
+        and the downstream blocks have flushed their remaining samples and messages.
+        There's no timeout on draining the source; a flowgraph that never drains it gets its worker
+        killed by the supervisor once the job exceeds JOB_TIMEOUT_S. Returns whether the downstream
+        blocks settled within FLOWGRAPH_SETTLE_TIMEOUT_S """
+        probe.wait()
 
-        if stop_s is None:
-            stop_i = None
-        else:
-            stop_i = stop_s * sample_rate
+        # the source is drained, but the blocks downstream of it may still hold buffered
+        # samples (and the decoders pending messages), so wait until nothing moves
+        deadline = time.time() + FLOWGRAPH_SETTLE_TIMEOUT_S
+        last_counts = None
+        stable_polls = 0
+        while stable_polls < FLOWGRAPH_SETTLE_POLLS:
+            if time.time() >= deadline:
+                return False
+            counts = (tb.equisat_decoder_equisat_4fsk_preamble_detect_0.nitems_read(0),
+                      tb.message_store_block_raw.num_messages(),
+                      tb.message_store_block_corrected.num_messages())
+            stable_polls = stable_polls + 1 if counts == last_counts else 0
+            last_counts = counts
+            time.sleep(FLOWGRAPH_SETTLE_POLL_S)
+        return True
 
-        try:
-            data, _ = sf.read(filename, start=start_i, stop=stop_i)
-            sf.write(filename, data, sample_rate)
-            duration = len(data) / sample_rate
-            return True, duration
+    @staticmethod
+    def demod_params():
+        """ Identifies the demodulator configuration, for keying cached results """
+        return "gnuradio:%d" % DEMOD_VERSION
 
-        except RuntimeError as ex: # soundfile error
-            logger.error("Error slicing audio file '%s'", filename)
-            logger.exception(ex)
-            return False, 0
+    @staticmethod
+    def run_flowgraph(tb, source, nframes, wait=None, name=""):
+        """ Runs the given demod or symbol decode flowgraph until the given source block
+        (nframes long) has been drained and then tears it down. Returns whether it finished
+        before its wait function gave up """
+        if wait is None:
+            wait = DecoderQueue.wait_for_flowgraph
+
+        # tap the source to find out as soon as it hits EOF
+        # (GNU Radio has a bug such that flowgraphs with Python message passing blocks won't terminate)
+        # (see https://github.com/gnuradio/gnuradio/pull/797, https://www.ruby-forum.com/t/run-to-completion-not-working-with-message-passing-blocks/240759)
+        probe = eof_probe(nframes)
+        tb.connect((source, 0), (probe, 0))
+
+        logger.debug("[%s] Starting demod flowgraph" % name)
+        tb.start()
+        finished = wait(tb, probe, nframes)
+        if not finished:
+            metrics.flowgraph_timeouts.inc()
+            logger.warn("[%s] Flowgraph timed out (%d/%d frames)" % \
+                (name, source.nitems_written(0), nframes))
+
+        logger.debug("[%s] Stopping demod flowgraph" % name)
+        tb.stop()
+        tb.wait()
+        tb.disconnect((source, 0), (probe, 0))
+        logger.debug("[%s] Demod flowgraph terminated" % name)
+        return finished
+
+    @staticmethod
+    def extract_packets(tb):
+        """ Returns a dict containing the raw_packets and corrected_packets lists
+        collected by the message stores of a finished flowgraph """
+        # we have a block to store both all valid raw packets and one to store
+        # all those that passed error correction (which includes the corresponding raw)
+        raw_store = tb.message_store_block_raw
+        corrected_store = tb.message_store_block_corrected
+        with metrics.packet_postprocess_duration.time():
+            return packet_batch.collect_packets([raw_store.get_message(i) for i in range(raw_store.num_messages())],
+                                                [corrected_store.get_message(i) for i in range(corrected_store.num_messages())],
+                                                packetparse.parse_packet)
 
     @staticmethod
-    def decode_worker(dec_queue, stopping):
+    def demod_wavfile(wavfilename, wait=None, reuse=None, frames=None):
+        """ Demodulates the given 16-bit PCM wav file, or only its frames [start_i, stop_i) if frames is given,
+        and returns a dict containing the raw_packets and corrected_packets lists. wait is the function used
+        to block until the flowgraph has finished (wait_for_flowgraph by default); reuse selects whether
+        to use this process' warm flowgraph (REUSE_FLOWGRAPHS by default) """
+        return DecoderQueue.demod_pcm(audio_utils.pcm_view(wavfilename, frames), wait, reuse)
+
+    @staticmethod
+    def demod_pcm(view, wait=None, reuse=None):
+        """ Demodulates the given audio_utils.PcmView, which a warm flowgraph reads straight out of its
+        file, and a new one (without reuse) with its wavfile_source (see demod_wavfile for the other
+        arguments). The packets dict is marked incomplete if the flowgraph timed out """
+        if reuse is None:
+            reuse = REUSE_FLOWGRAPHS
+
+        if reuse:
+            demod = demod_pool.get_demodulator(view)
+            tb = demod.tb
+            try:
+                with metrics.flowgraph_duration.time():
+                    finished = DecoderQueue.run_flowgraph(tb, demod.source, view.nframes, wait, view.filename)
+            except Exception:
+                demod_pool.discard_demodulator(view.sample_rate)
+                raise
+        else:
+            # the flowgraph's wavfile_source can only read whole files, so a span of one is copied out first
+            wavfilename = view.filename
+            if view.start_i != 0 or view.nframes != audio_utils.pcm_view(view.filename).nframes:
+                wavfilename = "%s.span%d-%d.wav" % (os.path.splitext(view.filename)[0], view.start_i, view.start_i + view.nframes)
+                audio_utils.slice_audiofile(view.filename, view.start_i, view.start_i + view.nframes, wavfilename)
+            try:
+                tb = equisat_fm_demod(sample_rate=view.sample_rate, wavfile=wavfilename)
+                with metrics.flowgraph_duration.time():
+                    finished = DecoderQueue.run_flowgraph(tb, tb.blocks_wavfile_source_0, view.nframes, wait, view.filename)
+            finally:
+                if wavfilename != view.filename and os.path.exists(wavfilename):
+                    os.remove(wavfilename)
+
+        packets = DecoderQueue.extract_packets(tb)
+        if not finished:
+            packets["incomplete"] = True # so it isn't cached
+        return packets
+
+    @staticmethod
+    def decode_worker(dec_queue, stopping, worker, store, cache):
         try:
-            while not stopping.value:
+            while not stopping.value and not worker.retiring.value:
                 try:
-                    # block until next demod is in
-                    next_demod = dec_queue.get(timeout=QUEUE_EMPTY_POLL_PERIOD)
+                    next_demod = store.claim(os.getpid())
+                    if next_demod is None:
+                        # block until a job is submitted (or check for the stopped condition after the timeout)
+                        dec_queue.get(timeout=QUEUE_EMPTY_POLL_PERIOD)
+                        continue
                 except Queue.Empty:
-                    # check for stopped condition if queue empty after timeout
                     continue
                 except KeyboardInterrupt:
                     return
 
+                logger.debug("[%s] scheduled on worker %d: %s", next_demod["id"], os.getpid(), next_demod["schedule_reason"])
+                metrics.queue_wait.observe(next_demod["queue_wait_s"])
+                worker.job_id.value = next_demod["id"]
+                worker.job_started.value = time.time()
+                worker.busy.value = True
                 try:
-                    wavfilename = next_demod["wavfilename"]
-                    sample_rate, duration, nframes = DecoderQueue.get_audio_info(wavfilename)
-
-                    # spawn the GNU radio flowgraph and run it
-                    tb = equisat_fm_demod(wavfile=wavfilename, sample_rate=sample_rate)
-                    logger.debug("[%s] Starting demod flowgraph" % wavfilename)
-                    tb.start()
-                    # run until the wav source block has completed
-                    # (GNU Radio has a bug such that flowgraphs with Python message passing blocks won't terminate)
-                    # (see https://github.com/gnuradio/gnuradio/pull/797, https://www.ruby-forum.com/t/run-to-completion-not-working-with-message-passing-blocks/240759)
-                    start = time.time()
-                    while tb.blocks_wavfile_source_0.nitems_written(0) < nframes \
-                        and (time.time() - start) < MAX_FLOWGRAPH_RUNTIME:
-                        time.sleep(FLOWGRAPH_POLL_PERIOD_S)
-                    
-                    if tb.blocks_wavfile_source_0.nitems_written(0) < nframes:
-                        logger.warn("[%s] Flowgraph timed out (%d/%d frames)" % \
-                            (wavfilename, tb.blocks_wavfile_source_0.nitems_written(0), nframes))
-                            
-                    logger.debug("[%s] Stopping demod flowgraph" % wavfilename)
-                    tb.stop()
-                    tb.wait()
-                    logger.debug("[%s] Demod flowgraph terminated" % wavfilename)
-
-                    # we have a block to store both all valid raw packets and one to store
-                    # all those that passed error correction (which includes the corresponding raw)
-                    raw_packets = []
-                    corrected_packets = []
-
-                    for i in range(tb.message_store_block_raw.num_messages()):
-                        msg = tb.message_store_block_raw.get_message(i)
-                        raw_packets.append(binascii.hexlify(bytearray(pmt.u8vector_elements(pmt.cdr(msg)))))
-
-                    for i in range(tb.message_store_block_corrected.num_messages()):
-                        msg = tb.message_store_block_corrected.get_message(i)
-                        corrected = pmt.u8vector_elements(pmt.cdr(msg))
-                        raw = pmt.u8vector_elements(pmt.dict_ref(pmt.car(msg), pmt.intern("raw"), pmt.get_PMT_NIL()))
-                        decoded, decode_errs = packetparse.parse_packet(binascii.hexlify(bytearray(corrected)))
-                        corrected_packets.append({
-                            "raw": binascii.hexlify(bytearray(raw)),
-                            "corrected": binascii.hexlify(bytearray(corrected)),
-                            "parsed": decoded,
-                            "decode_errs": decode_errs
-                        })
-
-                    onfinish = next_demod["onfinish"]
-                    onfinish(wavfilename, {
-                        "raw_packets": raw_packets,
-                        "corrected_packets": corrected_packets,
-                    }, next_demod["args"], None)
-
+                    # fetch/convert/slice etc., demodulate and report the results
+                    pipeline.run_job(next_demod, DecoderQueue.demod_wavfile, store, logger,
+                                     cache, DecoderQueue.demod_params(), SPLIT_LONG_RECORDINGS, dec_queue)
                 except KeyboardInterrupt:
                     return
                 except Exception as ex:
-                    logger.error("Exception in decoder worker, skipping job")
+                    logger.error("Exception while finishing job, skipping")
                     logger.exception(ex)
-                    onfinish = next_demod["onfinish"]
-                    onfinish(next_demod["wavfilename"], {
-                        "raw_packets": [],
-                        "corrected_packets": [],
-                    }, next_demod["args"], ex.message)
+                finally:
+                    worker.busy.value = False
+                    worker.job_id.value = ""
+                    worker.last_active.value = time.time()
+                    metrics.worker_busy.inc(worker.last_active.value - worker.job_started.value)
 
         finally:
             print("Stopping decoder worker")
@@ -190,7 +301,7 @@ if __name__ == "__main__":
         exit(1)
 
     dec = DecoderQueue()
-    dec.start(1)
+    dec.start(1, 1)
     dec.submit(sys.argv[1], onfinish_cli, None)
     time.sleep(5)
     dec.stop()
@@ -0,0 +1,104 @@
+""" Per-process pool of equisat_fm_demod flowgraphs which are kept warm between jobs instead of being
+rebuilt for every file. Each decoder worker process gets its own pool (it's created lazily after fork).
+The flowgraphs read their samples straight out of a span of a wav file (an audio_utils.PcmView), so
+slices and chunks of a recording don't have to be written out to files of their own first. """
+from collections import OrderedDict
+from equisat_fm_demod import equisat_fm_demod
+from gnuradio import blocks, gr
+import equisat_decoder
+
+MAX_WARM_DEMODULATORS = 4 # per worker process, keyed by sample rate
+SYMBOL_RATE = 4800 # as in equisat_fm_demod
+
+_demodulators = OrderedDict()
+
+def pcm_source(view):
+    """ Returns the chain of blocks streaming the first channel of the given PcmView out of its file,
+    as float samples normalized the same way as wavfile_source's """
+    source = blocks.file_source(gr.sizeof_short, view.filename, False)
+    source.seek(view.data_offset // 2 + view.start_i * view.channels, 0) # in samples, from the start of the file
+    chain = [source, blocks.head(gr.sizeof_short, view.nframes * view.channels)]
+    if view.channels > 1:
+        chain.append(blocks.keep_m_in_n(gr.sizeof_short, 1, view.channels, 0))
+    chain.append(blocks.short_to_float(1, 32768.0))
+    return chain
+
+class WarmDemodulator:
+    """ An equisat_fm_demod flowgraph for one sample rate which can be rerun over any number of wav file
+    spans by swapping its source, and rebuilding its symbol-domain blocks, between runs """
+
+    def __init__(self, view):
+        self.sample_rate = view.sample_rate
+        self.tb = equisat_fm_demod(sample_rate=view.sample_rate, wavfile=view.filename)
+        # the flowgraph's own wavfile_source can only read whole files, so it's swapped out on the first load
+        self.chain = [self.tb.blocks_wavfile_source_0]
+        self.runs = 0
+
+    @property
+    def source(self):
+        """ The block the demodulator's samples come out of """
+        return self.chain[-1]
+
+    def load(self, view):
+        """ Resets the flowgraph state left over from the previous run and points it at a new PcmView.
+        Must only be called while the flowgraph is stopped """
+        tb = self.tb
+        # the previous source is at EOF (and possibly for another file), so swap in a new one
+        tb.disconnect(*(self.chain + [tb.blocks_multiply_const_vxx_0_0]))
+        self.chain = pcm_source(view)
+        tb.connect(*(self.chain + [tb.blocks_multiply_const_vxx_0_0]))
+
+        if self.runs > 0:
+            # the preamble detector and decoders may hold a partial burst (and pending messages) from the end
+            # of the previous run, and the message stores its packets, so replace them all (they're cheap to build)
+            self.rebuild_symbol_blocks()
+
+            # restart clock recovery from its initial timing estimate
+            # (stream buffers, and with them the filter history, are reallocated when the flowgraph restarts)
+            tb.digital_clock_recovery_mm_xx_0.set_omega((self.sample_rate/tb.decimation)/float(SYMBOL_RATE))
+            tb.digital_clock_recovery_mm_xx_0.set_mu(0.5)
+
+        self.runs += 1
+        return tb
+
+    def rebuild_symbol_blocks(self):
+        """ Replaces the symbol-domain blocks of the flowgraph (preamble detection, block decode, FEC and
+        the message stores) with new ones, as in equisat_fm_demod """
+        tb = self.tb
+        tb.disconnect((tb.digital_clock_recovery_mm_xx_0, 0), (tb.equisat_decoder_equisat_4fsk_preamble_detect_0, 0))
+        for src, dst in self.message_links(tb):
+            tb.msg_disconnect(src, dst)
+
+        tb.message_store_block_raw = blocks.message_debug()
+        tb.message_store_block_corrected = blocks.message_debug()
+        tb.equisat_decoder_equisat_fec_decoder_0 = equisat_decoder.equisat_fec_decoder()
+        tb.equisat_decoder_equisat_4fsk_preamble_detect_0 = equisat_decoder.equisat_4fsk_preamble_detect(255,0.33, 40)
+        tb.equisat_decoder_equisat_4fsk_block_decode_0 = equisat_decoder.equisat_4fsk_block_decode(255, False)
+
+        for src, dst in self.message_links(tb):
+            tb.msg_connect(src, dst)
+        tb.connect((tb.digital_clock_recovery_mm_xx_0, 0), (tb.equisat_decoder_equisat_4fsk_preamble_detect_0, 0))
+
+    @staticmethod
+    def message_links(tb):
+        return [((tb.equisat_decoder_equisat_4fsk_block_decode_0, 'out'), (tb.equisat_decoder_equisat_fec_decoder_0, 'in')),
+                ((tb.equisat_decoder_equisat_4fsk_block_decode_0, 'out'), (tb.message_store_block_raw, 'store')),
+                ((tb.equisat_decoder_equisat_4fsk_preamble_detect_0, 'out'), (tb.equisat_decoder_equisat_4fsk_block_decode_0, 'in')),
+                ((tb.equisat_decoder_equisat_fec_decoder_0, 'out'), (tb.message_store_block_corrected, 'store'))]
+
+def get_demodulator(view):
+    """ Returns this process' warm demodulator for the sample rate of the given PcmView, loaded with it,
+    creating it (and evicting the least recently used one) if necessary """
+    demod = _demodulators.pop(view.sample_rate, None)
+    if demod is None:
+        demod = WarmDemodulator(view)
+        if len(_demodulators) >= MAX_WARM_DEMODULATORS:
+            _demodulators.popitem(last=False)
+    demod.load(view)
+    _demodulators[view.sample_rate] = demod
+    return demod
+
+def discard_demodulator(sample_rate):
+    """ Drops this process' warm demodulator for the given sample rate, e.g. after
+    a failed run left it in an unknown state """
+    _demodulators.pop(sample_rate, None)
@@ -0,0 +1,116 @@
+""" Size-bounded on-disk key/value cache with least-recently-used eviction. Values are stored as
+files in the cache folder and indexed (with their size and last access time, plus hit/miss
+counters) in a SQLite database alongside them, so one cache can be shared between processes. """
+import hashlib
+import os
+import shutil
+import sqlite_util
+import tempfile
+import time
+
+INDEX_DB = "index.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0);
+INSERT OR IGNORE INTO stats (name, value) VALUES ('misses', 0);
+INSERT OR IGNORE INTO stats (name, value) VALUES ('evictions', 0);
+"""
+
+class DiskCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.db = sqlite_util.LocalConnection(os.path.join(folder, INDEX_DB), SCHEMA)
+
+    def _conn(self):
+        return self.db.get()
+
+    def _path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def _count(self, name):
+        self._conn().execute("UPDATE stats SET value = value + 1 WHERE name = ?", (name,))
+
+    def get_file(self, key):
+        """ Returns the path of the file cached under key (marking it as recently used),
+        or None on a miss. The file may be evicted by another process at any point,
+        so callers should copy or open it right away """
+        conn = self._conn()
+        row = conn.execute("SELECT filename FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.exists(self._path(row[0])):
+            self._count("misses")
+            return None
+
+        conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._count("hits")
+        return self._path(row[0])
+
+    def get(self, key):
+        """ Returns the bytes cached under key, or None on a miss """
+        path = self.get_file(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except IOError: # evicted in the meantime
+            return None
+
+    def put_file(self, key, src_path, move=False):
+        """ Caches a copy of the file at src_path (or the file itself if move is set) under key """
+        filename = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        conn = self._conn()
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".part")
+        os.close(fd)
+        if move:
+            shutil.move(src_path, tmp_path)
+        else:
+            shutil.copyfile(src_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self._path(filename))
+
+        conn.execute("INSERT OR REPLACE INTO entries (key, filename, size, last_access) VALUES (?, ?, ?, ?)",
+                     (key, filename, size, time.time()))
+        self.evict()
+
+    def put(self, key, data):
+        """ Caches the given bytes under key """
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        self.put_file(key, tmp_path, move=True)
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits in max_bytes """
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            row = conn.execute("SELECT key, filename, size FROM entries ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            key, filename, size = row
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if os.path.exists(self._path(filename)):
+                os.remove(self._path(filename))
+            self._count("evictions")
+            total -= size
+
+    def stats(self):
+        """ Returns the hit/miss/eviction counters and current size of the cache """
+        conn = self._conn()
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"], stats["bytes"] = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return stats
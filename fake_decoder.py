@@ -1,76 +1,51 @@
-import soundfile as sf
+import audio_utils
+import pipeline
 import logging
 
 WAVFILE_CONV_SUBTYPE = "PCM_16"
+WAVFILE_CONV_MAX_SAMPLE_RATE = 48000
 
 class DecoderQueue:
-    def __init__(self):
-        pass
+    def __init__(self, in_logger=None, store=None, cache=None):
+        self.store = store
+        self.cache = cache
 
-    def start(self, num):
+    def start(self, min_workers, max_workers=None):
         pass
 
     def stop(self):
         pass
 
-    def submit(self, wavfilename, onfinish, args):
-        onfinish(wavfilename, {
-            "raw_packets": [],
-            "corrected_packets": [],
-        }, args)
+    def submit(self, wavfilename, onfinish, args, stages=None, duration=None):
+        job = pipeline.new_job(wavfilename, onfinish, args, stages, duration)
+        if self.store is not None:
+            self.store.create(job, pipeline.stage_plan(job))
+        pipeline.run_job(job, lambda wavfilename, frames=None: pipeline.empty_packets(), self.store,
+                         cache=self.cache, demod_params="fake")
+        return job["id"]
 
     @staticmethod
     def get_audio_info(filename):
-        data, sample_rate = sf.read(filename)
-        nframes = len(data)
-        duration = nframes / sample_rate
-        return sample_rate, duration, nframes
+        return audio_utils.get_audio_info(filename)
 
     @staticmethod
-    def convert_audiofile(filename, subtype=WAVFILE_CONV_SUBTYPE):
-        """ Converts the given file to a .wav file with the given subtype"""
+    def probe_audiofile(filename):
+        """ Reads the sample rate, number of frames, channels, subtype and duration of the given
+        audio file from its header only (see audio_utils.AudioInfo), or returns None if it can't be read """
         try:
-            data, sample_rate = sf.read(filename)
-            doti = filename.rfind(".")
-            if doti == -1:
-                wavfilename = filename + ".wav"
-            else:
-                wavfilename = filename[:doti] + ".wav"
-
-            sf.write(wavfilename, data, sample_rate, subtype=subtype)
-
-            nframes = len(data)
-            duration = nframes / sample_rate
-            return wavfilename, sample_rate, duration, nframes
+            return audio_utils.probe_audiofile(filename)
 
         except RuntimeError as ex:  # soundfile error
-            logging.error("Error converting audio file '%s' to wav", filename)
-            logging.exception(ex)
-            return None, 0, 0, 0
+            logging.warning("Error probing audio file '%s': %s", filename, ex)
+            return None
 
     @staticmethod
-    def slice_audiofile(filename, start_s, stop_s, sample_rate):
-        """ Slices the given audio file from start_s seconds to end_s seconds
-        and overwrites the file. If start_s or end_s are negative,
-        they reference from the end of the file.
-        Returns whether the process was successful and the new duration """
-        if start_s is None:
-            start_i = 0
-        else:
-            start_i = start_s * sample_rate
-
-        if stop_s is None:
-            stop_i = None
-        else:
-            stop_i = stop_s * sample_rate
-
+    def convert_audiofile(filename, subtype=WAVFILE_CONV_SUBTYPE, max_sample_rate=WAVFILE_CONV_MAX_SAMPLE_RATE):
+        """ Converts the given file to a mono .wav file with the given subtype, at no more than max_sample_rate """
         try:
-            data, _ = sf.read(filename, start=start_i, stop=stop_i)
-            sf.write(filename, data, sample_rate)
-            duration = len(data) / sample_rate
-            return True, duration
+            return audio_utils.convert_audiofile(filename, subtype, max_sample_rate)
 
         except RuntimeError as ex:  # soundfile error
-            logging.error("Error slicing audio file '%s'", filename)
+            logging.error("Error converting audio file '%s' to wav", filename)
             logging.exception(ex)
-            return False, 0
\ No newline at end of file
+            return None, 0, 0, 0
\ No newline at end of file
@@ -0,0 +1,506 @@
+""" SQLite-backed record of decode jobs: their state, per-stage timing and results. It's shared by
+the server and the decoder worker processes; each process opens its own connection on first use.
+It's also the decoder's job queue: jobs are stored with a pickled copy of the job dict (see
+pipeline.new_job), which workers claim atomically, so queued and interrupted jobs survive restarts.
+Which queued job a worker claims is decided by scheduler.pick_job. """
+import json
+import os
+import pickle
+import scheduler
+import sqlite_util
+import sqlite3
+import time
+
+JOBS_DB = "data/jobs.db"
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+REJECTED = "rejected" # by an ingest stage (see pipeline.StageError)
+FAILED = "failed"
+SPLIT = "split" # waiting for its chunks to be demodulated (see pipeline.split_job)
+FINISHED_STATES = (DONE, REJECTED, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    station_name TEXT,
+    satnogs INTEGER,
+    obs_id TEXT,
+    stage_plan TEXT,
+    current_stage TEXT,
+    submitted REAL NOT NULL,
+    updated REAL NOT NULL,
+    finished REAL,
+    error_title TEXT,
+    error TEXT,
+    result TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    payload BLOB,
+    claimed_by INTEGER,
+    submitter TEXT,
+    duration REAL,
+    claimed REAL,
+    schedule_reason TEXT,
+    parent_id TEXT,
+    chunk_index INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_state_submitted ON jobs (state, submitted);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    read_bytes INTEGER,
+    written_bytes INTEGER,
+    PRIMARY KEY (job_id, stage)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    args TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created REAL NOT NULL,
+    reported REAL
+);
+CREATE TABLE IF NOT EXISTS batch_observations (
+    batch_id TEXT NOT NULL,
+    obs_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    job_id TEXT,
+    queued REAL,
+    finished REAL,
+    result TEXT,
+    PRIMARY KEY (batch_id, obs_id)
+);
+"""
+# columns added to the jobs table since it was first created, as (name, definition),
+# which databases created before then need to have added
+ADDED_COLUMNS = [
+    ("attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("payload", "BLOB"),
+    ("claimed_by", "INTEGER"),
+    ("submitter", "TEXT"),
+    ("duration", "REAL"),
+    ("claimed", "REAL"),
+    ("schedule_reason", "TEXT"),
+    ("parent_id", "TEXT"),
+    ("chunk_index", "INTEGER"),
+]
+# likewise for the stages table
+ADDED_STAGE_COLUMNS = [
+    ("read_bytes", "INTEGER"),
+    ("written_bytes", "INTEGER"),
+]
+# indexes on added columns, created once the columns exist
+ADDED_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS jobs_claimed ON jobs (claimed, submitter, duration)",
+    "CREATE INDEX IF NOT EXISTS jobs_state_submitter ON jobs (state, submitter, duration, submitted)",
+    "CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id, chunk_index)",
+    "CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished, parent_id, duration)",
+]
+
+SCHEMA_VERSION = 1 # PRAGMA user_version; 1: submitters hashed (see scheduler.submitter_key)
+
+def migrate(conn):
+    """ Adds the columns and indexes added since a jobs database was created, and hashes the
+    submitters of jobs recorded before they were """
+    for table, added_columns in [("jobs", ADDED_COLUMNS), ("stages", ADDED_STAGE_COLUMNS)]:
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+        for name, definition in added_columns:
+            if name not in columns:
+                try:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, definition))
+                except sqlite3.OperationalError: # added by another process in the meantime
+                    pass
+    for statement in ADDED_INDEXES:
+        conn.execute(statement)
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        conn.create_function("hash_submitter", 1, scheduler.hash_submitter)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # checked again in the transaction, so only one process hashes them
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                conn.execute("UPDATE jobs SET submitter = hash_submitter(submitter) WHERE submitter IS NOT NULL")
+            conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+class JobStore:
+    def __init__(self, path=JOBS_DB):
+        self.db = sqlite_util.LocalConnection(path, SCHEMA, migrate)
+
+    def _conn(self):
+        return self.db.get()
+
+    def create(self, job, plan):
+        """ Records a newly submitted job (see pipeline.new_job) as queued,
+        along with the names of the stages it will go through """
+        self._insert(self._conn(), job, plan)
+
+    @staticmethod
+    def _insert(conn, job, plan):
+        now = time.time()
+        args = job["args"] or {}
+        conn.execute(
+            "INSERT INTO jobs (id, state, station_name, satnogs, obs_id, stage_plan, submitted, updated, payload, "
+            "submitter, duration, parent_id, chunk_index) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job["id"], QUEUED, args.get("station_name"), int(bool(args.get("satnogs"))), args.get("obs_id"),
+             json.dumps(plan), now, now, sqlite3.Binary(pickle.dumps(job, 2)),
+             scheduler.submitter_key(args), job.get("duration"), job.get("parent_id"), job.get("chunk_index")))
+
+    def split(self, job, chunks, plan):
+        """ Queues the given chunk jobs (with the given stage plan) of a running job, which is saved
+        and left waiting in the SPLIT state until they've all finished (see chunk_finished) """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for chunk in chunks:
+                self._insert(conn, chunk, plan)
+            conn.execute("UPDATE jobs SET state = ?, claimed_by = NULL, payload = ?, updated = ? WHERE id = ?",
+                         (SPLIT, sqlite3.Binary(pickle.dumps(job, 2)), time.time(), job["id"]))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def chunk_finished(self, parent_id, worker_pid=None):
+        """ Called after a chunk of the given job has finished. If it was the last one to, the job is claimed
+        for the given worker process to merge the chunks' results (or queued again if there's none),
+        and True is returned """
+        return self._resume_splits(RUNNING if worker_pid is not None else QUEUED, worker_pid, parent_id) > 0
+
+    def requeue_finished_splits(self):
+        """ Queues the split jobs whose chunks have all finished, e.g. if the server stopped before the
+        last chunk's worker could merge them. Returns the number of jobs queued """
+        return self._resume_splits(QUEUED)
+
+    def _resume_splits(self, state, worker_pid=None, job_id=None):
+        query = "UPDATE jobs SET state = ?, claimed_by = ?, updated = ? WHERE state = ? AND NOT EXISTS " \
+                "(SELECT 1 FROM jobs AS chunk WHERE chunk.parent_id = jobs.id AND chunk.state NOT IN (?, ?, ?))"
+        params = (state, worker_pid, time.time(), SPLIT) + FINISHED_STATES
+        if job_id is not None:
+            query += " AND id = ?"
+            params += (job_id,)
+        return self._conn().execute(query, params).rowcount
+
+    def chunk_results(self, parent_id):
+        """ Returns the state, packets dict and error of each chunk of the given job, in order """
+        rows = self._conn().execute("SELECT state, result, error FROM jobs WHERE parent_id = ? ORDER BY chunk_index",
+                                    (parent_id,))
+        return [(row["state"], json.loads(row["result"]) if row["result"] else None, row["error"]) for row in rows]
+
+    def checkpoint(self, job):
+        """ Saves the job dict, e.g. after a stage has updated it, so it resumes from there if it's rerun
+        (along with its duration, once a stage has measured it) """
+        self._conn().execute("UPDATE jobs SET payload = ?, duration = COALESCE(?, duration), updated = ? WHERE id = ?",
+                             (sqlite3.Binary(pickle.dumps(job, 2)), job.get("duration"), time.time(), job["id"]))
+
+    def claim(self, worker_pid):
+        """ Takes the queued job chosen by the scheduler (see scheduler.pick_job) for the given worker
+        process, atomically with respect to other workers. Returns the job dict (with its attempts count,
+        the reason it was chosen as "schedule_reason" and how long it was queued as "queue_wait_s"),
+        or None if there's none """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM jobs WHERE state = ? LIMIT 1", (QUEUED,)).fetchone() is None:
+            return None # don't take the write lock just to find nothing
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            oldest = conn.execute("SELECT id, submitter, duration, submitted FROM jobs WHERE state = ? "
+                                  "ORDER BY submitted LIMIT 1", (QUEUED,)).fetchone()
+            queued = dict(conn.execute("SELECT submitter, COUNT(*) FROM jobs WHERE state = ? GROUP BY submitter",
+                                       (QUEUED,)).fetchall())
+            # each submitter's shortest (then oldest) job, with unknown durations last
+            heads = [tuple(conn.execute("SELECT id, submitter, duration, submitted FROM jobs WHERE state = ? AND "
+                                        "submitter IS ? ORDER BY duration IS NULL, duration, submitted LIMIT 1",
+                                        (QUEUED, submitter)).fetchone()) for submitter in queued]
+            running = dict(conn.execute("SELECT submitter, COUNT(*) FROM jobs WHERE state = ? GROUP BY submitter",
+                                        (RUNNING,)).fetchall())
+            served = dict(conn.execute("SELECT submitter, SUM(COALESCE(duration, ?)) FROM jobs WHERE claimed >= ? "
+                                       "GROUP BY submitter", (scheduler.UNKNOWN_DURATION_S,
+                                                              now - scheduler.FAIRNESS_WINDOW_S)).fetchall())
+            oldest = tuple(oldest) if oldest is not None else None
+            job_id, reason = scheduler.pick_job(oldest, heads, queued, running, served, now)
+            row = None
+            if job_id is not None:
+                conn.execute("UPDATE jobs SET state = ?, claimed_by = ?, claimed = ?, schedule_reason = ?, updated = ? "
+                             "WHERE id = ?", (RUNNING, worker_pid, now, reason, now, job_id))
+                row = conn.execute("SELECT payload, attempts, submitted FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        job = pickle.loads(bytes(row["payload"]))
+        job["attempts"] = row["attempts"]
+        job["schedule_reason"] = reason
+        job["queue_wait_s"] = now - row["submitted"]
+        return job
+
+    def load(self, job_id):
+        """ Returns the stored job dict, state and attempts count of the given job, or Nones if
+        there's no such job (or it has finished, as the job dict is dropped then) """
+        row = self._conn().execute("SELECT payload, state, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["payload"] is None:
+            return None, None, None
+        return pickle.loads(bytes(row["payload"])), row["state"], row["attempts"]
+
+    def running_jobs(self, worker_pid=None):
+        """ Returns the IDs of the jobs claimed by a worker (or the given worker) which haven't finished """
+        if worker_pid is None:
+            rows = self._conn().execute("SELECT id FROM jobs WHERE state = ?", (RUNNING,))
+        else:
+            rows = self._conn().execute("SELECT id FROM jobs WHERE state = ? AND claimed_by = ?", (RUNNING, worker_pid))
+        return [row[0] for row in rows]
+
+    def unfinished_jobs(self):
+        """ Returns the stored job dicts of all queued, running and split jobs """
+        rows = self._conn().execute("SELECT payload FROM jobs WHERE state IN (?, ?, ?) AND payload IS NOT NULL",
+                                    (QUEUED, RUNNING, SPLIT))
+        return [pickle.loads(bytes(row[0])) for row in rows]
+
+    def start_stage(self, job_id, stage):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("UPDATE jobs SET state = ?, current_stage = ?, updated = ? WHERE id = ?",
+                     (RUNNING, stage, now, job_id))
+        conn.execute("INSERT OR REPLACE INTO stages (job_id, stage, started) VALUES (?, ?, ?)",
+                     (job_id, stage, now))
+
+    def finish_stage(self, job_id, stage, read_bytes=None, written_bytes=None):
+        """ Records a stage as finished, along with the bytes it read and wrote, if known """
+        self._conn().execute("UPDATE stages SET finished = ?, read_bytes = ?, written_bytes = ? WHERE job_id = ? AND stage = ?",
+                             (time.time(), read_bytes, written_bytes, job_id, stage))
+
+    def requeue(self, job_id, attempts):
+        """ Puts a job whose worker died back in the queue, recording how many times it has been attempted """
+        self._conn().execute("UPDATE jobs SET state = ?, current_stage = NULL, attempts = ?, claimed_by = NULL, "
+                             "updated = ? WHERE id = ?", (QUEUED, attempts, time.time(), job_id))
+
+    def update_info(self, job_id, station_name):
+        """ Updates the descriptive fields of a job that are only known once it's running """
+        self._conn().execute("UPDATE jobs SET station_name = ?, updated = ? WHERE id = ?",
+                             (station_name, time.time(), job_id))
+
+    def finish(self, job_id, state, packets=None, error_title=None, error=None):
+        now = time.time()
+        result = json.dumps(packets, default=str) if packets is not None else None
+        self._conn().execute(
+            "UPDATE jobs SET state = ?, current_stage = NULL, updated = ?, finished = ?, "
+            "error_title = ?, error = ?, result = ?, payload = NULL WHERE id = ?",
+            (state, now, now, error_title, error, result, job_id))
+
+    def queue_position(self, submitted):
+        """ Returns the number of queued jobs submitted before the given time (only an estimate of how
+        many will run first, as the scheduler also goes by submitter and clip length) """
+        row = self._conn().execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND submitted < ?",
+                                   (QUEUED, submitted)).fetchone()
+        return row[0]
+
+    def queue_stats(self):
+        """ Returns the number of queued jobs and how long the oldest has been waiting (s) """
+        count, oldest = self._conn().execute("SELECT COUNT(*), MIN(submitted) FROM jobs WHERE state = ?",
+                                             (QUEUED,)).fetchone()
+        return count, time.time() - oldest if oldest is not None else 0
+
+    def queued_audio_s(self, submitter):
+        """ Returns the audio seconds of the given submitter's queued and running jobs
+        (counting jobs of unknown duration as scheduler.UNKNOWN_DURATION_S) """
+        row = self._conn().execute("SELECT SUM(COALESCE(duration, ?)) FROM jobs WHERE state IN (?, ?) AND submitter IS ?",
+                                   (scheduler.UNKNOWN_DURATION_S, QUEUED, RUNNING, submitter)).fetchone()
+        return row[0] or 0
+
+    def backlog_audio_s(self):
+        """ Returns the audio seconds of everyone's queued and running jobs (see queued_audio_s) """
+        row = self._conn().execute("SELECT SUM(COALESCE(duration, ?)) FROM jobs WHERE state IN (?, ?)",
+                                   (scheduler.UNKNOWN_DURATION_S, QUEUED, RUNNING)).fetchone()
+        return row[0] or 0
+
+    def finished_audio_s(self, since):
+        """ Returns the audio seconds of the jobs (not counting chunks) finished since the given time """
+        row = self._conn().execute("SELECT SUM(COALESCE(duration, ?)) FROM jobs WHERE finished >= ? AND parent_id IS NULL",
+                                   (scheduler.UNKNOWN_DURATION_S, since)).fetchone()
+        return row[0] or 0
+
+    def queued_jobs(self):
+        """ Returns (submitter, duration, submitted) for every queued job """
+        return [tuple(row) for row in self._conn().execute(
+            "SELECT submitter, duration, submitted FROM jobs WHERE state = ?", (QUEUED,))]
+
+    def claims(self, since, limit=None):
+        """ Returns dicts describing the jobs claimed by a worker since the given time, most recent first """
+        query = "SELECT id, submitter, duration, submitted, claimed, schedule_reason FROM jobs " \
+                "WHERE claimed >= ? ORDER BY claimed DESC"
+        params = (since,)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        return [{
+            "id": row["id"],
+            "submitter": row["submitter"],
+            "duration": row["duration"],
+            "claimed": row["claimed"],
+            "wait_s": row["claimed"] - row["submitted"],
+            "reason": row["schedule_reason"],
+        } for row in self._conn().execute(query, params)]
+
+    def get(self, job_id):
+        """ Returns a dict describing the given job, or None if there's no such job """
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        stages = []
+        for stage_row in conn.execute("SELECT stage, started, finished, read_bytes, written_bytes FROM stages "
+                                      "WHERE job_id = ? ORDER BY started", (job_id,)):
+            stages.append({
+                "stage": stage_row["stage"],
+                "started": stage_row["started"],
+                "finished": stage_row["finished"],
+                "duration_s": stage_row["finished"] - stage_row["started"] if stage_row["finished"] else None,
+                "read_bytes": stage_row["read_bytes"],
+                "written_bytes": stage_row["written_bytes"],
+            })
+        io = {
+            "read_bytes": sum(s["read_bytes"] or 0 for s in stages),
+            "written_bytes": sum(s["written_bytes"] or 0 for s in stages),
+        }
+
+        plan = json.loads(row["stage_plan"]) if row["stage_plan"] else []
+        finished_stages = len([s for s in stages if s["finished"] is not None])
+        chunks = None
+        total, finished_chunks = conn.execute("SELECT COUNT(*), SUM(state IN (?, ?, ?)) FROM jobs WHERE parent_id = ?",
+                                              FINISHED_STATES + (job_id,)).fetchone()
+        if total > 0:
+            chunks = {"total": total, "finished": finished_chunks}
+        job = {
+            "id": row["id"],
+            "state": row["state"],
+            "station_name": row["station_name"],
+            "satnogs": bool(row["satnogs"]),
+            "obs_id": row["obs_id"],
+            "current_stage": row["current_stage"],
+            "attempts": row["attempts"],
+            "duration": row["duration"],
+            "schedule_reason": row["schedule_reason"],
+            "parent_id": row["parent_id"],
+            "chunks": chunks,
+            "stage_plan": plan,
+            "stages": stages,
+            "io": io, # totals over the finished stages (chunk jobs' are recorded with the chunks)
+            "progress": 1.0 if row["state"] in FINISHED_STATES else float(finished_stages) / max(1, len(plan)),
+            "submitted": row["submitted"],
+            "updated": row["updated"],
+            "finished": row["finished"],
+            "queue_position": self.queue_position(row["submitted"]) if row["state"] == QUEUED else None,
+            "error_title": row["error_title"],
+            "error": row["error"],
+            "packets": json.loads(row["result"]) if row["result"] else None
+        }
+        return job
+
+    def create_batch(self, batch_id, args, obs_ids):
+        """ Records a batch of SatNOGS observations to decode with the given args in common. Its
+        observations are queued a few at a time (see take_batch_observations) """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO batches (id, args, total, created) VALUES (?, ?, ?, ?)",
+                         (batch_id, json.dumps(args), len(obs_ids), now))
+            conn.executemany("INSERT INTO batch_observations (batch_id, obs_id, position) VALUES (?, ?, ?)",
+                             [(batch_id, obs_id, i) for i, obs_id in enumerate(obs_ids)])
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def take_batch_observations(self, batch_id, parallelism):
+        """ Marks as queued, and returns, as many of the batch's observations waiting to be queued
+        as keeps parallelism of them queued or running """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = conn.execute("SELECT COUNT(*) FROM batch_observations WHERE batch_id = ? AND queued IS NOT NULL "
+                                   "AND finished IS NULL", (batch_id,)).fetchone()[0]
+            obs_ids = [row["obs_id"] for row in conn.execute(
+                "SELECT obs_id FROM batch_observations WHERE batch_id = ? AND queued IS NULL ORDER BY position LIMIT ?",
+                (batch_id, max(0, parallelism - running)))]
+            conn.executemany("UPDATE batch_observations SET queued = ? WHERE batch_id = ? AND obs_id = ?",
+                             [(time.time(), batch_id, obs_id) for obs_id in obs_ids])
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return obs_ids
+
+    def set_batch_job(self, batch_id, obs_id, job_id):
+        self._conn().execute("UPDATE batch_observations SET job_id = ? WHERE batch_id = ? AND obs_id = ?",
+                             (job_id, batch_id, obs_id))
+
+    def finish_batch_observation(self, batch_id, obs_id, result):
+        """ Records the result (a dict) of one of the batch's observations. Returns True if it was the
+        batch's last, in which case the caller is the one to report on the whole batch """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE batch_observations SET finished = ?, result = ? WHERE batch_id = ? AND obs_id = ?",
+                         (time.time(), json.dumps(result, default=str), batch_id, obs_id))
+            last = conn.execute("UPDATE batches SET reported = ? WHERE id = ? AND reported IS NULL AND NOT EXISTS "
+                                "(SELECT 1 FROM batch_observations WHERE batch_id = ? AND finished IS NULL)",
+                                (time.time(), batch_id, batch_id)).rowcount > 0
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return last
+
+    def forget_batch_email(self, batch_id):
+        """ Drops the email address from the batch's args, once its report has been sent """
+        conn = self._conn()
+        row = conn.execute("SELECT args FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is not None:
+            args = json.loads(row["args"])
+            args.pop("email", None)
+            conn.execute("UPDATE batches SET args = ? WHERE id = ?", (json.dumps(args), batch_id))
+
+    def unfinished_batches(self):
+        """ Returns the IDs of the batches with observations left to decode, requeueing those which
+        were taken but never submitted (if the server stopped in between) """
+        conn = self._conn()
+        conn.execute("UPDATE batch_observations SET queued = NULL WHERE queued IS NOT NULL AND job_id IS NULL AND finished IS NULL")
+        return [row["id"] for row in conn.execute("SELECT id FROM batches WHERE reported IS NULL")]
+
+    def batch(self, batch_id):
+        """ Returns a dict describing the given batch and its observations (finished ones first, in the
+        order they finished), or None if there's no such batch """
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        observations = [{
+            "obs_id": obs["obs_id"],
+            "job_id": obs["job_id"],
+            "queued": obs["queued"],
+            "finished": obs["finished"],
+            "result": json.loads(obs["result"]) if obs["result"] else None,
+        } for obs in conn.execute("SELECT * FROM batch_observations WHERE batch_id = ? "
+                                  "ORDER BY finished IS NULL, finished, position", (batch_id,))]
+        return {
+            "id": row["id"],
+            "args": json.loads(row["args"]),
+            "total": row["total"],
+            "finished": len([obs for obs in observations if obs["finished"] is not None]),
+            "created": row["created"],
+            "reported": row["reported"],
+            "observations": observations,
+        }
@@ -0,0 +1,210 @@
+""" Delivery of result emails from a dedicated process, so decoder workers only have to add them to a
+durable SQLite outbox (see Mailer.send), where they survive crashes and restarts of the mail process.
+The mail process keeps one SMTP connection open while there is mail to send, sends everything that
+has queued up over it back to back, reconnects when the connection fails and retries failed messages
+with backoff. Messages are deleted from the outbox once they're sent or given up on, so it doesn't
+keep anyone's email address. yagmail.SMTP.send opens a new connection for every message,
+so messages are prepared with yagmail and handed to its smtplib connection directly. """
+import json
+import logging
+import metrics
+import multiprocessing
+import smtplib
+import socket
+import sqlite_util
+import time
+import yagmail
+from yagmail.error import YagInvalidEmailAddress
+
+SMTP_HOST = "smtp.gmail.com"
+MAIL_OUTBOX_DB = "data/mail.db"
+QUEUE_EMPTY_POLL_PERIOD = 1
+MAIL_BATCH_LIMIT = 50 # messages sent per pass over the queue
+SMTP_IDLE_CLOSE_S = 60 # servers drop idle connections anyway
+RETRY_BASE_S = 10
+RETRY_MAX_S = 30*60
+MAX_ATTEMPTS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mail (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    contents TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mail_next_attempt ON mail (next_attempt);
+"""
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def retry_delay(attempts):
+    """ Seconds to wait before the next attempt after the given number of failed ones """
+    return min(RETRY_MAX_S, RETRY_BASE_S * 2**(attempts - 1))
+
+class SMTPConnection:
+    """ A yagmail.SMTP which stays logged in between messages and reconnects after failures """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.yag = None
+        self.last_used = 0
+        self.connections = 0
+
+    def connect(self):
+        s = self.settings
+        self.yag = yagmail.SMTP(s["user"], s["password"], host=s["host"], port=s["port"], smtp_ssl=s["ssl"],
+                                smtp_starttls=s["starttls"], smtp_skip_login=s["skip_login"])
+        self.yag.login()
+        self.connections += 1
+
+    def close(self):
+        if self.yag is not None:
+            try:
+                self.yag.close()
+            except (smtplib.SMTPException, socket.error):
+                pass # already broken
+            self.yag = None
+
+    def send(self, message):
+        """ Sends the given message over the open connection, opening one if needed.
+        Raises on failure, after closing the connection so the next send reconnects """
+        try:
+            if self.yag is None:
+                self.connect()
+            recipients, msg_string = self.yag.prepare_send(to=message["to"], subject=message["subject"],
+                                                           contents=message["contents"])
+            self.yag.smtp.sendmail(self.yag.user, recipients, msg_string)
+            self.last_used = time.time()
+        except (YagInvalidEmailAddress, smtplib.SMTPRecipientsRefused):
+            raise # the connection is still fine
+        except:
+            self.close()
+            raise
+
+    def close_if_idle(self):
+        if self.yag is not None and time.time() - self.last_used > SMTP_IDLE_CLOSE_S:
+            self.close()
+
+class MailOutbox:
+    def __init__(self, path=MAIL_OUTBOX_DB):
+        self.db = sqlite_util.LocalConnection(path, SCHEMA)
+
+    def _conn(self):
+        return self.db.get()
+
+    def add(self, to, subject, contents):
+        now = time.time()
+        self._conn().execute("INSERT INTO mail (recipient, subject, contents, next_attempt, created) VALUES (?, ?, ?, ?, ?)",
+                             (to, subject, json.dumps(contents), now, now))
+
+    def due(self, limit=MAIL_BATCH_LIMIT, now=None):
+        """ Returns the messages whose next attempt is due, oldest first """
+        now = time.time() if now is None else now
+        return [{
+            "id": row["id"],
+            "to": row["recipient"],
+            "subject": row["subject"],
+            "contents": json.loads(row["contents"]),
+            "attempts": row["attempts"],
+        } for row in self._conn().execute("SELECT * FROM mail WHERE next_attempt <= ? ORDER BY id LIMIT ?", (now, limit))]
+
+    def remove(self, message_id):
+        """ Drops a message which was sent or given up on """
+        self._conn().execute("DELETE FROM mail WHERE id = ?", (message_id,))
+
+    def retry(self, message_id, attempts, delay):
+        self._conn().execute("UPDATE mail SET attempts = ?, next_attempt = ? WHERE id = ?",
+                             (attempts, time.time() + delay, message_id))
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM mail").fetchone()[0]
+
+class Mailer:
+    def __init__(self, user, password, host=SMTP_HOST, port=None, ssl=True, starttls=None, skip_login=False,
+                 outbox=None, in_logger=None):
+        self.settings = {
+            "user": user,
+            "password": password,
+            "host": host,
+            "port": port,
+            "ssl": ssl,
+            "starttls": starttls,
+            "skip_login": skip_login,
+        }
+        self.outbox = outbox if outbox is not None else MailOutbox()
+        self.stopping = multiprocessing.Value("b", False)
+        self.proc = None
+        if in_logger:
+            global logger
+            logger = in_logger
+
+    def start(self):
+        """ Spawns the process which delivers queued messages """
+        self.proc = multiprocessing.Process(target=self.mail_worker, args=(self.outbox, self.stopping, self.settings))
+        self.proc.start()
+
+    def stop(self):
+        self.stopping.value = True
+
+    def send(self, to, subject, contents):
+        """ Queues an email for delivery """
+        self.outbox.add(to, subject, contents)
+
+    @staticmethod
+    def deliver(conn, outbox, batch):
+        """ Sends a batch of messages from the outbox, scheduling failed ones for retry """
+        for message in batch:
+            try:
+                with metrics.email_duration.time():
+                    conn.send(message)
+                logger.debug("sent email '%s' to %s", message["subject"], message["to"])
+                outbox.remove(message["id"])
+
+            except (YagInvalidEmailAddress, smtplib.SMTPRecipientsRefused) as ex:
+                logger.error("email '%s' to %s can't be delivered: %s", message["subject"], message["to"], ex)
+                outbox.remove(message["id"])
+
+            except (smtplib.SMTPException, socket.error) as ex:
+                Mailer.retry(outbox, message, ex)
+
+            except Exception as ex:
+                # e.g. a message yagmail can't build; retried like any other failure (in case the cause
+                # was transient), so it's given up on after MAX_ATTEMPTS rather than holding up the rest
+                logger.error("error sending email '%s' to %s", message["subject"], message["to"])
+                logger.exception(ex)
+                Mailer.retry(outbox, message, ex)
+
+    @staticmethod
+    def retry(outbox, message, ex):
+        """ Schedules a message which failed to send for another attempt, or gives up after MAX_ATTEMPTS """
+        attempts = message["attempts"] + 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.error("giving up on email '%s' to %s after %d attempts: %s",
+                         message["subject"], message["to"], attempts, ex)
+            outbox.remove(message["id"])
+        else:
+            delay = retry_delay(attempts)
+            logger.warning("email '%s' to %s failed to send, retrying in %ds: %s",
+                           message["subject"], message["to"], delay, ex)
+            outbox.retry(message["id"], attempts, delay)
+
+    @staticmethod
+    def mail_worker(outbox, stopping, settings):
+        conn = SMTPConnection(settings)
+        while not stopping.value:
+            try:
+                batch = outbox.due()
+                if len(batch) > 0:
+                    Mailer.deliver(conn, outbox, batch)
+                else:
+                    conn.close_if_idle()
+                    time.sleep(QUEUE_EMPTY_POLL_PERIOD)
+            except Exception as ex:
+                logger.error("Exception in mail worker")
+                logger.exception(ex)
+                time.sleep(QUEUE_EMPTY_POLL_PERIOD)
+        conn.close()
@@ -0,0 +1,151 @@
+""" Counters and latency histograms shared by the server and all the processes it forks (decoder
+workers, packet publisher and mailer), rendered in the Prometheus text format for the /metrics
+endpoint. Each metric keeps its values in a multiprocessing.Array allocated when this module is
+imported, so the processes forked afterwards all update the same memory and no process has to
+collect them from the others. Label values are fixed when a metric is declared, with any other
+value counted under "other". Gauges, such as the queue depth, are read at scrape time (see
+server.metrics_endpoint) instead. """
+import multiprocessing
+import time
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS_S = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+OTHER_LABEL = "other"
+
+_registry = []
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in labels)
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class _Metric:
+    def __init__(self, name, help, label, width):
+        """ label is None or a (name, values) pair; width is the number of values kept per label value """
+        self.name = name
+        self.help = help
+        self.label_name, self.label_values = label if label is not None else (None, [])
+        self.label_values = list(self.label_values) + [OTHER_LABEL] if label is not None else [None]
+        self.width = width
+        self.values = multiprocessing.Array("d", width * len(self.label_values))
+        _registry.append(self)
+
+    def _offset(self, label):
+        if self.label_name is None:
+            return 0
+        if label not in self.label_values:
+            label = OTHER_LABEL
+        return self.label_values.index(label) * self.width
+
+    def _labels(self, label):
+        return [] if self.label_name is None else [(self.label_name, label)]
+
+class Counter(_Metric):
+    def __init__(self, name, help, label=None):
+        _Metric.__init__(self, name, help, label, 1)
+
+    def inc(self, amount=1, label=None):
+        offset = self._offset(label)
+        with self.values.get_lock():
+            self.values[offset] += amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for label in self.label_values:
+            lines.append("%s%s %s" % (self.name, _format_labels(self._labels(label)),
+                                      _format_value(self.values[self._offset(label)])))
+        return lines
+
+class Histogram(_Metric):
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS_S):
+        self.buckets = list(buckets) + [float("inf")]
+        # a count per bucket (not cumulative), then the sum of the observations
+        _Metric.__init__(self, name, help, label, len(self.buckets) + 1)
+
+    def observe(self, value, label=None):
+        offset = self._offset(label)
+        bucket = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self.values.get_lock():
+            self.values[offset + bucket] += 1
+            self.values[offset + len(self.buckets)] += value
+
+    def time(self, label=None):
+        """ A context manager observing how long its block took """
+        return _Timer(self, label)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.values.get_lock():
+            values = self.values[:]
+        for label in self.label_values:
+            offset = self._offset(label)
+            labels = self._labels(label)
+            count = 0
+            for i, bound in enumerate(self.buckets):
+                count += values[offset + i]
+                lines.append("%s_bucket%s %s" % (self.name, _format_labels(labels + [("le", _format_value(bound))]),
+                                                 _format_value(count)))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(labels), _format_value(values[offset + len(self.buckets)])))
+            lines.append("%s_count%s %s" % (self.name, _format_labels(labels), _format_value(count)))
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, self.label)
+        return False
+
+def render_sampled(name, help, values, label_name=None, type="gauge"):
+    """ Renders a metric read at scrape time (e.g. from the job store), given its value or a dict of
+    values by label value. type may be "counter" for values kept elsewhere which only go up """
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, type)]
+    if label_name is None:
+        values = {None: values}
+    for label in sorted(values):
+        labels = [] if label_name is None else [(label_name, label)]
+        lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(values[label])))
+    return lines
+
+def render(sampled=None):
+    """ Returns all declared metrics, followed by the given lines of metrics read at scrape time
+    (see render_sampled), in the Prometheus text format """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(sampled or [])
+    return "\n".join(lines) + "\n"
+
+# the decoder's metrics
+JOB_STATES = ["done", "rejected", "failed"] # see jobstore.FINISHED_STATES
+STAGES = ["fetch_satnogs_stage", "convert_stage", "slice_stage", "demod", "report"] # see pipeline.run_stage
+
+queue_wait = Histogram("equisat_queue_wait_seconds", "Time from a job's submission until a worker claimed it")
+stage_duration = Histogram("equisat_stage_duration_seconds", "Time taken by each stage of a job", ("stage", STAGES))
+flowgraph_duration = Histogram("equisat_flowgraph_duration_seconds", "Time taken to run a demod flowgraph")
+flowgraph_timeouts = Counter("equisat_flowgraph_timeouts_total", "Flowgraph runs whose wait function gave up before the source was drained")
+packet_postprocess_duration = Histogram("equisat_packet_postprocess_duration_seconds",
+                                        "Time taken to extract and parse the packets of a finished flowgraph")
+publish_duration = Histogram("equisat_publish_duration_seconds", "Time taken to post a packet to the packet API")
+email_duration = Histogram("equisat_email_duration_seconds", "Time taken to send a result email")
+jobs_finished = Counter("equisat_jobs_finished_total", "Jobs finished, by final state", ("state", JOB_STATES))
+admission_rejections = Counter("equisat_admission_rejections_total", "Submissions turned away with a 429, by the limit they hit "
+                               "(see server.check_admission)", ("reason", ["client", "submitter", "queued", "backlog"]))
+worker_busy = Counter("equisat_worker_busy_seconds_total", "Time decoder workers have spent running jobs")
+# the FEC success rate is the rate of corrected packets over that of raw ones
+packets_decoded = Counter("equisat_packets_total", "Packets decoded by finished jobs: raw ones, those that passed "
+                          "error correction, and corrected ones with parse errors", ("kind", ["raw", "corrected", "parse_errors"]))
+duplicate_packets = Counter("equisat_duplicate_packets_total", "Error-free packets not submitted to the packet API because "
+                            "another job already had (see packet_index.py)")
@@ -0,0 +1,79 @@
+""" Post-processing of the packets collected by a finished demod flowgraph (see DecoderQueue.extract_packets)
+as one batch rather than message by message. The payloads of all stored messages are copied out of their
+PMTs whole (from their serialized form, instead of element by element through u8vector_elements) into
+one contiguous buffer, which is hexlified in one go; the hex strings the output needs are slices of it.
+Corrected packets are then parsed from those. """
+import binascii
+import pmt
+import struct
+
+# the header of a serialized u8vector (see pmt_serialize.cc): type, item type, length, padding
+PST_UNIFORM_VECTOR = 0x0a
+UVI_U8 = 0x00
+U8VECTOR_HEADER = struct.Struct(">BBIB")
+
+def u8vector_bytes(vector):
+    """ Returns the contents of the given u8vector PMT as a byte string """
+    serialized = pmt.serialize_str(vector)
+    if len(serialized) >= U8VECTOR_HEADER.size:
+        pst, item_type, length, npad = U8VECTOR_HEADER.unpack(serialized[:U8VECTOR_HEADER.size])
+        start = U8VECTOR_HEADER.size + npad
+        if pst == PST_UNIFORM_VECTOR and item_type == UVI_U8 and len(serialized) == start + length:
+            return serialized[start:]
+    # some other serialization
+    return bytes(bytearray(pmt.u8vector_elements(vector)))
+
+class PayloadBatch:
+    """ Byte strings appended back to back to one buffer, each of which can be had as hex """
+
+    def __init__(self):
+        self.payloads = []
+        self.offsets = [0]
+        self._hex = None
+
+    def append(self, payload):
+        self.payloads.append(payload)
+        self.offsets.append(self.offsets[-1] + len(payload))
+        self._hex = None
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def hex(self, i):
+        """ The ith payload as a hex string (the whole buffer is hexlified on first use) """
+        if self._hex is None:
+            self._hex = binascii.hexlify(b"".join(self.payloads))
+        return self._hex[2 * self.offsets[i]:2 * self.offsets[i + 1]]
+
+    def hex_all(self):
+        return [self.hex(i) for i in range(len(self))]
+
+def collect_packets(raw_messages, corrected_messages, parse_packet):
+    """ Returns a dict containing the raw_packets and corrected_packets lists for the given raw and
+    corrected packet messages of a flowgraph's message stores; corrected packets are parsed with
+    parse_packet(hex), which returns the parsed packet and a list of errors """
+    raw = PayloadBatch()
+    for msg in raw_messages:
+        raw.append(u8vector_bytes(pmt.cdr(msg)))
+
+    corrected = PayloadBatch()
+    corrected_raw = PayloadBatch()
+    raw_key = pmt.intern("raw")
+    for msg in corrected_messages:
+        corrected.append(u8vector_bytes(pmt.cdr(msg)))
+        corrected_raw.append(u8vector_bytes(pmt.dict_ref(pmt.car(msg), raw_key, pmt.get_PMT_NIL())))
+
+    corrected_packets = []
+    for i in range(len(corrected)):
+        decoded, decode_errs = parse_packet(corrected.hex(i))
+        corrected_packets.append({
+            "raw": corrected_raw.hex(i),
+            "corrected": corrected.hex(i),
+            "parsed": decoded,
+            "decode_errs": decode_errs
+        })
+
+    return {
+        "raw_packets": raw.hex_all(),
+        "corrected_packets": corrected_packets,
+    }
@@ -0,0 +1,101 @@
+""" Index of the error-free packets submitted to the packet API, so a packet received by several
+stations (or submitted twice) is only posted once, and results can say who else received it. Each
+packet is keyed by the first 8 bytes of the SHA-1 of its corrected bytes, as the table's integer
+primary key, so looking one up is a single key lookup. Entries hold the packet's first rx_time and
+station, and the other stations that received it. They're evicted INDEX_WINDOW_S after they were
+first seen, so the index only holds a few weeks of packets however long the server runs (a packet
+received again after that is posted again, which the API answers as a duplicate). Packets are only
+recorded once the API has accepted them (see PacketPublisher.send), so one it rejects or that expires
+in the outbox is still posted from the next job with it; until then, jobs finishing with the same packet
+may all queue it, which the API answers as a duplicate too. """
+import hashlib
+import json
+import sqlite_util
+import struct
+import time
+
+PACKET_INDEX_DB = "data/packets.db"
+INDEX_WINDOW_S = 30*24*60*60
+EVICT_PERIOD_S = 60*60 # between evictions by each process
+MAX_STATIONS = 50 # kept per packet
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packets (
+    key INTEGER PRIMARY KEY,
+    rx_time REAL,
+    station_name TEXT,
+    first_seen REAL NOT NULL,
+    stations TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packets_first_seen ON packets (first_seen);
+"""
+
+def packet_key(corrected):
+    """ The index key of a packet, given its corrected bytes as hex """
+    return struct.unpack(">q", hashlib.sha1(corrected.lower().encode("ascii")).digest()[:8])[0]
+
+class PacketIndex:
+    def __init__(self, path=PACKET_INDEX_DB, window_s=INDEX_WINDOW_S):
+        self.window_s = window_s
+        self.db = sqlite_util.LocalConnection(path, SCHEMA)
+        self.evicted = 0 # when this process last evicted old packets
+
+    def _conn(self):
+        return self.db.get()
+
+    @staticmethod
+    def _entry(row):
+        return {
+            "rx_time": row["rx_time"],
+            "station_name": row["station_name"],
+            "stations": json.loads(row["stations"]),
+        }
+
+    def get(self, corrected):
+        """ Returns the entry (a dict of the first rx_time as POSIX seconds, the first station_name and
+        all the stations which received it) of the given packet, or None if it isn't in the index """
+        row = self._conn().execute("SELECT * FROM packets WHERE key = ? AND first_seen >= ?",
+                                   (packet_key(corrected), time.time() - self.window_s)).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def add(self, corrected, rx_time, station_name):
+        """ Records that the given station received the given packet at rx_time (POSIX seconds), once the
+        API has accepted it. Returns None if it wasn't in the index, or its entry otherwise including this station """
+        return self._record(corrected, station_name, rx_time, True)
+
+    def add_station(self, corrected, station_name):
+        """ Records that the given station also received a packet already in the index (see get), whose
+        copy wasn't posted. Returns its entry including this station, or None if it isn't in the index """
+        return self._record(corrected, station_name, None, False)
+
+    def _record(self, corrected, station_name, rx_time, insert):
+        now = time.time()
+        conn = self._conn()
+        self._evict(conn, now)
+        key = packet_key(corrected)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM packets WHERE key = ? AND first_seen >= ?", (key, now - self.window_s)).fetchone()
+            entry = None
+            if row is None:
+                if insert:
+                    conn.execute("INSERT OR REPLACE INTO packets (key, rx_time, station_name, first_seen, stations) VALUES (?, ?, ?, ?, ?)",
+                                 (key, rx_time, station_name, now, json.dumps([station_name])))
+            else:
+                entry = self._entry(row)
+                if station_name not in entry["stations"] and len(entry["stations"]) < MAX_STATIONS:
+                    entry["stations"].append(station_name)
+                    conn.execute("UPDATE packets SET stations = ? WHERE key = ?", (json.dumps(entry["stations"]), key))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return entry
+
+    def _evict(self, conn, now):
+        if now - self.evicted >= EVICT_PERIOD_S:
+            conn.execute("DELETE FROM packets WHERE first_seen < ?", (now - self.window_s,))
+            self.evicted = now
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM packets").fetchone()[0]
@@ -0,0 +1,277 @@
+""" Helpers for the staged decode jobs run by the decoder workers. A job is a dict holding the
+wavfilename, onfinish callback and args passed to DecoderQueue.submit, along with a list of
+ingest stages (fetch, convert, slice, ...) which run in the worker before demodulation.
+Stages are module-level functions (so jobs can be pickled onto the queue) which take the
+job dict and update it, e.g. by setting job["wavfilename"] to the file they produced, or
+job["frames"] to the span [start_i, stop_i) of its frames to demodulate.
+Long recordings can be split into chunks demodulated by several workers at once (see split_job).
+The bytes each stage reads and writes are recorded along with its timing. """
+import audio_utils
+import bursts
+import chunking
+import jobstore
+import logging
+import metrics
+import os
+import time
+import uuid
+
+ORPHANED_FILE_MIN_AGE_S = 60*60 # so files being uploaded (before their job exists) are left alone
+PROC_IO = "/proc/self/io"
+DEMOD_STAGE = "demod"
+REPORT_STAGE = "report" # the onfinish callback (publishing and emailing results)
+
+class StageError(Exception):
+    """ Raised by a stage to reject a job, with a title and message meant for the submitter """
+    def __init__(self, title, message):
+        Exception.__init__(self, message)
+        self.title = title
+        self.message = message
+
+def new_job(wavfilename, onfinish, args, stages=None, duration=None):
+    return {
+        "id": uuid.uuid4().hex,
+        "wavfilename": None if wavfilename is None else str(wavfilename),
+        "onfinish": onfinish,
+        "args": args,
+        "stages": list(stages or []),
+        "attempts": 0, # runs started, counted by the decoder when a worker dies (see DecoderQueue.lost_job)
+        "duration": duration, # of the audio in seconds, for scheduling; estimated until a stage measures it
+    }
+
+def stage_plan(job):
+    """ Returns the names of all stages the job will go through """
+    return [stage.__name__ for stage in job["stages"]] + [DEMOD_STAGE, REPORT_STAGE]
+
+def io_counters():
+    """ Returns the bytes this process has read and written so far through read/write system calls
+    (including sockets, but not pages of memory-mapped files), or (None, None) where that isn't known """
+    try:
+        with open(PROC_IO) as f:
+            counters = dict(line.split(":", 1) for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+def run_stage(job, name, func, store):
+    if store is not None:
+        store.start_stage(job["id"], name)
+    read_before, written_before = io_counters()
+    with metrics.stage_duration.time(name):
+        result = func(job)
+    if store is not None:
+        read_after, written_after = io_counters()
+        if read_before is None or read_after is None:
+            store.finish_stage(job["id"], name)
+        else:
+            store.finish_stage(job["id"], name, read_after - read_before, written_after - written_before)
+    return result
+
+def run_job(job, demod, store=None, logger=logging, cache=None, demod_params="", split=False, doorbell=None):
+    """ Runs the job's ingest stages, demodulates its wav file with demod(wavfilename, frames=frames) and
+    passes the results to its onfinish callback, recording progress in the given JobStore.
+    If a ResultCache is given, results are looked up there first (demod_params identifies
+    the demodulator configuration) and stored there afterwards, unless they're incomplete.
+    If split is set, long recordings are split into chunk jobs for other workers to demodulate
+    in parallel (see split_job); the worker which finishes the last chunk merges their results
+    and reports them. doorbell is the queue to put the IDs of the chunk jobs on, to wake idle workers """
+    err = None
+    error_title = None
+    is_chunk = job.get("parent_id") is not None
+    job_cache = cache if not is_chunk else None # chunk results only count once merged
+    try:
+        # a cached SatNOGS result lets the job skip fetching the audio as well as demodulating it
+        obs_key = job_cache.obs_key(job["args"], demod_params) if job_cache is not None else None
+        cached = job_cache.get(obs_key) if obs_key is not None else None
+        if cached is not None:
+            logger.info("[%s] Using cached results for observation" % job["id"])
+            packets, cached_args = cached
+            job["args"].update(cached_args)
+        else:
+            while len(job["stages"]) > 0:
+                stage = job["stages"][0]
+                run_stage(job, stage.__name__, stage, store)
+                # drop the finished stage and save the job, so it resumes after it if it's rerun
+                job["stages"].pop(0)
+                if store is not None:
+                    store.checkpoint(job)
+
+            audio_key = job_cache.audio_key(job["wavfilename"], demod_params, job.get("frames")) \
+                if job_cache is not None else None
+            cached = job_cache.get(audio_key) if audio_key is not None else None
+            if cached is not None:
+                logger.info("[%s] Using cached results for identical audio" % job["id"])
+                packets = cached[0]
+            else:
+                if job.get("chunks") is not None:
+                    packets = merge_chunks(job, store, logger)
+                elif split and store is not None and not is_chunk and chunking.should_split(job_duration(job)):
+                    split_job(job, store, doorbell, logger)
+                    return # reported once its chunks have finished
+                else:
+                    packets = run_stage(job, DEMOD_STAGE, lambda job: demod_job(job, demod), store)
+                if job_cache is not None and not packets.get("incomplete"):
+                    job_cache.put([obs_key, audio_key], packets, job["args"] or {})
+
+        if store is not None and job["args"] is not None:
+            store.update_info(job["id"], job["args"].get("station_name"))
+        state = jobstore.DONE
+
+    except StageError as ex:
+        logger.info("[%s] Job rejected: %s" % (job["id"], ex.title))
+        packets = empty_packets(ex.title)
+        err = ex.message
+        error_title = ex.title
+        state = jobstore.REJECTED
+
+    except Exception as ex:
+        logger.error("Exception in decoder worker, skipping job")
+        logger.exception(ex)
+        packets = empty_packets()
+        err = str(ex)
+        state = jobstore.FAILED
+
+    onfinish = job["onfinish"]
+    try:
+        run_stage(job, REPORT_STAGE, lambda job: onfinish(job["wavfilename"], packets, job["args"], err), store)
+    finally:
+        if store is not None:
+            store.finish(job["id"], state, packets, error_title, err)
+        if not is_chunk:
+            count_finished(state, packets)
+
+    if is_chunk and store is not None and store.chunk_finished(job["parent_id"], os.getpid()):
+        # this was the recording's last chunk to finish, so merge and report the results here
+        parent, _, attempts = store.load(job["parent_id"])
+        parent["attempts"] = attempts
+        run_job(parent, demod, store, logger, cache, demod_params, split, doorbell)
+
+def demod_job(job, demod):
+    """ Demodulates the job's wav file (or its frames). For a chunk, the overlap with the previous chunk
+    ("head_frames") is also demodulated alone, to count the packets decoded from it (which come first),
+    as its "head" [raw, corrected] counts (see chunking.merge_packets) """
+    packets = demod(job["wavfilename"], frames=job.get("frames"))
+    if job.get("head_frames") is not None:
+        head = demod(job["wavfilename"], frames=job["head_frames"])
+        packets["head"] = [len(head["raw_packets"]), len(head["corrected_packets"])]
+    return packets
+
+def job_duration(job):
+    """ The duration of the job's audio, as measured by an ingest stage or from its header,
+    or None if it can't be read (which is left to the demodulator to report) """
+    if job.get("duration") is not None:
+        return job["duration"]
+    try:
+        return audio_utils.probe_audiofile(job["wavfilename"]).duration
+    except RuntimeError: # soundfile error
+        return None
+
+def split_job(job, store, doorbell=None, logger=logging):
+    """ Splits the job's audio into overlapping chunks (see chunking.py) and queues a job for each,
+    which only demodulates it. The chunks are spans of the job's wav file rather than files of their
+    own. The job waits in the SPLIT state until all of them have finished """
+    wavfilename = job["wavfilename"]
+    view = audio_utils.pcm_view(wavfilename, job.get("frames"))
+    duration = float(view.nframes) / view.sample_rate
+    score, window_s = bursts.score_audiofile(wavfilename, chunking.SCORE_WINDOW_S, job.get("frames"))
+    if score is None:
+        score, window_s = [], chunking.SCORE_WINDOW_S
+    spans = chunking.plan_chunks(score, duration, window_s)
+
+    store.start_stage(job["id"], DEMOD_STAGE) # finished once the chunks are merged
+    chunks = []
+    for i, (start_s, stop_s) in enumerate(spans):
+        chunk = new_job(wavfilename, report_chunk, {
+            "email": job["args"].get("email"), # for fair scheduling
+            "station_name": job["args"].get("station_name"),
+        }, duration=stop_s - start_s)
+        chunk["frames"] = (view.start_i + int(start_s * view.sample_rate), view.start_i + int(stop_s * view.sample_rate))
+        chunk["parent_id"] = job["id"]
+        chunk["chunk_index"] = i
+        if i > 0:
+            # demodulated by both this chunk and the previous one (see demod_job)
+            chunk["head_frames"] = (chunk["frames"][0], view.start_i + int(spans[i - 1][1] * view.sample_rate))
+        chunks.append(chunk)
+
+    job["chunks"] = len(chunks)
+    store.split(job, chunks, stage_plan(chunks[0]))
+    logger.info("[%s] Split %ds recording into %d chunks" % (job["id"], duration, len(chunks)))
+    if doorbell is not None:
+        for chunk in chunks:
+            doorbell.put_nowait(chunk["id"])
+
+def merge_chunks(job, store, logger=logging):
+    """ Returns the merged packets of the job's finished chunks (see chunking.merge_packets). Chunks which
+    failed are left out (unless all did, which raises), which marks the result incomplete """
+    results = store.chunk_results(job["id"])
+    failed = [error for state, _, error in results if state != jobstore.DONE]
+    if len(failed) == len(results):
+        raise Exception("All %d chunks of the recording failed to demodulate: %s" % (len(results), failed[0]))
+    if len(failed) > 0:
+        logger.warning("[%s] %d of %d chunks failed; merging the rest: %s" % (job["id"], len(failed), len(results), failed))
+
+    packets = chunking.merge_packets([packets if state == jobstore.DONE else None for state, packets, _ in results])
+    store.finish_stage(job["id"], DEMOD_STAGE)
+    return packets
+
+def report_chunk(wavfilename, packets, args, err):
+    """ The onfinish callback of chunk jobs, which does nothing: their results are reported
+    by their parent job, which also removes the wav file they share """
+    pass
+
+def fail_job(job, title, message, store=None, logger=logging, doorbell=None):
+    """ Reports a job which couldn't be run to completion (e.g. because its worker process died)
+    to its onfinish callback, without running any of its stages. If it was the last chunk of a
+    split job to finish, the split job is queued (and doorbell rung) to merge the results """
+    logger.error("[%s] Job failed: %s" % (job["id"], message))
+    packets = empty_packets(title)
+    try:
+        job["onfinish"](job["wavfilename"], packets, job["args"], message)
+    finally:
+        if store is not None:
+            store.finish(job["id"], jobstore.FAILED, packets, title, message)
+        if job.get("parent_id") is None:
+            count_finished(jobstore.FAILED, packets)
+
+    if job.get("parent_id") is not None and store is not None and store.chunk_finished(job["parent_id"]):
+        if doorbell is not None:
+            doorbell.put_nowait(job["parent_id"])
+
+def count_finished(state, packets):
+    """ Counts a finished job and the packets it decoded in the shared metrics (see metrics.py) """
+    metrics.jobs_finished.inc(label=state)
+    metrics.packets_decoded.inc(len(packets["raw_packets"]), "raw")
+    metrics.packets_decoded.inc(len(packets["corrected_packets"]), "corrected")
+    metrics.packets_decoded.inc(len([p for p in packets["corrected_packets"] if len(p["decode_errs"]) > 0]), "parse_errors")
+
+def empty_packets(error_title=None):
+    """ The packets dict passed to onfinish for a job that didn't get to demodulation """
+    packets = {
+        "raw_packets": [],
+        "corrected_packets": [],
+    }
+    if error_title is not None:
+        packets["error_title"] = error_title
+    return packets
+
+def collect_orphaned_files(folder, store, min_age_s=ORPHANED_FILE_MIN_AGE_S, logger=logging):
+    """ Removes the files in folder which don't belong to an unfinished job in the given JobStore,
+    e.g. those left behind by jobs interrupted by a restart. Returns the removed filenames """
+    owned = set()
+    for job in store.unfinished_jobs():
+        if job["wavfilename"] is not None:
+            owned.add(os.path.abspath(job["wavfilename"]))
+            owned.add(os.path.abspath(audio_utils.wav_filename(job["wavfilename"])))
+
+    removed = []
+    now = time.time()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith(".") or not os.path.isfile(path) or os.path.abspath(path) in owned:
+            continue
+        if now - os.path.getmtime(path) >= min_age_s:
+            os.remove(path)
+            removed.append(path)
+    if len(removed) > 0:
+        logger.info("Removed %d orphaned files from %s" % (len(removed), folder))
+    return removed
@@ -0,0 +1,223 @@
+""" Submission of decoded packets to the packet API. Decoder workers only add a job's packets to a
+durable SQLite outbox (see PacketPublisher.submit); a separate publisher process sends them over a
+pooled HTTP session and retries failed submissions with exponential backoff, so packets survive API
+outages and server restarts. The API takes one packet per request, so a job's packets are stored
+together and sent back to back over the same connection. Packets the API accepts are recorded in the
+packet index (see packet_index.py), so other jobs with them don't post them again. """
+import datetime
+import json
+import logging
+import metrics
+import multiprocessing
+import requests
+import sqlite_util
+import time
+
+PACKET_API_ROUTE = "http://api.brownspace.org/equisat/receive/raw"
+OUTBOX_DB = "data/outbox.db"
+PUBLISH_POLL_PERIOD = 1
+PUBLISH_BATCH_LIMIT = 100 # packets claimed per pass over the outbox
+HTTP_TIMEOUT_S = 30
+HTTP_POOL_SIZE = 2
+RETRY_BASE_S = 5
+RETRY_MAX_S = 60*60
+MAX_ATTEMPTS = 12
+# responses worth retrying; any other status apart from 200/201 means the API rejected the packet
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# outbox entry states
+PENDING = "pending"
+SENT = "sent"
+DUPLICATE = "duplicate" # the API already had the packet (201)
+REJECTED = "rejected"
+EXPIRED = "expired" # gave up after MAX_ATTEMPTS
+PUBLISHED_STATES = (SENT, DUPLICATE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch TEXT NOT NULL,
+    station_name TEXT,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    status_code INTEGER,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_state_next_attempt ON outbox (state, next_attempt);
+"""
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def packet_payload(raw, corrected, post_publicly, rx_time, station_name):
+    """ Returns the JSON body the packet API expects for a packet, without the API secret """
+    epoch = datetime.datetime(1970, 1, 1)
+    rx_time_posix = (rx_time - epoch).total_seconds()*1000 # ms since 1970
+
+    return {
+        "raw": raw,
+        "corrected": corrected,
+        "station_name": station_name,
+        "post_publicly": post_publicly,
+        "source": "decoder.brownspace.org",
+        "rx_time": rx_time_posix,
+    }
+
+def retry_delay(attempts):
+    """ Seconds to wait before the next attempt after the given number of failed ones """
+    return min(RETRY_MAX_S, RETRY_BASE_S * 2**(attempts - 1))
+
+class Outbox:
+    def __init__(self, path=OUTBOX_DB):
+        self.db = sqlite_util.LocalConnection(path, SCHEMA)
+
+    def _conn(self):
+        return self.db.get()
+
+    def add(self, batch, station_name, payloads):
+        """ Adds the given packet payloads, all from one job, in a single transaction """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO outbox (batch, station_name, payload, state, next_attempt, created) VALUES (?, ?, ?, ?, ?, ?)",
+                [(batch, station_name, json.dumps(payload), PENDING, now, now) for payload in payloads])
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    def due(self, limit=PUBLISH_BATCH_LIMIT, now=None):
+        """ Returns pending entries whose next attempt is due, oldest job first """
+        now = time.time() if now is None else now
+        return self._conn().execute(
+            "SELECT * FROM outbox WHERE state = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+            (PENDING, now, limit)).fetchall()
+
+    def finish(self, entry_id, state, status_code=None, error=None):
+        self._conn().execute(
+            "UPDATE outbox SET state = ?, attempts = attempts + 1, finished = ?, status_code = ?, last_error = ? WHERE id = ?",
+            (state, time.time(), status_code, error, entry_id))
+
+    def retry(self, entry_id, attempts, status_code=None, error=None):
+        """ Records a failed attempt, scheduling the next one or giving up after MAX_ATTEMPTS """
+        if attempts + 1 >= MAX_ATTEMPTS:
+            self.finish(entry_id, EXPIRED, status_code, error)
+        else:
+            self._conn().execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, status_code = ?, last_error = ? WHERE id = ?",
+                (time.time() + retry_delay(attempts + 1), status_code, error, entry_id))
+
+    def counts(self):
+        """ Returns the number of entries in each state """
+        return dict(self._conn().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall())
+
+class PacketPublisher:
+    def __init__(self, api_key, route=PACKET_API_ROUTE, outbox=None, index=None, in_logger=None):
+        self.api_key = api_key
+        self.route = route
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.index = index
+        self.stopping = multiprocessing.Value("b", False)
+        self.proc = None
+        if in_logger:
+            global logger
+            logger = in_logger
+
+    def start(self):
+        """ Spawns the process which sends packets from the outbox to the API """
+        self.proc = multiprocessing.Process(target=self.publish_worker,
+                                            args=(self.outbox, self.route, self.api_key, self.stopping, self.index))
+        self.proc.start()
+
+    def stop(self):
+        self.stopping.value = True
+
+    def submit(self, batch, station_name, payloads):
+        """ Queues the given packet payloads (see packet_payload) from one job for submission """
+        if len(payloads) > 0:
+            self.outbox.add(batch, station_name, payloads)
+        return len(payloads)
+
+    @staticmethod
+    def new_session():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def send(session, outbox, route, api_key, entry, index=None):
+        """ Posts one outbox entry to the API and records the outcome, and the packet in the given
+        PacketIndex if it was published. Returns whether it was """
+        station_name = entry["station_name"]
+        try:
+            jsn = json.loads(entry["payload"])
+            jsn["secret"] = api_key
+            with metrics.publish_duration.time():
+                r = session.post(route, json=jsn, timeout=HTTP_TIMEOUT_S)
+        except requests.exceptions.RequestException as ex:
+            logger.warning("[%s] couldn't submit packet (attempt %d): %s", station_name, entry["attempts"] + 1, ex)
+            outbox.retry(entry["id"], entry["attempts"], error=str(ex))
+            return False
+        except Exception as ex:
+            # e.g. a payload that can't be decoded or encoded; it's retried like any other failure
+            # (in case the cause was transient), so it expires after MAX_ATTEMPTS rather than blocking the outbox
+            logger.error("[%s] error submitting packet (attempt %d)", station_name, entry["attempts"] + 1)
+            logger.exception(ex)
+            outbox.retry(entry["id"], entry["attempts"], error=repr(ex))
+            return False
+
+        if r.status_code == requests.codes.ok or r.status_code == 201:
+            logger.info("[%s] submitted %spacket successfully" %
+                        (station_name, "duplicate " if r.status_code == 201 else ""))
+            del jsn["secret"] # remove hidden info
+            logger.debug("Full POST request:\n%s", jsn)
+            outbox.finish(entry["id"], DUPLICATE if r.status_code == 201 else SENT, r.status_code)
+            if index is not None:
+                try:
+                    index.add(jsn["corrected"], jsn["rx_time"] / 1000.0, jsn["station_name"])
+                except Exception as ex:
+                    # it's published either way; another job with it may just post it again
+                    logger.error("[%s] couldn't record packet in the index", station_name)
+                    logger.exception(ex)
+            return True
+        elif r.status_code in RETRY_STATUS_CODES:
+            logger.warning("[%s] couldn't submit packet (%d, attempt %d): %s" %
+                           (station_name, r.status_code, entry["attempts"] + 1, r.text))
+            outbox.retry(entry["id"], entry["attempts"], r.status_code, r.text)
+            return False
+        else:
+            logger.warning("[%s] couldn't submit packet (%d): %s" % (station_name, r.status_code, r.text))
+            outbox.finish(entry["id"], REJECTED, r.status_code, r.text)
+            return False
+
+    @staticmethod
+    def drain(session, outbox, route, api_key, index=None):
+        """ Sends every entry that's currently due. Returns the number of entries attempted """
+        attempted = 0
+        entries = outbox.due()
+        while len(entries) > 0:
+            for entry in entries:
+                PacketPublisher.send(session, outbox, route, api_key, entry, index)
+            attempted += len(entries)
+            entries = outbox.due()
+        return attempted
+
+    @staticmethod
+    def publish_worker(outbox, route, api_key, stopping, index=None):
+        session = PacketPublisher.new_session()
+        while not stopping.value:
+            try:
+                if PacketPublisher.drain(session, outbox, route, api_key, index) == 0:
+                    time.sleep(PUBLISH_POLL_PERIOD)
+            except Exception as ex:
+                logger.error("Exception in publisher worker")
+                logger.exception(ex)
+                time.sleep(PUBLISH_POLL_PERIOD)
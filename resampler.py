@@ -0,0 +1,81 @@
+""" Streaming polyphase resampling by a rational factor up/down, used to bring uploads to one sample
+rate when converting them (see audio_utils.convert_audiofile). The anti-aliasing filter (a Kaiser
+windowed sinc at the upsampled rate) is split into up phases of a few taps each, so every output
+sample costs one short dot product whatever the factor; all the outputs of a block are computed at
+once by gathering their taps and input samples into two matrices. Filters are designed once per
+factor and kept. """
+from fractions import Fraction
+import numpy
+
+HALF_TAPS = 10 # input samples either side of each output sample, at the lower of the two rates
+KAISER_BETA = 5.0
+
+_filters = {}
+
+def design_filter(up, down):
+    """ Returns the polyphase filter bank for resampling by up/down, as an (up, taps per phase) array
+    whose row p holds the taps applied to the input samples at and before an output sample of phase
+    p, and the filter's delay in output samples """
+    half_len = HALF_TAPS * max(up, down)
+    half_len += -half_len % down # so the delay is a whole number of output samples
+    if (up, down) not in _filters:
+        cutoff = 1.0 / max(up, down) # relative to the Nyquist frequency at the upsampled rate
+        n = numpy.arange(2 * half_len + 1) - half_len
+        taps = up * cutoff * numpy.sinc(cutoff * n) * numpy.kaiser(len(n), KAISER_BETA)
+        ntaps = -(-len(taps) // up)
+        bank = numpy.zeros(ntaps * up)
+        bank[:len(taps)] = taps
+        _filters[(up, down)] = bank.reshape(ntaps, up).T.astype(numpy.float32)
+    return _filters[(up, down)], half_len // down
+
+class Resampler:
+    """ Resamples a stream of mono float samples, given block by block, from in_rate to out_rate """
+
+    def __init__(self, in_rate, out_rate):
+        ratio = Fraction(int(out_rate), int(in_rate))
+        self.up, self.down = ratio.numerator, ratio.denominator
+        self.bank, self.delay = design_filter(self.up, self.down)
+        ntaps = self.bank.shape[1]
+        self.history = numpy.zeros(ntaps - 1, dtype=numpy.float32) # the input before the block, zeros at first
+        self.history_start = -(ntaps - 1) # input index of history[0]
+        self.next_out = 0 # index of the next output, counting the filter's delay
+        self.nin = 0
+        self.nout = 0
+
+    def _filter(self, samples):
+        ext = numpy.concatenate([self.history, samples.astype(numpy.float32)])
+        last = self.history_start + len(ext) - 1
+        # outputs whose newest input sample (at or before out*down/up) has been given
+        stop = ((last + 1) * self.up - 1) // self.down + 1
+        outputs = numpy.arange(self.next_out, max(self.next_out, stop))
+        positions = outputs * self.down
+        newest = positions // self.up - self.history_start
+        ntaps = self.bank.shape[1]
+        gathered = ext[newest[:, None] - numpy.arange(ntaps)[None, :]]
+        out = numpy.einsum("ij,ij->i", gathered, self.bank[positions % self.up])
+
+        keep = len(ext) - (ntaps - 1)
+        self.history = ext[keep:]
+        self.history_start += keep
+        self.next_out += len(outputs)
+        # the first delay outputs are the filter filling up
+        skip = max(0, self.delay - (self.next_out - len(outputs)))
+        return out[skip:]
+
+    def process(self, samples):
+        """ Returns the resampled output available after the given samples """
+        self.nin += len(samples)
+        out = self._filter(samples)
+        self.nout += len(out)
+        return out
+
+    def flush(self):
+        """ Returns the rest of the output, once all the input has been given: ceil(nin * up / down)
+        samples in all """
+        total = -(-self.nin * self.up // self.down)
+        # the newest input sample the last output needs, past the end of the input if need be
+        newest = ((total - 1 + self.delay) * self.down) // self.up
+        padding = max(0, newest - (self.history_start + len(self.history) - 1))
+        out = self._filter(numpy.zeros(padding, dtype=numpy.float32))[:max(0, total - self.nout)]
+        self.nout += len(out)
+        return out
@@ -0,0 +1,44 @@
+""" Cache of decode results, so the same audio (or the same slice of a SatNOGS observation)
+isn't demodulated twice. Results are keyed both by a hash of the converted PCM samples plus the
+demod parameters, and by (obs_id, start_s, stop_s) plus the demod parameters for SatNOGS jobs,
+which lets those skip fetching and converting the audio too. """
+import audio_utils
+from disk_cache import DiskCache
+import pickle
+
+RESULT_CACHE_FOLDER = "data/result_cache"
+RESULT_CACHE_MAX_BYTES = 50e6
+# the job args filled in by the ingest stages which a cached SatNOGS result has to restore
+CACHED_ARGS = ["rx_time", "station_name"]
+
+class ResultCache:
+    def __init__(self, folder=RESULT_CACHE_FOLDER, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.cache = DiskCache(folder, max_bytes)
+
+    @staticmethod
+    def obs_key(args, demod_params):
+        """ The key for a SatNOGS job, or None for other jobs """
+        if not args or not args.get("satnogs"):
+            return None
+        return "obs:%s:%s:%s:%s" % (args["obs_id"], args["start_s"], args["stop_s"], demod_params)
+
+    @staticmethod
+    def audio_key(wavfilename, demod_params, frames=None):
+        """ The key for the given wav file, or only its frames [start_i, stop_i) if frames is given """
+        return "pcm:%s:%s" % (audio_utils.hash_audiofile(wavfilename, frames), demod_params)
+
+    def get(self, key):
+        """ Returns the cached (packets, args) for key, or None """
+        if key is None:
+            return None
+        data = self.cache.get(key)
+        return pickle.loads(data) if data is not None else None
+
+    def put(self, keys, packets, args):
+        data = pickle.dumps((packets, dict((name, args.get(name)) for name in CACHED_ARGS)), 2)
+        for key in keys:
+            if key is not None:
+                self.cache.put(key, data)
+
+    def stats(self):
+        return self.cache.stats()
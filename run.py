@@ -2,11 +2,19 @@
 from gevent.pywsgi import WSGIServer
 from server import app
 from server import start_decoder
+from server import start_publisher
+from server import start_mailer
 import logging
 
 # start decoder worker process
 start_decoder()
 
+# start packet publisher process
+start_publisher()
+
+# start email delivery process
+start_mailer()
+
 # setup logging
 app.logger.setLevel(logging.DEBUG)
 
@@ -0,0 +1,165 @@
+""" Client for the SatNOGS network website: scrapes observation pages for their metadata and downloads
+observation audio. Requests go through a pooled HTTP session (one per process), parsed metadata is
+cached for a while and audio files are cached by observation ID, both on disk so the server and all
+decoder workers share them. Repeated requests for one observation therefore don't hit the network. """
+from bs4 import BeautifulSoup, SoupStrainer
+import datetime
+from disk_cache import DiskCache
+import logging
+import os
+import pickle
+import requests
+import shutil
+import threading
+import time
+
+SATNOGS_BASE_URL = "https://network.satnogs.org"
+SATNOGS_CACHE_FOLDER = "data/satnogs_cache"
+AUDIO_CACHE_MAX_BYTES = 500e6
+METADATA_CACHE_MAX_BYTES = 5e6
+METADATA_TTL_S = 60*60
+# observations without audio yet (or not found) may still be updated, so don't trust them for long
+INCOMPLETE_METADATA_TTL_S = 60
+HTTP_TIMEOUT_S = 30
+HTTP_POOL_SIZE = 4
+HTTP_RETRIES = 2
+DOWNLOAD_CHUNK_B = 64*1024
+
+class SatnogsClient:
+    def __init__(self, base_url=SATNOGS_BASE_URL, cache_folder=SATNOGS_CACHE_FOLDER, logger=logging):
+        self.base_url = base_url.rstrip("/")
+        self.cache_folder = cache_folder
+        self.logger = logger
+        self.metadata_cache = DiskCache(os.path.join(cache_folder, "metadata"), METADATA_CACHE_MAX_BYTES)
+        self.audio_cache = DiskCache(os.path.join(cache_folder, "audio"), AUDIO_CACHE_MAX_BYTES)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # sessions can't be shared between processes
+        return {"base_url": self.base_url, "cache_folder": self.cache_folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["base_url"], state["cache_folder"])
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None or self._local.pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                                    max_retries=HTTP_RETRIES)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+            self._local.pid = os.getpid()
+        return session
+
+    def observation_url(self, obs_id):
+        return "%s/observations/%s" % (self.base_url, obs_id)
+
+    def get_metadata(self, obs_id):
+        """ Returns a dict with the status, station_name, start_time and audio_url (or None)
+        of the given observation, or None if it wasn't found or its page couldn't be parsed """
+        key = "meta:%s" % obs_id
+        cached = self.metadata_cache.get(key)
+        if cached is not None:
+            expires, obs_data = pickle.loads(cached)
+            if time.time() < expires:
+                return obs_data
+
+        obs_data = self.scrape_metadata(obs_id)
+        complete = obs_data is not None and obs_data["audio_url"] is not None
+        ttl = METADATA_TTL_S if complete else INCOMPLETE_METADATA_TTL_S
+        self.metadata_cache.put(key, pickle.dumps((time.time() + ttl, obs_data), 2))
+        return obs_data
+
+    def scrape_metadata(self, obs_id):
+        """ Fetches and parses the page of the given observation, bypassing the cache """
+        page = self._session().get(self.observation_url(obs_id), timeout=HTTP_TIMEOUT_S)
+
+        if page.status_code == 404:
+            # no observation found
+            return None
+        else:
+            # only the side column rows are used, so don't build a tree for the rest of the page
+            soup = BeautifulSoup(page.text, 'html.parser', parse_only=SoupStrainer(attrs={"class":"front-line"}))
+
+            try:
+                # get side column
+                side_col_rows = soup.find_all(attrs={"class":"front-line"})
+
+                # extract status
+                # <span class ="label label-xs label-good" aria-hidden="true" data-toggle="tooltip" data-placement="right" title=""
+                # data-original-title="Vetted good on 2019-01-07 00:16:28 by Brown Space Engineering">Good</span>
+                status_span = side_col_rows[3].findChildren()[2] # findChildren returns flat list of all nested children
+                status = status_span.text.lower()
+
+                # extract station name
+                # <a href="/stations/291/">
+                #   291 - COSPAR 8049
+                # </a>
+                full_station_name = side_col_rows[1].a.text
+                dash_i = full_station_name.index("-")
+                station_name = full_station_name[dash_i+1:].strip()
+
+                # extract and convert observation start time
+                start_time_span = side_col_rows[7].findChildren()[2]
+                start_time_str = start_time_span.contents[1].text + "T" + start_time_span.contents[3].text
+                start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%dT%H:%M:%S")
+
+                # extract URL of audio file
+                # <a href="/media/data_obs/399165/satnogs_399165_2019-01-07T00-01-01.ogg" target="_blank" download="">
+                #     <button type="button" class="btn btn-default btn-xs" >
+                #         <span class ="glyphicon glyphicon-download"></span>
+                #         Audio
+                #     </button>
+                # </a>
+                if len(side_col_rows) < 15:
+                    audio_url = None
+                else:
+                    first_a = side_col_rows[14].a
+                    # check if the icon exists and if it's the audio one
+                    if first_a is None or first_a["href"].find(".ogg") == -1:
+                        audio_url = None
+                    else:
+                        audio_url = str(self.base_url + first_a["href"])
+
+                return {
+                    "status": str(status),
+                    "station_name": str(station_name),
+                    "start_time": start_time,
+                    "audio_url": audio_url
+                }
+
+            except (IndexError, ValueError, AttributeError) as ex:
+                self.logger.error("Error while parsing SatNOGS station page for observation %s", obs_id)
+                self.logger.exception(ex)
+                return None
+
+    def fetch_audio(self, obs_id, audio_url, filename):
+        """ Saves the audio file of the given observation to filename, from the cache if possible """
+        key = "audio:%s" % obs_id
+        cached_path = self.audio_cache.get_file(key)
+        if cached_path is not None:
+            try:
+                shutil.copyfile(cached_path, filename)
+                return
+            except IOError: # evicted in the meantime
+                pass
+
+        self.download(audio_url, filename)
+        self.audio_cache.put_file(key, filename)
+
+    def download(self, url, filename):
+        """ Streams the file at url to filename """
+        tmpfilename = filename + ".part"
+        try:
+            with self._session().get(url, stream=True, timeout=HTTP_TIMEOUT_S) as response:
+                response.raise_for_status()
+                with open(tmpfilename, "wb") as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_B):
+                        f.write(chunk)
+        except:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+        os.rename(tmpfilename, filename)
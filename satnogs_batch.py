@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Submits a batch of SatNOGS observations to a decode server (see server.decode_satnogs_batch) and
+prints the result of each observation as it finishes, then a summary of the batch.
+
+usage: python satnogs_batch.py --token TOKEN --email you@example.com [--server URL] [--submit-to-db]
+    [--post-publicly] [--json] 1200-1250 1300 ...
+"""
+import argparse
+import json
+import requests
+import sys
+
+DEFAULT_SERVER = "http://localhost:5000"
+TIMEOUT_S = 60 # to connect and between streamed results (the server polls every second)
+
+def print_result(result):
+    if "batch_id" in result:
+        print("batch %(batch_id)s: %(finished)d/%(observations)d observations finished, %(decoded)d decoded, "
+              "%(with_packets)d with packets; %(corrected_packets)d corrected packets (%(raw_packets)d raw), "
+              "%(published)d published" % result)
+    elif result["error"] is not None:
+        print("%s: %s" % (result["station_name"], result["error_title"] or result["error"]))
+    else:
+        shared = len([stations for stations in result.get("also_received_by", []) if stations])
+        print("%s: %d corrected packets (%d raw), %d published, %d also received by other stations" %
+              (result["station_name"], len(result["corrected_packets"]), result["raw_packets"], result["published"], shared))
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a batch of SatNOGS observations")
+    parser.add_argument("obs_ids", nargs="+", help="observation IDs and ranges of them, like 1200-1250")
+    parser.add_argument("--server", default=DEFAULT_SERVER)
+    parser.add_argument("--token", required=True, help="the server's batch_token")
+    parser.add_argument("--email", required=True, help="where to send the batch's report")
+    parser.add_argument("--submit-to-db", action="store_true")
+    parser.add_argument("--post-publicly", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print results as lines of JSON")
+    options = parser.parse_args()
+
+    form = {"token": options.token, "email": options.email, "obs_ids": " ".join(options.obs_ids)}
+    if options.submit_to_db:
+        form["submit_to_db"] = "on"
+    if options.post_publicly:
+        form["post_publicly"] = "on"
+    response = requests.post(options.server.rstrip("/") + "/decode_satnogs_batch", data=form, timeout=TIMEOUT_S)
+    if response.status_code != 202:
+        try:
+            error = response.json()["error"]
+        except ValueError:
+            error = "HTTP %d" % response.status_code
+        parser.exit(1, "couldn't submit the batch: %s\n" % error)
+    batch = response.json()
+    if not options.json:
+        print("submitted batch %(batch_id)s of %(observations)d observations" % batch)
+
+    results = requests.get(options.server.rstrip("/") + batch["results_url"], stream=True, timeout=TIMEOUT_S)
+    for line in results.iter_lines():
+        if not line:
+            continue
+        if options.json:
+            print(line.decode("utf-8"))
+            sys.stdout.flush()
+        else:
+            print_result(json.loads(line.decode("utf-8")))
+
+if __name__ == "__main__":
+    main()
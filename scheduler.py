@@ -0,0 +1,99 @@
+""" Decides which queued decode job a free worker takes next (see JobStore.claim), so that one
+submitter uploading many long recordings can't hold up everyone else. Jobs are shared out fairly
+between submitters (identified by a keyed hash of their email, or station name without one, so the
+job store doesn't hold addresses): the submitter with the fewest
+running jobs, then the least audio decoded recently, goes next, and within a submitter the shortest
+clip goes first. Jobs which have waited too long go first regardless, so long clips aren't starved.
+Also has the per-submitter cap on queued audio and the wait-time statistics by clip length. """
+import hashlib
+import hmac
+
+FAIRNESS_WINDOW_S = 15*60 # how far back audio decoded for a submitter counts against them
+STARVATION_WAIT_S = 10*60
+UNKNOWN_DURATION_S = 480 # assumed for jobs whose duration isn't known yet (e.g. SatNOGS observations)
+MAX_QUEUED_AUDIO_S = 4*480 # per submitter, counting queued and running jobs
+WAIT_PERCENTILES = [50, 90, 99]
+SUBMITTER_SECRET = "" # keys the hashes submitters are identified by; set by the server from its config
+
+# clip length classes, as (name, longest duration); the last catches everything longer
+CLIP_CLASSES = [
+    ("short", 60),
+    ("medium", 240),
+    ("long", None),
+]
+
+def submitter_key(args):
+    """ The identity jobs are shared out by: a hash of the submitter's email, or the station name without one """
+    args = args or {}
+    identity = (args.get("email") or "").strip().lower() or (args.get("station_name") or "").strip()
+    return hash_submitter(identity) if identity != "" else None
+
+def hash_submitter(identity):
+    return hmac.new(SUBMITTER_SECRET.encode("utf-8"), identity.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+def submitter_label(submitter):
+    """ A stable but anonymous name for a submitter, for logs and stats """
+    if submitter is None:
+        return "anonymous"
+    return "submitter-%s" % hashlib.sha1(submitter.encode("utf-8")).hexdigest()[:8]
+
+def job_duration(duration):
+    return UNKNOWN_DURATION_S if duration is None else duration
+
+def clip_class(duration):
+    for name, longest in CLIP_CLASSES:
+        if longest is None or job_duration(duration) <= longest:
+            return name
+
+def pick_job(oldest, heads, queued, running, served, now):
+    """ Chooses the next job to run. Jobs are given as (id, submitter, duration, submitted) tuples:
+    oldest is the job that has waited longest (or None if nothing is queued), and heads has each waiting
+    submitter's shortest (then oldest) job. queued, running and served map submitters to their number of
+    queued and running jobs and audio seconds decoded in the last FAIRNESS_WINDOW_S.
+    Returns the chosen job ID and the reason it was chosen, or (None, None) if nothing is queued """
+    if oldest is None:
+        return None, None
+    if now - oldest[3] >= STARVATION_WAIT_S:
+        return oldest[0], "waited %ds" % (now - oldest[3])
+
+    def fair_share(head):
+        return running.get(head[1], 0), served.get(head[1]) or 0, job_duration(head[2]), head[3]
+
+    job = min(heads, key=fair_share)
+    submitter = job[1]
+    reason = "fair share among %d submitters (%s: %d running, %ds decoded recently); shortest %s clip of its %d queued" % (
+        len(heads), submitter_label(submitter), running.get(submitter, 0), served.get(submitter) or 0,
+        clip_class(job[2]), queued.get(submitter, 0))
+    return job[0], reason
+
+def percentile(values, p):
+    """ The nearest-rank pth percentile of a sorted list """
+    if len(values) == 0:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+def wait_stats(waits):
+    """ Summarizes (duration, wait_s) pairs as wait-time percentiles per clip class """
+    by_class = dict((name, []) for name, _ in CLIP_CLASSES)
+    for duration, wait in waits:
+        by_class[clip_class(duration)].append(wait)
+
+    stats = {}
+    for name, values in by_class.items():
+        values.sort()
+        stats[name] = {"count": len(values)}
+        for p in WAIT_PERCENTILES:
+            stats[name]["p%d_wait_s" % p] = percentile(values, p)
+    return stats
+
+def queue_summary(queued, now):
+    """ Summarizes queued jobs, given as (submitter, duration, submitted) tuples, by clip class """
+    summary = dict((name, {"jobs": 0, "audio_s": 0, "oldest_wait_s": 0}) for name, _ in CLIP_CLASSES)
+    for submitter, duration, submitted in queued:
+        stats = summary[clip_class(duration)]
+        stats["jobs"] += 1
+        stats["audio_s"] += job_duration(duration)
+        stats["oldest_wait_s"] = max(stats["oldest_wait_s"], now - submitted)
+    summary["submitters"] = len(set(job[0] for job in queued))
+    return summary
@@ -1,16 +1,29 @@
 #!/usr/bin/python
-from flask import request, Flask, render_template
+from flask import request, Flask, Response, render_template, jsonify, url_for, make_response, stream_with_context
 from werkzeug.utils import secure_filename
-import requests
 import yaml
 import os
-import yagmail
 from yagmail import validate
 from yagmail.error import YagInvalidEmailAddress
 import datetime
+import gevent
+import json
 import logging
-import urllib
-from bs4 import BeautifulSoup
+import math
+import time
+import uuid
+import admission
+import audio_utils
+import pipeline
+from pipeline import StageError
+import jobstore
+import metrics
+import scheduler
+from satnogs import SatnogsClient, SATNOGS_BASE_URL
+from result_cache import ResultCache
+from publisher import PacketPublisher, packet_payload
+from packet_index import PacketIndex
+from mailer import Mailer, SMTP_HOST
 
 import config
 if config.decoder_enabled:
@@ -20,24 +33,56 @@ else:
     from fake_decoder import DecoderQueue
 
 # config
-NUM_DECODER_PROCESSES = 2
+MIN_DECODER_WORKERS = 1
+MAX_DECODER_WORKERS = None # defaults to what the cores allow (see supervisor.py)
 AUDIO_UPLOAD_FOLDER = 'wav_uploads/'
 MAX_AUDIOFILE_DURATION_S = 480
 MAX_AUDIOFILE_SIZE_B = 20e6 # set in nginx config for production server
-PACKET_API_ROUTE = "http://api.brownspace.org/equisat/receive/raw"
+MAX_QUEUED_AUDIO_S = getattr(config, "max_queued_audio_s", scheduler.MAX_QUEUED_AUDIO_S) # per submitter
+MAX_BACKLOG_AUDIO_S = getattr(config, "max_backlog_audio_s", 50*MAX_AUDIOFILE_DURATION_S) # everyone's queued and running jobs
+CLIENT_AUDIO_S_PER_HOUR = getattr(config, "client_audio_s_per_hour", 4*MAX_AUDIOFILE_DURATION_S) # per IP address and per submitter
+CLIENT_BURST_AUDIO_S = getattr(config, "client_burst_audio_s", 4*MAX_AUDIOFILE_DURATION_S)
+TRUSTED_PROXIES = ("127.0.0.1", "::1") # whose X-Real-IP header gives the client's address (see decoder.brownspace.org.conf)
+DRAIN_RATE_WINDOW_S = 60*60
+BATCH_TOKEN = getattr(config, "batch_token", None) # required to submit batches of SatNOGS observations; None disables them
+BATCH_PARALLELISM = getattr(config, "batch_parallelism", 4) # observations of a batch queued or running at once
+MAX_BATCH_OBSERVATIONS = 1000
+BATCH_POLL_S = 1
+BATCH_STREAM_TIMEOUT_S = 60*60 # after which a batch's results stream ends with a summary so far
+MAX_BATCH_OBSERVATION_S = 30*60 # longer than any pass; batch observations are otherwise decoded whole
+MIN_DRAIN_AUDIO_S_PER_S = 1.0 # assumed decoding rate for wait estimates when little has been decoded lately
+SCHEDULER_STATS_WINDOW_S = 60*60
+SCHEDULER_RECENT_DECISIONS = 20
+
+# keys the hashes submitters are recorded under in the job store (see scheduler.submitter_key)
+scheduler.SUBMITTER_SECRET = getattr(config, "submitter_secret", config.api_key)
 
 app = Flask(__name__)
-decoder = DecoderQueue(in_logger=app.logger)
+job_store = jobstore.JobStore()
+result_cache = ResultCache()
+satnogs = SatnogsClient(getattr(config, "satnogs_base_url", SATNOGS_BASE_URL), logger=app.logger)
+decoder = DecoderQueue(in_logger=app.logger, store=job_store, cache=result_cache)
+packet_index = PacketIndex()
+publisher = PacketPublisher(config.api_key, index=packet_index, in_logger=app.logger)
+# created before the decoder workers are forked, so they share them (see admission.py)
+ip_buckets = admission.TokenBuckets(CLIENT_AUDIO_S_PER_HOUR / 3600.0, CLIENT_BURST_AUDIO_S)
+submitter_buckets = admission.TokenBuckets(CLIENT_AUDIO_S_PER_HOUR / 3600.0, CLIENT_BURST_AUDIO_S)
 
 # limit upload file size
 app.logger.setLevel(logging.DEBUG)
 
 # setup email
-if hasattr(config, "gmail_user") and hasattr(config, "gmail_user"):
-    yag = yagmail.SMTP(config.gmail_user, config.gmail_pass)
+if hasattr(config, "gmail_user") and hasattr(config, "gmail_pass"):
+    mailer = Mailer(config.gmail_user, config.gmail_pass,
+                    host=getattr(config, "smtp_host", SMTP_HOST),
+                    port=getattr(config, "smtp_port", None),
+                    ssl=getattr(config, "smtp_ssl", True),
+                    starttls=getattr(config, "smtp_starttls", None),
+                    skip_login=getattr(config, "smtp_skip_login", False),
+                    in_logger=app.logger)
 else:
     app.logger.warning("incomplete config.py; will not send emails")
-    yag = None
+    mailer = None
 
 @app.route('/')
 def root():
@@ -55,6 +100,11 @@ def page_not_found(e):
 
 @app.route('/decode_file', methods=["POST"])
 def decode_file():
+    # turn away clients over their limit before reading the upload
+    rejection = check_client()
+    if rejection is not None:
+        return rejection
+
     # initial validation
     valid, ret = validate_email(request.form["email"])
     if not valid:
@@ -88,45 +138,142 @@ def decode_file():
         title = "No audio file provided"
         message = "Please make sure to upload an audio file using the form."
     else:
-        # convert audio file to WAV and get metadata for filtering
-        wavfilename, sample_rate, duration, _ = decoder.convert_audiofile(filename)
-        # remove original file now, unless it was originally a wav
-        if filename != wavfilename:
+        # check the duration from the file header before spending time on converting it
+        info = decoder.probe_audiofile(filename)
+        if info is not None and info.duration > MAX_AUDIOFILE_DURATION_S:
+            app.logger.debug("rejected %s before conversion; duration %ds", filename, info.duration)
             os.remove(filename)
+            return render_template("decode_submit.html", title="Audio file too long", message=too_long_message(info.duration))
 
-        if wavfilename is None:
-            title = "Audio file conversion failed"
-            message = "We need to convert your audio file to a 16-bit PCM WAV file, but the conversion failed. " \
-                      "Make sure your audio file format is supported by libsndfile (see link on main page)." \
-                      "You can also try converting the file yourself using a program such as Audacity or ffmpeg."
-        elif duration > MAX_AUDIOFILE_DURATION_S:
-            title = "Audio file too long"
-            message = "Your submitted file was too long (maximum duration is %ds, yours was %ds). " \
-                      "You can try shortening the audio duration using a program such as Audacity." % (MAX_AUDIOFILE_DURATION_S, duration)
-            # remove the unused file
-            os.remove(wavfilename)
+        args = {
+            "email": request.form["email"],
+            "rx_time": rx_time,
+            "station_name": request.form["station_name"],
+            "submit_to_db": request.form.has_key("submit_to_db") or request.form.has_key("post_publicly"), # submit to db is prereq
+            "post_publicly": request.form.has_key("post_publicly"),
+            "satnogs": False,
+            "obs_id": None,
+            "client_ip": client_ip()
+        }
+        duration = info.duration if info is not None else None
+        rejection = check_admission(args, duration)
+        if rejection is not None:
+            os.remove(filename)
+            return rejection
+
+        app.logger.info("[%s] submitting FILE decode request; rx_time: %s, submit_to_db: %s, post_publicly: %s, filename: %s",
+                        request.form["station_name"], rx_time, request.form.has_key("submit_to_db"), request.form.has_key("post_publicly"), filename)
+
+        # conversion happens in the decoder workers so the server can respond right away
+        job_id = decoder.submit(filename, on_complete_decoding, args, stages=[convert_stage], duration=duration)
+
+        title = "Audio file submitted successfully!"
+        message = "Your file is queued to be decoded. You should be receiving an email shortly (even if there were no results). "
+        if request.form.has_key("submit_to_db"):
+            message += "Thank you so much for your help in providing us data on EQUiSat!"
         else:
-            app.logger.info("[%s] submitting FILE decode request; rx_time: %s, submit_to_db: %s, post_publicly: %s, wavfilename: %s",
-                            request.form["station_name"], rx_time, request.form.has_key("submit_to_db"), request.form.has_key("post_publicly"), wavfilename)
-
-            title = "Audio file submitted successfully!"
-            decoder.submit(wavfilename, on_complete_decoding, args={
-                "email": request.form["email"],
-                "rx_time": rx_time,
-                "station_name": request.form["station_name"],
-                "submit_to_db": request.form.has_key("submit_to_db") or request.form.has_key("post_publicly"), # submit to db is prereq
-                "post_publicly": request.form.has_key("post_publicly"),
-                "satnogs": False,
-                "obs_id": None
-            })
-            message = "Your file is queued to be decoded. You should be receiving an email shortly (even if there were no results). "
-            if request.form.has_key("submit_to_db"):
-                message += "Thank you so much for your help in providing us data on EQUiSat!"
-            else:
-                message += "Thank you for your interest in EQUiSat!"
+            message += "Thank you for your interest in EQUiSat!"
+        return render_template("decode_submit.html", title=title, message=message, job_id=job_id)
 
     return render_template("decode_submit.html", title=title, message=message)
 
+def too_long_message(duration):
+    return "Your submitted file was too long (maximum duration is %ds, yours was %ds). " \
+           "You can try shortening the audio duration using a program such as Audacity." % (MAX_AUDIOFILE_DURATION_S, duration)
+
+def client_ip():
+    """ The client's address, which the proxy in front of the server passes on in X-Real-IP """
+    if request.remote_addr in TRUSTED_PROXIES:
+        return request.headers.get("X-Real-IP", request.remote_addr)
+    return request.remote_addr
+
+def check_client():
+    """ Returns a 429 response if the client's IP address has used up its audio allowance or the
+    backlog is full, or None otherwise. Doesn't read the request body, so it's cheap to run first """
+    ip = client_ip()
+    wait_s = ip_buckets.wait_s(ip)
+    if wait_s > 0:
+        app.logger.info("rejected request from %s; over its rate limit for %ds", ip, wait_s)
+        return too_many_requests("client", "Too many submissions",
+                                 "A lot of audio has been submitted from your address recently.", wait_s)
+    return check_backlog(0)
+
+def check_backlog(audio_s):
+    """ Returns a 429 response if audio_s more seconds of audio would take the backlog of everyone's
+    queued and running jobs over MAX_BACKLOG_AUDIO_S, or None otherwise """
+    backlog_s = job_store.backlog_audio_s()
+    if backlog_s + audio_s <= MAX_BACKLOG_AUDIO_S:
+        return None
+
+    app.logger.warning("rejected submission; %ds of audio already queued", backlog_s)
+    return too_many_requests("backlog", "The decoder is too busy",
+                             "There's already as much audio waiting to be decoded as we can queue.",
+                             drain_wait_s(backlog_s + audio_s - MAX_BACKLOG_AUDIO_S))
+
+def check_admission(args, duration):
+    """ Returns a 429 response if the submitter has used up its audio allowance, already has
+    MAX_QUEUED_AUDIO_S of audio waiting to be decoded (counting this submission of the given duration)
+    or the backlog would be full, or None otherwise, in which case the client's and submitter's
+    buckets are charged for the submission """
+    submitter = scheduler.submitter_key(args)
+    audio_s = scheduler.job_duration(duration)
+    wait_s = submitter_buckets.wait_s(submitter)
+    if wait_s > 0:
+        app.logger.info("rejected submission from %s; over its rate limit for %ds", scheduler.submitter_label(submitter), wait_s)
+        return too_many_requests("submitter", "Too many submissions", "You've submitted a lot of audio recently.", wait_s)
+
+    queued_s = job_store.queued_audio_s(submitter)
+    if queued_s + audio_s > MAX_QUEUED_AUDIO_S:
+        app.logger.info("rejected submission from %s; %ds of audio already queued",
+                        scheduler.submitter_label(submitter), queued_s)
+        return too_many_requests("queued", "Too many submissions waiting",
+                                 "You already have %d seconds of audio waiting to be decoded (the limit is %ds per person)."
+                                 % (queued_s, MAX_QUEUED_AUDIO_S), drain_wait_s(queued_s + audio_s - MAX_QUEUED_AUDIO_S))
+
+    rejection = check_backlog(audio_s)
+    if rejection is not None:
+        return rejection
+
+    ip_buckets.charge(args["client_ip"], audio_s)
+    submitter_buckets.charge(submitter, audio_s)
+    args["charged_audio_s"] = audio_s
+    return None
+
+def refund_audio(args, audio_s):
+    """ Gives the client and submitter back audio seconds they were charged for but didn't submit """
+    if audio_s > 0:
+        ip_buckets.refund(args.get("client_ip"), audio_s)
+        submitter_buckets.refund(scheduler.submitter_key(args), audio_s)
+
+def settle_audio_charge(args, duration):
+    """ Refunds what the submission was charged (see check_admission) beyond the duration of audio
+    it turned out to have, e.g. the default it was charged if its duration couldn't be probed """
+    charged = args.get("charged_audio_s")
+    if charged is not None and duration < charged:
+        refund_audio(args, charged - duration)
+        args["charged_audio_s"] = duration
+
+def drain_wait_s(audio_s):
+    """ Estimates how long the decoders will take to get through audio_s seconds of the backlog,
+    going by how much audio they finished over the last DRAIN_RATE_WINDOW_S """
+    rate = job_store.finished_audio_s(time.time() - DRAIN_RATE_WINDOW_S) / float(DRAIN_RATE_WINDOW_S)
+    return audio_s / max(rate, MIN_DRAIN_AUDIO_S_PER_S)
+
+def too_many_requests(reason, title, message, wait_s):
+    """ A 429 response with the given page, telling the client to retry after wait_s """
+    metrics.admission_rejections.inc(label=reason)
+    wait_s = max(1, int(math.ceil(wait_s)))
+    if wait_s < 120:
+        wait = "%d seconds" % wait_s
+    elif wait_s < 2*60*60:
+        wait = "about %d minutes" % round(wait_s / 60.0)
+    else:
+        wait = "about %d hours" % round(wait_s / 3600.0)
+    message += " Please try again in %s." % wait
+    response = make_response(render_template("decode_submit.html", title=title, message=message), 429)
+    response.headers["Retry-After"] = str(wait_s)
+    return response
+
 def save_audiofile():
     # check if the post request has the file part
     if 'audiofile' not in request.files:
@@ -149,6 +296,10 @@ def save_audiofile():
 
 @app.route('/decode_satnogs', methods=["POST"])
 def decode_satnogs():
+    rejection = check_client()
+    if rejection is not None:
+        return rejection
+
     # initial validation
     valid, ret = validate_email(request.form["email"])
     if not valid:
@@ -198,149 +349,337 @@ def decode_satnogs():
         message = "Your start time (%d) needs to be less than your stop time (%d)" % (start_s, stop_s)
         return render_template("decode_submit.html", title=title, message=message)
 
+    obs_id = request.form["obs_id"]
+    app.logger.info("Submitting SATNOGS decode request; obs_id: %s, time interval: [%ss, %ss], submit_to_db: %s, post_publicly: %s",
+                    obs_id, start_s, stop_s, request.form.has_key("submit_to_db"), request.form.has_key("post_publicly"))
+
+    args = {
+        "email": request.form["email"],
+        "rx_time": None,
+        "station_name": "SatNOGS observation #%s" % obs_id,
+        "submit_to_db": request.form.has_key("submit_to_db") or request.form.has_key("post_publicly"), # submit to db is prereq
+        "post_publicly": request.form.has_key("post_publicly"),
+        "satnogs": True,
+        "obs_id": obs_id,
+        "start_s": start_s,
+        "stop_s": stop_s,
+        "client_ip": client_ip()
+    }
+    # the observation's length isn't known until its audio is fetched, so go by the requested interval
+    duration = min(stop_s - start_s, MAX_AUDIOFILE_DURATION_S)
+    rejection = check_admission(args, duration)
+    if rejection is not None:
+        return rejection
+
+    # the observation metadata and audio are fetched, converted and sliced by the decoder workers
+    # (rx_time and station_name are filled in from the observation)
+    job_id = decoder.submit(None, on_complete_decoding, args, stages=[fetch_satnogs_stage, convert_stage, slice_stage],
+                            duration=duration)
+
+    title = "SatNOGS observation submitted successfully!"
+    message = "The observation is queued to be decoded. You should be receiving an email shortly (even if there were no results). "
+    if request.form.has_key("submit_to_db"):
+        message += "Thank you so much for your help in providing us data on EQUiSat!"
+    else:
+        message += "Thank you for your interest in EQUiSat!"
+
+    return render_template("decode_submit.html", title=title, message=message, job_id=job_id)
+
+## SatNOGS batches
+
+@app.route('/decode_satnogs_batch', methods=["POST"])
+def decode_satnogs_batch():
+    """ Decodes a list of SatNOGS observations (obs_ids: IDs and ranges like 1200-1250, separated by
+    commas or spaces), whole (up to MAX_BATCH_OBSERVATION_S), as one batch. Its observations are fetched, converted and demodulated
+    by the decoder workers BATCH_PARALLELISM at a time, results are streamed from /batches/<batch_id>
+    as they finish, and one email reports on all of them at the end. Needs the batch token """
+    if BATCH_TOKEN is None or request.form.get("token") != BATCH_TOKEN:
+        return jsonify(error="batches need a valid token"), 403
+
+    rejection = check_backlog(0)
+    if rejection is not None:
+        return rejection
+
+    valid, _ = validate_email(request.form["email"])
+    if not valid:
+        return jsonify(error="invalid email address"), 400
+    try:
+        obs_ids = parse_obs_ids(request.form["obs_ids"])
+    except ValueError as ex:
+        return jsonify(error=str(ex)), 400
+
+    args = {
+        "email": request.form["email"],
+        "submit_to_db": request.form.has_key("submit_to_db") or request.form.has_key("post_publicly"), # submit to db is prereq
+        "post_publicly": request.form.has_key("post_publicly"),
+    }
+    batch_id = uuid.uuid4().hex
+    job_store.create_batch(batch_id, args, obs_ids)
+    app.logger.info("Submitting SATNOGS batch %s of %d observations; submit_to_db: %s, post_publicly: %s",
+                    batch_id, len(obs_ids), args["submit_to_db"], args["post_publicly"])
+    feed_batch(batch_id)
+
+    return jsonify(batch_id=batch_id, observations=len(obs_ids),
+                   results_url=url_for("batch_results", batch_id=batch_id)), 202
+
+def parse_obs_ids(text):
+    """ Returns the observation IDs listed in the given text, in order and without repeats """
+    obs_ids = []
+    seen = set()
+    for part in text.replace(",", " ").split():
+        try:
+            if "-" in part:
+                first, last = [int(bound) for bound in part.split("-", 1)]
+                ids = range(first, last + 1)
+            else:
+                ids = [int(part)]
+        except ValueError:
+            raise ValueError("'%s' isn't an observation ID or a range of them" % part)
+        if len(ids) > MAX_BATCH_OBSERVATIONS:
+            raise ValueError("batches can have up to %d observations" % MAX_BATCH_OBSERVATIONS)
+        for obs_id in ids:
+            if obs_id >= 0 and str(obs_id) not in seen:
+                seen.add(str(obs_id))
+                obs_ids.append(str(obs_id))
+        if len(obs_ids) > MAX_BATCH_OBSERVATIONS:
+            raise ValueError("batches can have up to %d observations" % MAX_BATCH_OBSERVATIONS)
+
+    if len(obs_ids) == 0:
+        raise ValueError("no observation IDs given")
+    return obs_ids
+
+def feed_batch(batch_id):
+    """ Submits as many of the batch's waiting observations as keeps BATCH_PARALLELISM of them queued or
+    running. Called when the batch is submitted and as each observation finishes (by a decoder worker) """
+    obs_ids = job_store.take_batch_observations(batch_id, BATCH_PARALLELISM)
+    if len(obs_ids) == 0:
+        return
+    common_args = job_store.batch(batch_id)["args"]
+    for obs_id in obs_ids:
+        args = dict(common_args)
+        args.update({
+            "rx_time": None,
+            "station_name": "SatNOGS observation #%s" % obs_id,
+            "satnogs": True,
+            "obs_id": obs_id,
+            "start_s": 0,
+            "stop_s": None,
+            "batch_id": batch_id,
+        })
+        # the observation's length is only known once it's fetched, so this is an estimate
+        job_id = decoder.submit(None, on_complete_batch_decoding, args, stages=[fetch_satnogs_stage, convert_stage, slice_stage],
+                                duration=MAX_AUDIOFILE_DURATION_S)
+        job_store.set_batch_job(batch_id, obs_id, job_id)
+
+@app.route('/batches/<batch_id>')
+def batch_results(batch_id):
+    """ Streams the result of each observation of the batch as a line of JSON as it finishes,
+    followed by a line summarizing the whole batch once they all have, or once BATCH_STREAM_TIMEOUT_S
+    have passed (fetch it again for the rest; the results so far are streamed again first) """
+    if job_store.batch(batch_id) is None:
+        return jsonify(error="no such batch"), 404
+
+    def results():
+        sent = 0
+        deadline = time.time() + BATCH_STREAM_TIMEOUT_S
+        while True:
+            batch = job_store.batch(batch_id)
+            for obs in batch["observations"][sent:batch["finished"]]:
+                yield json.dumps(obs["result"]) + "\n"
+            sent = batch["finished"]
+            if sent == batch["total"] or time.time() >= deadline:
+                yield json.dumps(batch_summary(batch)) + "\n"
+                return
+            gevent.sleep(BATCH_POLL_S)
+
+    return Response(stream_with_context(results()), mimetype="application/x-ndjson")
+
+def batch_summary(batch):
+    results = [obs["result"] for obs in batch["observations"] if obs["result"] is not None]
+    return {
+        "batch_id": batch["id"],
+        "observations": batch["total"],
+        "finished": len(results),
+        "decoded": len([r for r in results if r["error"] is None]),
+        "with_packets": len([r for r in results if len(r["corrected_packets"]) > 0]),
+        "raw_packets": sum(r["raw_packets"] for r in results),
+        "corrected_packets": sum(len(r["corrected_packets"]) for r in results),
+        "published": sum(r["published"] for r in results),
+    }
+
+## Job status
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """ Shows the state, progress and results of a decode job, as JSON if requested
+    with ?format=json or an Accept header preferring it, and as a page otherwise """
+    job = job_store.get(job_id)
+    wants_json = request.args.get("format") == "json" or \
+                 request.accept_mimetypes.best_match(["application/json", "text/html"]) == "application/json"
+
+    if job is None:
+        if wants_json:
+            return jsonify(error="no such job"), 404
+        return render_template('error_page.html', error="Job not found",
+                               msg="We couldn't find a decode job with that ID. Make sure you copied the whole link."), 404
+
+    if wants_json:
+        return jsonify(job)
+    return render_template("job_status.html", job=job, finished=job["state"] in jobstore.FINISHED_STATES,
+                           json_url=url_for("job_status", job_id=job_id, format="json"))
+
+@app.route('/stats/cache')
+def cache_stats():
+    """ Hit/miss counters and size of the decode result cache """
+    return jsonify(result_cache.stats())
+
+@app.route('/stats/outbox')
+def outbox_stats():
+    """ Number of packets in each state of the packet API outbox """
+    return jsonify(publisher.outbox.counts())
+
+@app.route('/stats/scheduler')
+def scheduler_stats():
+    """ What's queued by clip class, wait-time percentiles by clip class over the last
+    SCHEDULER_STATS_WINDOW_S, and the most recent scheduling decisions (see scheduler.py) """
+    now = time.time()
+    claims = job_store.claims(now - SCHEDULER_STATS_WINDOW_S)
+    recent = []
+    for claim in claims[:SCHEDULER_RECENT_DECISIONS]:
+        claim["submitter"] = scheduler.submitter_label(claim["submitter"])
+        claim["clip_class"] = scheduler.clip_class(claim["duration"])
+        recent.append(claim)
+    return jsonify(queued=scheduler.queue_summary(job_store.queued_jobs(), now),
+                   wait_s=scheduler.wait_stats([(c["duration"], c["wait_s"]) for c in claims]),
+                   recent_decisions=recent)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """ Stage latencies, queue depth, worker utilization and packet counts of the server and all its
+    worker processes, in the Prometheus text format (see metrics.py) """
+    depth, oldest_wait = job_store.queue_stats()
+    sampled = metrics.render_sampled("equisat_queue_depth", "Jobs waiting for a decoder worker", depth)
+    sampled += metrics.render_sampled("equisat_queue_oldest_wait_seconds", "How long the oldest queued job has waited", oldest_wait)
+    supervisor = getattr(decoder, "supervisor", None) # the fake decoder has no workers
+    if supervisor is not None:
+        stats = supervisor.stats()
+        sampled += metrics.render_sampled("equisat_workers", "Decoder worker processes, by whether they're running a job",
+                                          {"busy": stats["busy_workers"], "idle": stats["workers"] - stats["busy_workers"]}, "state")
+        sampled += metrics.render_sampled("equisat_worker_exits_total", "Decoder workers which crashed or were killed "
+                                          "for running past the job timeout", {"crashed": stats["crashes"],
+                                          "timed_out": stats["timeouts"]}, "reason", type="counter")
+    sampled += metrics.render_sampled("equisat_outbox_packets", "Packets in the packet API outbox, by state",
+                                      publisher.outbox.counts(), "state")
+    return Response(metrics.render(sampled), mimetype="text/plain; version=0.0.4")
+
+## Ingest stages (run by the decoder workers, see pipeline.py)
+
+def fetch_satnogs_stage(job):
+    """ Pulls the observation metadata and audio file from SatNOGS """
+    args = job["args"]
+    obs_id = args["obs_id"]
+
     # try to get observation data
-    app.logger.info("[obs %s] pulling data from SatNOGS" % request.form["obs_id"])
-    obs_data = scrape_satnogs_metadata(request.form["obs_id"])
-    app.logger.debug("[obs %s] got SatNOGS data: %s" % (request.form["obs_id"], obs_data))
+    app.logger.info("[obs %s] pulling data from SatNOGS" % obs_id)
+    obs_data = satnogs.get_metadata(obs_id)
+    app.logger.debug("[obs %s] got SatNOGS data: %s" % (obs_id, obs_data))
 
     # validate the observation properties
     if obs_data is None:
-        title = "Observation not found or incomplete"
-        message = "We could not find an observation under the ID you provided, or the page for observation was incomplete. " \
-                  "Make sure the page for that observation is available on SatNOGS "
-        return render_template("decode_submit.html", title=title, message=message)
+        raise StageError("Observation not found or incomplete",
+                         "We could not find an observation under the ID you provided, or the page for observation was incomplete. " \
+                         "Make sure the page for that observation is available on SatNOGS ")
     elif obs_data["status"] == "pending":
-        title = "Observation is in the future"
-        message = "The observation had status 'future' so there is no data available to decode"
-        return render_template("decode_submit.html", title=title, message=message)
+        raise StageError("Observation is in the future",
+                         "The observation had status 'future' so there is no data available to decode")
     elif obs_data["audio_url"] is None:
-        title = "No audio found for observation"
-        message = "We couldn't find an audio file listed under this observation. " \
-                  "It's possible that the observation failed and the station did not upload audio."
-        return render_template("decode_submit.html", title=title, message=message)
-
-    rx_time = obs_data["start_time"] + datetime.timedelta(seconds=start_s)
-
-    # get file
-    filename = AUDIO_UPLOAD_FOLDER + os.path.basename(obs_data["audio_url"])
-    app.logger.info("[obs %s] retrieving audio file from %s" % (request.form["obs_id"], obs_data["audio_url"]))
-    urllib.urlretrieve(obs_data["audio_url"], filename)
+        raise StageError("No audio found for observation",
+                         "We couldn't find an audio file listed under this observation. " \
+                         "It's possible that the observation failed and the station did not upload audio.")
+
+    args["rx_time"] = obs_data["start_time"] + datetime.timedelta(seconds=args["start_s"])
+    args["station_name"] = "%s #%s" % (obs_data["station_name"], obs_id)
+
+    # get file (named after the job, as other jobs may be fetching the same observation)
+    filename = AUDIO_UPLOAD_FOLDER + job["id"] + os.path.splitext(os.path.basename(obs_data["audio_url"]))[1]
+    app.logger.info("[obs %s] retrieving audio file from %s" % (obs_id, obs_data["audio_url"]))
+    satnogs.fetch_audio(obs_id, obs_data["audio_url"], filename)
+    job["wavfilename"] = filename
+
+    # check the start time against the duration in the file header before converting it
+    info = decoder.probe_audiofile(filename)
+    if info is not None and args["start_s"] >= info.duration:
+        os.remove(filename)
+        raise StageError("Start time was larger than the duration of the observation",
+                         "You specified a start time of %ss but the observation was only %ss long." % (args["start_s"], info.duration))
+
+def convert_stage(job):
+    """ Converts the job's audio file to WAV and checks its duration """
+    filename = job["wavfilename"]
+    args = job["args"]
 
     # convert audio file to WAV and get metadata for filtering
     wavfilename, sample_rate, duration, _ = decoder.convert_audiofile(filename)
-    os.remove(filename) # remove original file
+    # remove original file now, unless it was originally a wav
+    if filename != wavfilename:
+        os.remove(filename)
 
     if wavfilename is None:
-        title = "Audio file conversion failed"
-        message = "Converting from the SatNOGS format failed. This is likely a bug with our software, " \
-                  "but could be an issue with the SatNOGS observation. Please try another observation" \
-                  "or email us at bse@brown.edu"
-        return render_template("decode_submit.html", title=title, message=message)
-    elif start_s >= duration:
-        title = "Start time was larger than the duration of the observation"
-        message = "You specified a start time of %ss but the observation was only %ss long." % (start_s, duration)
-        return render_template("decode_submit.html", title=title, message=message)
+        if args["satnogs"]:
+            raise StageError("Audio file conversion failed",
+                             "Converting from the SatNOGS format failed. This is likely a bug with our software, " \
+                             "but could be an issue with the SatNOGS observation. Please try another observation" \
+                             "or email us at bse@brown.edu")
+        else:
+            raise StageError("Audio file conversion failed",
+                             "We need to convert your audio file to a 16-bit PCM WAV file, but the conversion failed. " \
+                             "Make sure your audio file format is supported by libsndfile (see link on main page)." \
+                             "You can also try converting the file yourself using a program such as Audacity or ffmpeg.")
 
-    # slice audio file to desired duration
-    success, duration = decoder.slice_audiofile(wavfilename, start_s, stop_s, sample_rate)
-
-    if not success:
-        title = "Audio file slicing failed"
-        message = "We were unable to shorten the audio file according to the start and end times you specified. " \
-                  "You can try removing these values or not using negative values."
-        # remove the unused file
-        os.remove(wavfilename)
+    job["wavfilename"] = wavfilename
+    job["sample_rate"] = sample_rate
+    job["duration"] = duration
+    settle_audio_charge(args, duration)
 
+    if args["satnogs"]:
+        if args["start_s"] >= duration:
+            os.remove(wavfilename)
+            raise StageError("Start time was larger than the duration of the observation",
+                             "You specified a start time of %ss but the observation was only %ss long." % (args["start_s"], duration))
     elif duration > MAX_AUDIOFILE_DURATION_S:
-        title = "Specified duration too long"
-        message = "The duration you specified with your start and end times was too long. " \
-                  "You can try specifying a shorter or more specific duration (i.e. try not leaving the fields blank)."
         # remove the unused file
         os.remove(wavfilename)
+        raise StageError("Audio file too long", too_long_message(duration))
 
-    else:
-        station_name = "%s #%s" % (obs_data["station_name"], request.form["obs_id"])
-        app.logger.info("Submitting SATNOGS decode request; station_name: %s, time interval: [%ss, %ss], rx_time: %s, submit_to_db: %s, post_publicly: %s, wavfilename: %s",
-                        station_name, start_s, stop_s, rx_time, request.form.has_key("submit_to_db"), request.form.has_key("post_publicly"), wavfilename)
+def slice_stage(job):
+    """ Limits the job to the requested start and stop times of its WAV file
+    (which is left as it is; only that span of its frames is demodulated) """
+    args = job["args"]
+    wavfilename = job["wavfilename"]
 
-        decoder.submit(wavfilename, on_complete_decoding, args={
-            "email": request.form["email"],
-            "rx_time": rx_time,
-            "station_name": station_name,
-            "submit_to_db": request.form.has_key("submit_to_db") or request.form.has_key("post_publicly"), # submit to db is prereq
-            "post_publicly": request.form.has_key("post_publicly"),
-            "satnogs": True,
-            "obs_id": request.form["obs_id"]
-        })
-        title = "SatNOGS observation submitted successfully!"
-        message = "The observation is queued to be decoded. You should be receiving an email shortly (even if there were no results). "
-        if request.form.has_key("submit_to_db"):
-            message += "Thank you so much for your help in providing us data on EQUiSat!"
-        else:
-            message += "Thank you for your interest in EQUiSat!"
-
-    return render_template("decode_submit.html", title=title, message=message)
-
-def scrape_satnogs_metadata(obs_id):
-    page = requests.get("https://network.satnogs.org/observations/%s" % obs_id)
+    # slice audio file to desired duration
+    try:
+        duration, frames = audio_utils.view_audiofile(wavfilename, args["start_s"], args["stop_s"], job["sample_rate"])
+    except RuntimeError as ex: # soundfile error
+        app.logger.error("Error reading audio file '%s'", wavfilename)
+        app.logger.exception(ex)
+        # remove the unused file
+        os.remove(wavfilename)
+        raise StageError("Audio file slicing failed",
+                         "We were unable to shorten the audio file according to the start and end times you specified. " \
+                         "You can try removing these values or not using negative values.")
 
-    if page.status_code == 404:
-        # no observation found
-        return None
-    else:
-        soup = BeautifulSoup(page.text, 'html.parser')
+    if duration > (MAX_BATCH_OBSERVATION_S if args.get("batch_id") is not None else MAX_AUDIOFILE_DURATION_S):
+        # remove the unused file
+        os.remove(wavfilename)
+        raise StageError("Specified duration too long",
+                         "The duration you specified with your start and end times was too long. " \
+                         "You can try specifying a shorter or more specific duration (i.e. try not leaving the fields blank).")
 
-        try:
-            # get side column
-            side_col_rows = soup.body.find_all(attrs={"class":"front-line"})
-
-            # extract status
-            # <span class ="label label-xs label-good" aria-hidden="true" data-toggle="tooltip" data-placement="right" title=""
-            # data-original-title="Vetted good on 2019-01-07 00:16:28 by Brown Space Engineering">Good</span>
-            status_span = side_col_rows[3].findChildren()[2] # findChildren returns flat list of all nested children
-            status = status_span.text.lower()
-
-            # extract station name
-            # <a href="/stations/291/">
-            #   291 - COSPAR 8049
-            # </a>
-            full_station_name = side_col_rows[1].a.text
-            dash_i = full_station_name.index("-")
-            station_name = full_station_name[dash_i+1:].strip()
-
-            # extract and convert observation start time
-            start_time_span = side_col_rows[7].findChildren()[2]
-            start_time_str = start_time_span.contents[1].text + "T" + start_time_span.contents[3].text
-            start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%dT%H:%M:%S")
-
-            # extract URL of audio file
-            # <a href="/media/data_obs/399165/satnogs_399165_2019-01-07T00-01-01.ogg" target="_blank" download="">
-            #     <button type="button" class="btn btn-default btn-xs" >
-            #         <span class ="glyphicon glyphicon-download"></span>
-            #         Audio
-            #     </button>
-            # </a>
-            if len(side_col_rows) < 15:
-                audio_url = None
-            else:
-                first_a = side_col_rows[14].a
-                # check if the icon exists and if it's the audio one
-                if first_a is None or first_a["href"].find(".ogg") == -1:
-                    audio_url = None
-                else:
-                    audio_url = "https://network.satnogs.org" + first_a["href"]
-
-            return {
-                "status": str(status),
-                "station_name": str(station_name),
-                "start_time": start_time,
-                "audio_url": str(audio_url)
-            }
-
-        except IndexError or ValueError as ex:
-            app.logger.error("Error while parsing SatNOGS station page for observation %s", obs_id)
-            app.logger.exception(ex)
-            return None
+    job["frames"] = frames
+    job["duration"] = duration
+    # the submission was charged for the interval requested (see check_admission)
+    settle_audio_charge(args, duration)
 
 ## Post-decoding helpers
 
@@ -354,8 +693,14 @@ def validate_email(email):
         return False, render_template("decode_submit.html", title=title, message=message)
 
 def on_complete_decoding(wavfilename, packets, args, err):
+    # jobs which were rejected or failed (including through pipeline.fail_job) decoded nothing,
+    # so give back all the audio time they were charged for
+    if err is not None:
+        refund_audio(args, args.pop("charged_audio_s", 0))
+
     # remove wavfile because we're done with it (but leave it around on error for debugging)
-    if err is None:
+    # (there is none if the results were cached for a SatNOGS observation)
+    if err is None and wavfilename is not None:
         app.logger.debug("[%s] removing used wavfile %s", args["station_name"], wavfilename)
         os.remove(wavfilename)
 
@@ -369,54 +714,68 @@ def on_complete_decoding(wavfilename, packets, args, err):
     send_decode_results(wavfilename, packets, args, num_published, err)
 
 def publish_packets(packets, args):
-    num_published = 0
-    if args["submit_to_db"]:
-        for packet in packets["corrected_packets"]:
-            if len(packet["decode_errs"]) == 0:
-                published = submit_packet(packet["raw"], packet["corrected"], args["post_publicly"], args["rx_time"], args["station_name"], config.api_key)
-                if published:
-                    num_published += 1
-            else:
-                app.logger.debug("[%s] did not submit packet to DB due to decode errors: %s", args["station_name"], packet["decode_errs"])
+    """ Queues the job's error-free packets for submission to the packet API (see publisher.py),
+    leaving out those already accepted from another job (see packet_index.py), and returns the
+    number queued. Also marks each corrected packet with the other stations that received it.
+    The publisher records packets in the index once the API accepts them; packets are published
+    if it can't be read """
+    seen_packets = []
+    queued = set()
+    payloads = []
+    for packet in packets["corrected_packets"]:
+        seen = indexed_packet(packet["corrected"], args)
+        if args["submit_to_db"] and len(packet["decode_errs"]) == 0:
+            if seen is not None:
+                seen_packets.append(packet)
+            if seen is None and packet["corrected"] not in queued:
+                queued.add(packet["corrected"])
+                payloads.append(packet_payload(packet["raw"], packet["corrected"], args["post_publicly"], args["rx_time"], args["station_name"]))
+            elif seen is not None:
+                app.logger.debug("[%s] did not submit packet to DB as %s already did", args["station_name"], seen["station_name"])
+                metrics.duplicate_packets.inc()
+        elif args["submit_to_db"]:
+            app.logger.debug("[%s] did not submit packet to DB due to decode errors: %s", args["station_name"], packet["decode_errs"])
+        if seen is not None:
+            packet["also_received_by"] = [station for station in seen["stations"] if station != args["station_name"]]
 
-    return num_published
+    try:
+        num_published = publisher.submit(uuid.uuid4().hex, args["station_name"], payloads)
+    except Exception as ex:
+        app.logger.error("[%s] couldn't queue packets for submission", args["station_name"])
+        app.logger.exception(ex)
+        num_published = 0
 
-def submit_packet(raw, corrected, post_publicly, rx_time, station_name, api_key):
-    epoch = datetime.datetime(1970, 1, 1)
-    rx_time_posix = (rx_time - epoch).total_seconds()*1000 # ms since 1970
-
-    jsn = {
-        "raw": raw,
-        "corrected": corrected,
-        "station_name": station_name,
-        "post_publicly": post_publicly,
-        "source": "decoder.brownspace.org",
-        "rx_time": rx_time_posix,
-        "secret": api_key,
-    }
+    for packet in seen_packets:
+        try:
+            packet_index.add_station(packet["corrected"], args["station_name"])
+        except Exception as ex:
+            app.logger.error("[%s] couldn't record packet in the index", args["station_name"])
+            app.logger.exception(ex)
+    return num_published
 
+def indexed_packet(corrected, args):
+    """ Returns the packet's entry in the index (see PacketIndex.get), or None if it isn't there
+    or the index can't be read (so the packet is published rather than lost) """
     try:
-        r = requests.post(PACKET_API_ROUTE, json=jsn)
-        if r.status_code == requests.codes.ok or r.status_code == 201:
-            app.logger.info("[%s] submitted %spacket successfully" %
-                            (station_name, "duplicate " if r.status_code == 201 else ""))
-            del jsn["secret"] # remove hidden info
-            app.logger.debug("Full POST request:\n%s", jsn)
-            return True
-        else:
-            app.logger.warning("[%s] couldn't submit packet (%d): %s" % (station_name, r.status_code, r.text))
-            return False
+        return packet_index.get(corrected)
     except Exception as ex:
-        app.logger.error("[%s] couldn't submit packet", station_name)
+        app.logger.error("[%s] couldn't look up packet in the index", args["station_name"])
         app.logger.exception(ex)
-        return False
+        return None
 
 def send_decode_results(wavfilename, packets, args, num_published, err):
     raw_packets = packets["raw_packets"]
     corrected_packets = packets["corrected_packets"]
-    cleaned_wavfilename = os.path.basename(wavfilename)
+    cleaned_wavfilename = os.path.basename(wavfilename) if wavfilename is not None else ""
 
-    if err is not None:
+    if err is not None and "error_title" in packets:
+        # the job was rejected by one of its ingest stages
+        body = """Unfortunately, we weren't able to decode your submission: %s
+
+%s
+""" % (packets["error_title"], err)
+
+    elif err is not None:
         body = """Unfortunately, the server encountered an error while attempting to decode your file and couldn't continue.
         
 This is likely a bug with our software, so we'd appreciate it if you forwarded this email to bse@brown.edu. 
@@ -433,8 +792,10 @@ If you're curious, this is the error message that was produced: %s
         for i in range(len(corrected_packets)):
             parsed_yaml = yaml.dump(corrected_packets[i]["parsed"], default_flow_style=False)
             decode_errs_s = "none" if len(corrected_packets[i]["decode_errs"]) == 0 else ", ".join(corrected_packets[i]["decode_errs"])
-            corrected_packets_summary += "packet #%d:\nhex:\n\t%s\nerrors in decoding: %s\ndecoded data:\n %s\n\n" % \
-                                         (i+1, corrected_packets[i]["corrected"], decode_errs_s, parsed_yaml)
+            also_received_by = corrected_packets[i].get("also_received_by")
+            also_received_by_s = "also received by: %s\n" % ", ".join(also_received_by) if also_received_by else ""
+            corrected_packets_summary += "packet #%d:\nhex:\n\t%s\n%serrors in decoding: %s\ndecoded data:\n %s\n\n" % \
+                                         (i+1, corrected_packets[i]["corrected"], also_received_by_s, decode_errs_s, parsed_yaml)
         if len(corrected_packets) > 0:
             corrected_packets_summary += "To learn more about the decoded data, see this table: <a href=\"https://goo.gl/Kj9RkY\">https://goo.gl/Kj9RkY</a>"
 
@@ -443,9 +804,11 @@ If you're curious, this is the error message that was produced: %s
             extra_msg = "\nSorry nothing was found! We're still working on the decoder, so keep trying and check back later!\n"
         if num_published > 0:
             if args["post_publicly"]:
-                extra_msg = "\n%d of your packets were added to our database and should have been posted to <a href=\"https://twitter.com/equisat_bot\">Twitter</a>!\n" % num_published
+                extra_msg = "\n%d of your packets were submitted to our database and should soon be posted to <a href=\"https://twitter.com/equisat_bot\">Twitter</a>!\n" % num_published
             else:
-                extra_msg = "\n%d of your packets were added to our database!\n" % num_published
+                extra_msg = "\n%d of your packets were submitted to our database!\n" % num_published
+        elif args["submit_to_db"] and any(len(packet["decode_errs"]) == 0 for packet in corrected_packets):
+            extra_msg = "\nYour packets had already been submitted to our database, by you or other stations.\n"
         elif args["submit_to_db"]:
             extra_msg = "\nYour packets unfortunately had too many errors to be added to our database or posted publicly.\n"
 
@@ -482,19 +845,98 @@ Email us: <a href="mailto:bse@brown.edu">bse@brown.edu</a>
 
     contents = "%s\n%s\n%s" % (header, body, footer)
 
-    if yag is not None:
+    if mailer is not None:
         try:
-            yag.send(to=args["email"], subject=subject, contents=contents)
-            app.logger.debug("[%s] sent email with info on packets (raw: %d, corrected: %d, err: %s)",
+            mailer.send(args["email"], subject, contents)
+            app.logger.debug("[%s] queued email with info on packets (raw: %d, corrected: %d, err: %s)",
                              args["station_name"], len(raw_packets), len(corrected_packets), err)
         except Exception as ex:
-            app.logger.error("[%s] email failed to send", args["station_name"])
+            app.logger.error("[%s] email failed to queue", args["station_name"])
+            app.logger.exception(ex)
+
+def on_complete_batch_decoding(wavfilename, packets, args, err):
+    """ Records the result of one observation of a batch, queues the next one, and reports on
+    the whole batch if it was the last to finish. The observation is finished even if handling its
+    result fails, so the batch doesn't wait on it forever """
+    result = {
+        "obs_id": args["obs_id"],
+        "station_name": args["station_name"],
+        "error_title": "Error handling the results",
+        "error": err or "The observation was decoded, but its results couldn't be handled",
+        "raw_packets": 0,
+        "corrected_packets": [],
+        "also_received_by": [],
+        "published": 0,
+    }
+    try:
+        if err is None and wavfilename is not None:
+            os.remove(wavfilename)
+        num_published = publish_packets(packets, args) if err is None else 0
+
+        result.update({
+            "error_title": packets.get("error_title") if err is not None else None,
+            "error": err,
+            "raw_packets": len(packets["raw_packets"]),
+            "corrected_packets": [packet["corrected"] for packet in packets["corrected_packets"]],
+            "also_received_by": [packet.get("also_received_by", []) for packet in packets["corrected_packets"]],
+            "published": num_published,
+        })
+    finally:
+        last = job_store.finish_batch_observation(args["batch_id"], args["obs_id"], result)
+        feed_batch(args["batch_id"])
+        if last:
+            try:
+                send_batch_report(job_store.batch(args["batch_id"]))
+            finally:
+                job_store.forget_batch_email(args["batch_id"])
+
+def send_batch_report(batch):
+    summary = batch_summary(batch)
+    lines = []
+    for obs in sorted(batch["observations"], key=lambda obs: int(obs["obs_id"])):
+        result = obs["result"]
+        if result["error"] is not None:
+            lines.append("%s: not decoded (%s)" % (result["station_name"], result["error_title"] or result["error"]))
+        else:
+            lines.append("%s: %d valid error-corrected packets (%d raw), %d submitted to our database" %
+                         (result["station_name"], len(result["corrected_packets"]), result["raw_packets"], result["published"]))
+
+    contents = """Hello,
+
+Here are your results from the EQUiSat Decoder <a href="http://decoder.brownspace.org">decoder.brownspace.org</a>, for a batch of %(observations)d SatNOGS observations:
+%(decoded)d were decoded, %(with_packets)d with packets, for %(corrected_packets)d valid error-corrected packets (%(raw_packets)d raw) in all, %(published)d of which were submitted to our database.
+
+""" % summary + "\n".join(lines) + """
+
+The Brown Space Engineering Team
+"""
+    if mailer is not None:
+        try:
+            mailer.send(batch["args"]["email"], "EQUiSat Decoder Results for %d SatNOGS observations" % batch["total"], contents)
+            app.logger.debug("[batch %s] queued email with the batch's results", batch["id"])
+        except Exception as ex:
+            app.logger.error("[batch %s] email failed to queue", batch["id"])
             app.logger.exception(ex)
 
-def start_decoder(num_procs=NUM_DECODER_PROCESSES):
-    decoder.start(num_procs)
+def start_decoder(min_workers=getattr(config, "min_decoder_workers", MIN_DECODER_WORKERS),
+                  max_workers=getattr(config, "max_decoder_workers", MAX_DECODER_WORKERS)):
+    # clean up after jobs which were interrupted by the last shutdown
+    pipeline.collect_orphaned_files(AUDIO_UPLOAD_FOLDER, job_store, logger=app.logger)
+    decoder.start(min_workers, max_workers)
+    # carry on with batches interrupted by the last shutdown
+    for batch_id in job_store.unfinished_batches():
+        feed_batch(batch_id)
+
+def start_publisher():
+    publisher.start()
+
+def start_mailer():
+    if mailer is not None:
+        mailer.start()
 
 if __name__ == "__main__":
     start_decoder()
+    start_publisher()
+    start_mailer()
     app.run(debug=True)
     # see run.py for production runner
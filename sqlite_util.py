@@ -0,0 +1,59 @@
+""" SQLite connections for the stores shared between the server and its worker processes (the job
+store, the packet and mail outboxes, the disk caches and the packet index). SQLite connections can't
+be shared between processes or threads, so each store holds a LocalConnection, which opens one per
+process and thread on first use, and is pickled as just what's needed to open it again. """
+import os
+import sqlite3
+import threading
+
+DB_TIMEOUT_S = 30
+SCHEMA_ATTEMPTS = 3
+
+def connect(path, schema, migrate=None):
+    """ Opens the database at path (creating its folder if need be) in WAL mode, with rows returned as
+    sqlite3.Rows and transactions left to the caller, runs the given (idempotent) schema script on it
+    and then migrate(conn), if given, to bring databases created by older versions up to date """
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    conn = sqlite3.connect(path, timeout=DB_TIMEOUT_S, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for attempt in range(SCHEMA_ATTEMPTS):
+        try:
+            conn.executescript(schema)
+            break
+        except sqlite3.OperationalError:
+            # another connection created the schema while the script ran (Python 2's executescript
+            # doesn't re-prepare statements after a schema change); the script is idempotent, so rerun it
+            if attempt == SCHEMA_ATTEMPTS - 1:
+                raise
+    if migrate is not None:
+        migrate(conn)
+    return conn
+
+class LocalConnection:
+    """ The connection to a database (see connect) of the calling process and thread. migrate must
+    be a module-level function, so it can be pickled """
+
+    def __init__(self, path, schema, migrate=None):
+        self.path = path
+        self.schema = schema
+        self.migrate = migrate
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections can't be shared between processes
+        return {"path": self.path, "schema": self.schema, "migrate": self.migrate}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["schema"], state["migrate"])
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect(self.path, self.schema, self.migrate)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
@@ -0,0 +1,141 @@
+""" Supervisor thread which sizes the DecoderQueue's worker pool to the load: it keeps at least
+min_workers running, spawns more (up to max_workers) while jobs are waiting, and retires workers
+which have been idle for a while. The pool is capped by the number of cores, since every worker
+runs a GNU Radio flowgraph with a thread per block rather than a single thread.
+It also kills workers whose job has run past the job timeout, and hands the jobs of workers that
+died (crashed, ran out of memory or were killed) back to the DecoderQueue to be rerun or failed. """
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+SUPERVISE_PERIOD_S = 1
+# each demod flowgraph keeps about this many cores busy (the filter/resampling chain and the
+# clock recovery and decoder blocks run in parallel threads)
+CORES_PER_WORKER = 2
+MIN_WORKERS = 1
+SCALE_UP_QUEUE_DEPTH = 2 # waiting jobs per idle worker before scaling up right away
+SCALE_UP_WAIT_S = 5 # or the age of the oldest waiting job
+WORKER_IDLE_RETIRE_S = 120
+
+def max_workers_for_cores(cores=None):
+    """ The largest pool that doesn't oversubscribe the CPU """
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    return max(1, cores // CORES_PER_WORKER)
+
+class WorkerState:
+    """ A decoder worker process along with the flags it shares with the supervisor """
+    def __init__(self):
+        self.proc = None
+        self.retiring = multiprocessing.Value("b", False)
+        self.busy = multiprocessing.Value("b", False)
+        self.last_active = multiprocessing.Value("d", time.time())
+        self.job_id = multiprocessing.Array("c", 32) # of the job being run, or empty
+        self.job_started = multiprocessing.Value("d", 0)
+        self.killed_reason = None # set by the supervisor when it kills the worker
+
+    def idle_for(self):
+        return 0 if self.busy.value else time.time() - self.last_active.value
+
+class DecoderSupervisor:
+    def __init__(self, decoder, min_workers=MIN_WORKERS, max_workers=None, job_timeout=None, logger=logging):
+        """ decoder is the DecoderQueue whose workers are supervised; max_workers
+        defaults to (and is capped by) max_workers_for_cores(). Workers are killed
+        if their current job has run for more than job_timeout seconds """
+        cap = max_workers_for_cores()
+        self.decoder = decoder
+        self.max_workers = cap if max_workers is None else max(1, min(max_workers, cap))
+        self.min_workers = max(0, min(min_workers, self.max_workers))
+        self.job_timeout = job_timeout
+        self.crashes = 0
+        self.timeouts = 0
+        self.logger = logger
+        self.thread = None
+
+    def start(self):
+        self.scale_to(self.min_workers)
+        self.thread = threading.Thread(target=self.run, name="decoder-supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.decoder.stopping.value:
+            try:
+                self.supervise()
+            except Exception as ex:
+                self.logger.error("Exception in decoder supervisor")
+                self.logger.exception(ex)
+            time.sleep(SUPERVISE_PERIOD_S)
+
+    def active_workers(self):
+        return [w for w in self.decoder.workers if not w.retiring.value]
+
+    def enforce_timeouts(self):
+        if self.job_timeout is None:
+            return
+        for worker in self.decoder.workers:
+            runtime = time.time() - worker.job_started.value
+            if worker.busy.value and runtime > self.job_timeout and worker.killed_reason is None:
+                self.logger.error("[%s] killing decoder worker %d after %ds", worker.job_id.value, worker.proc.pid, runtime)
+                worker.killed_reason = "timed out after %ds" % self.job_timeout
+                self.timeouts += 1
+                try:
+                    os.kill(worker.proc.pid, signal.SIGKILL)
+                except OSError: # already gone
+                    pass
+
+    def reap(self):
+        """ Forgets about workers which have exited, letting the decoder recover any job they were running """
+        for worker in list(self.decoder.workers):
+            if worker.proc.is_alive():
+                continue
+            worker.proc.join()
+            self.decoder.workers.remove(worker)
+
+            if worker.killed_reason is None and not worker.retiring.value:
+                self.crashes += 1
+                self.logger.error("decoder worker %d died (exit code %s)", worker.proc.pid, worker.proc.exitcode)
+            reason = worker.killed_reason or "crashed (exit code %s)" % worker.proc.exitcode
+            self.decoder.lost_worker(worker.proc.pid, reason)
+
+    def supervise(self):
+        self.enforce_timeouts()
+        self.reap()
+        workers = self.active_workers()
+        depth, oldest_wait = self.decoder.queue_stats()
+        idle = [w for w in workers if not w.busy.value]
+
+        if len(workers) < self.min_workers:
+            self.scale_to(self.min_workers)
+
+        elif depth > len(idle) and len(workers) < self.max_workers and \
+                (depth >= SCALE_UP_QUEUE_DEPTH * max(1, len(idle)) or oldest_wait >= SCALE_UP_WAIT_S):
+            target = min(self.max_workers, len(workers) + depth - len(idle))
+            self.logger.info("%d jobs waiting (oldest %.1fs); scaling decoder workers from %d to %d",
+                             depth, oldest_wait, len(workers), target)
+            self.scale_to(target)
+
+        elif depth == 0 and len(workers) > self.min_workers:
+            # retire the workers that have been idle longest first
+            idle = sorted([w for w in idle if w.idle_for() >= WORKER_IDLE_RETIRE_S], key=lambda w: -w.idle_for())
+            for worker in idle[:len(workers) - self.min_workers]:
+                self.logger.info("retiring decoder worker %d (idle %ds)", worker.proc.pid, worker.idle_for())
+                worker.retiring.value = True
+
+    def scale_to(self, num):
+        for _ in range(num - len(self.active_workers())):
+            self.decoder.spawn_worker()
+
+    def stats(self):
+        workers = self.active_workers()
+        return {
+            "workers": len(workers),
+            "busy_workers": len([w for w in workers if w.busy.value]),
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "crashes": self.crashes,
+            "timeouts": self.timeouts,
+        }
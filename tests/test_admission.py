@@ -0,0 +1,57 @@
+""" Charging and refunding of the clients' audio allowances (see admission.py and server.check_admission) """
+import os
+import shutil
+import tempfile
+import unittest
+
+import jobstore
+import pipeline
+import server
+
+class NotFoundSatnogs:
+    """ A SatNOGS client for which no observation can be found """
+    def get_metadata(self, obs_id):
+        return None
+
+class RefundTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (server.job_store, server.satnogs, server.mailer)
+        server.job_store = jobstore.JobStore(os.path.join(self.folder, "jobs.db"))
+        server.satnogs = NotFoundSatnogs()
+        server.mailer = None
+
+    def tearDown(self):
+        server.job_store, server.satnogs, server.mailer = self.saved
+        shutil.rmtree(self.folder)
+
+    def test_failed_fetch_refunds_charge(self):
+        args = {
+            "email": "station@example.com",
+            "rx_time": None,
+            "station_name": "SatNOGS observation #1",
+            "submit_to_db": False,
+            "post_publicly": False,
+            "satnogs": True,
+            "obs_id": "1",
+            "start_s": 0,
+            "stop_s": 300,
+            "client_ip": "192.0.2.1",
+        }
+        # the client has already used some of its allowance
+        server.ip_buckets.charge(args["client_ip"], 600)
+        server.submitter_buckets.charge(server.scheduler.submitter_key(args), 600)
+        ip_before = server.ip_buckets.full_at[server.ip_buckets._slot(args["client_ip"])]
+
+        with server.app.app_context():
+            self.assertIsNone(server.check_admission(args, 300))
+            self.assertGreater(server.ip_buckets.full_at[server.ip_buckets._slot(args["client_ip"])], ip_before)
+
+            job = pipeline.new_job(None, server.on_complete_decoding, args,
+                                   [server.fetch_satnogs_stage, server.convert_stage, server.slice_stage], 300)
+            pipeline.run_job(job, None, logger=server.app.logger)
+
+        self.assertAlmostEqual(server.ip_buckets.full_at[server.ip_buckets._slot(args["client_ip"])], ip_before)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+""" Rendering of the job status page (templates/job_status.html) for jobs in each state """
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask, render_template
+
+import jobstore
+from jobstore import JobStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class JobStatusPageTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.folder, "jobs.db"))
+        self.app = Flask(__name__, template_folder=os.path.join(ROOT, "templates"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def render(self, job_id):
+        job = self.store.get(job_id)
+        with self.app.test_request_context():
+            return render_template("job_status.html", job=job, finished=job["state"] in jobstore.FINISHED_STATES,
+                                   json_url="/job/%s?format=json" % job_id)
+
+    def test_split_job(self):
+        args = {"station_name": "test station"}
+        job = {"id": "parent", "args": args}
+        self.store.create(job, ["slice", "demod", "decode"])
+        chunks = [{"id": "chunk%d" % i, "args": args, "parent_id": "parent", "chunk_index": i} for i in range(3)]
+        self.store.split(job, chunks, ["demod"])
+        self.store.finish("chunk0", jobstore.DONE, packets={"raw_packets": [], "corrected_packets": []})
+
+        page = self.render("parent")
+        self.assertIn("being demodulated in 3 chunks; 1 of them has finished", page)
+        self.assertNotIn("error while decoding", page)
+
+if __name__ == "__main__":
+    unittest.main()
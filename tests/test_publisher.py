@@ -0,0 +1,82 @@
+""" Queueing decoded packets for the packet API and recording the published ones in the packet index
+(see publisher.py, packet_index.py and server.publish_packets) """
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import publisher
+import server
+from packet_index import PacketIndex
+from publisher import Outbox, PacketPublisher
+
+CORRECTED = "0123456789abcdef"
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+class StandinSession:
+    """ Answers every post to the packet API with the given status code """
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.posted = []
+
+    def post(self, route, json=None, timeout=None):
+        self.posted.append(json)
+        return Response(self.status_code)
+
+def job_packets():
+    return {
+        "raw_packets": [CORRECTED + "00"],
+        "corrected_packets": [{"raw": CORRECTED + "00", "corrected": CORRECTED, "decode_errs": []}],
+    }
+
+def job_args(station_name):
+    return {
+        "station_name": station_name,
+        "rx_time": datetime.datetime(2018, 9, 1, 12, 0, 0),
+        "submit_to_db": True,
+        "post_publicly": False,
+    }
+
+class PublishTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (server.publisher, server.packet_index)
+        self.index = PacketIndex(os.path.join(self.folder, "packets.db"))
+        self.outbox = Outbox(os.path.join(self.folder, "outbox.db"))
+        server.packet_index = self.index
+        server.publisher = PacketPublisher("test", outbox=self.outbox, index=self.index)
+
+    def tearDown(self):
+        server.publisher, server.packet_index = self.saved
+        shutil.rmtree(self.folder)
+
+    def drain(self, status_code):
+        session = StandinSession(status_code)
+        PacketPublisher.drain(session, self.outbox, "http://api.invalid/", "test", self.index)
+        return session.posted
+
+    def test_rejected_packet_is_submitted_again(self):
+        self.assertEqual(server.publish_packets(job_packets(), job_args("first station")), 1)
+        self.assertEqual(len(self.drain(400)), 1)
+        self.assertEqual(self.outbox.counts(), {publisher.REJECTED: 1})
+        self.assertIsNone(self.index.get(CORRECTED))
+
+        # a second job with the packet queues it again, as it was never published
+        self.assertEqual(server.publish_packets(job_packets(), job_args("second station")), 1)
+        self.assertEqual(len(self.drain(200)), 1)
+        entry = self.index.get(CORRECTED)
+        self.assertEqual(entry["station_name"], "second station")
+
+        # once it was, later copies are left out
+        packets = job_packets()
+        self.assertEqual(server.publish_packets(packets, job_args("third station")), 0)
+        self.assertEqual(packets["corrected_packets"][0]["also_received_by"], ["second station"])
+        self.assertEqual(self.index.get(CORRECTED)["stations"], ["second station", "third station"])
+
+if __name__ == "__main__":
+    unittest.main()